@@ -0,0 +1,84 @@
+"""
+Ruby のマルコフ生成の速さを測る（文字/秒）
+
+    python bench_ruby.py                       # ruby_mem/channels/*.json の会話で学習
+    python bench_ruby.py --corpus log.txt      # 1行1メッセージのテキストも足せる
+    python bench_ruby.py --model ruby_model.bin
+
+before = 毎回 counter から重みを作り直す _soft_pick
+after  = 作り置きの累積重み + bisect の _pick
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import time
+
+from ruby_core import Ruby
+
+
+class LegacyRuby(Ruby):
+    """比較用: 1文字ごとに _soft_pick で重みを作り直す"""
+
+    def _pick(self, prefix, temperature=0.95):
+        return self._soft_pick(self._counts(prefix), temperature=temperature)
+
+
+def load_corpus(mem_dir: str, extra: list) -> list:
+    texts = []
+    for path in sorted(glob.glob(os.path.join(mem_dir, "channels", "*.json"))):
+        with open(path, encoding="utf-8") as f:
+            texts += [m.get("c", "") for m in json.load(f).get("messages", [])]
+    for path in extra:
+        with open(path, encoding="utf-8") as f:
+            texts += [line.rstrip("\n") for line in f]
+    return [t for t in texts if t.strip()]
+
+
+def run(cls, texts: list, seeds: list, rounds: int, model_path: str, feed_every: int) -> dict:
+    r = cls()
+    if model_path:
+        r.load_model(model_path)
+    for t in texts:
+        r.feed(t)
+
+    random.seed(1234)
+    chars = 0
+    t0 = time.perf_counter()
+    for i in range(rounds):
+        seed = seeds[i % len(seeds)]
+        # gen() と同じく温度3つで生成
+        for temp in (0.9, 1.0, 1.1):
+            chars += len(r._markov_generate(seed, max_len=120, temperature=temp))
+        if feed_every and i % feed_every == 0:
+            r.feed(seed)   # 会話中の学習で表が捨てられるコストも込みで測る
+    sec = time.perf_counter() - t0
+    return {"chars": chars, "sec": sec, "cps": chars / sec if sec else 0.0}
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Ruby の生成速度ベンチマーク")
+    ap.add_argument("--mem-dir", default="ruby_mem")
+    ap.add_argument("--corpus", action="append", default=[], help="1行1メッセージのテキスト（複数可）")
+    ap.add_argument("--model", default="", help="load_model() するモデルファイル")
+    ap.add_argument("--rounds", type=int, default=2000)
+    ap.add_argument("--feed-every", type=int, default=10, help="N回ごとにseedを学習する（0で学習しない）")
+    args = ap.parse_args()
+
+    texts = load_corpus(args.mem_dir, args.corpus)
+    if not texts and not args.model:
+        raise SystemExit("学習するテキストがありません（--mem-dir / --corpus / --model）")
+    seeds = texts or ["今日はどうだった"]
+    print(f"corpus: {len(texts)} messages, {sum(map(len, texts))} chars")
+
+    before = run(LegacyRuby, texts, seeds, args.rounds, args.model, args.feed_every)
+    after = run(Ruby, texts, seeds, args.rounds, args.model, args.feed_every)
+    for name, res in (("before", before), ("after", after)):
+        print(f"{name:6s}: {res['chars']:8d} chars  {res['sec']:7.3f}s  {res['cps']:10.0f} chars/s")
+    if before["cps"]:
+        print(f"speedup: x{after['cps'] / before['cps']:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,10 @@
 import os
+import signal
 import asyncio
 import discord
 from aiohttp import web
-from openai import OpenAI
-from datetime import date, datetime
+from openai import AsyncOpenAI
+from datetime import datetime
 import random
 import re
 
@@ -13,14 +14,94 @@ except Exception:
     ZoneInfo = None
 
 import memory_store
+from history_manager import fit_history, history_entries, summary_backlog
+from input_pipeline import DebouncePipeline, Turn
+from coordination import shard_of
+from keywords import analyze
+from metrics import REGISTRY, MessageTrace
+from openai_scheduler import OpenAIScheduler
+from rate_limiter import RateLimiter
+from reply_cache import ReplyCache
+from ruby_core import Ruby
 
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OWNER_ID = os.getenv("OWNER_ID")
 PORT = int(os.getenv("PORT", "10000"))
 
-DAILY_LIMIT = 50
-ai = OpenAI(api_key=OPENAI_API_KEY)
+# 複数プロセスで動かすとき: WORKER_COUNT 個のプロセスに WORKER_INDEX=0.. を振る（COORDINATOR=sqlite などと一緒に使う）
+# DMはどのプロセスにも届くので、DMごとに memory_store.claim_once で取り合い、取れた1つだけが返事をする
+# 相手ごとの受け持ち（shard_of）が先に取りにいき、ほかは ROUTE_GRACE_SEC 待ってから（受け持ちが落ちているときだけ拾う）
+WORKER_COUNT = max(1, int(os.getenv("WORKER_COUNT", "1")))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+ROUTE_GRACE_SEC = float(os.getenv("ROUTE_GRACE_SEC", "1.5"))
+
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")   # fake_openai.py 等に差し替え可（未設定なら本家）
+
+# ストリーミング返信：最初の塊を早めに送り、以降は間隔をあけて編集で伸ばす
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "0") == "1"
+STREAM_FIRST_CHARS = int(os.getenv("STREAM_FIRST_CHARS", "12"))
+STREAM_EDIT_INTERVAL_SEC = float(os.getenv("STREAM_EDIT_INTERVAL_SEC", "1.2"))  # Discordの編集レート制限に合わせる
+
+# OpenAIが遅い/落ちているときはローカルのるび(ruby_core)が返す
+OPENAI_LATENCY_BUDGET_SEC = float(os.getenv("OPENAI_LATENCY_BUDGET_SEC", "15"))
+# 挨拶や「AとBどっち」のような定型はAPIを呼ばずにローカルで返す
+LOCAL_TRIVIAL_REPLIES = os.getenv("LOCAL_TRIVIAL_REPLIES", "0") == "1"
+
+# 履歴はトークン数（ローカル見積もり）の予算に収める。先頭は HISTORY_ALIGN 件単位で動かす
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1200"))
+HISTORY_ALIGN = int(os.getenv("HISTORY_ALIGN", "4"))
+# 予算からあふれた発言が SUMMARY_BATCH 件たまったら、返信のあとで要約を更新する（0で無効）
+SUMMARY_BATCH = int(os.getenv("SUMMARY_BATCH", "8"))
+SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", "400"))
+
+# 短い定型メッセージへの返事はキャッシュから返す（REPLY_CACHE=1 で有効）
+# 相手ごとに分けて、履歴も要約もない状態で作った返事だけを入れる
+REPLY_CACHE = os.getenv("REPLY_CACHE", "0") == "1"
+REPLY_CACHE_MAX_ENTRIES = int(os.getenv("REPLY_CACHE_MAX_ENTRIES", "2000"))
+REPLY_CACHE_TTL_SEC = float(os.getenv("REPLY_CACHE_TTL_SEC", str(6 * 3600)))
+REPLY_CACHE_MAX_CHARS = int(os.getenv("REPLY_CACHE_MAX_CHARS", "24"))   # これより長い発言はキャッシュしない
+REPLY_CACHE_FUZZY = float(os.getenv("REPLY_CACHE_FUZZY", "0.6"))       # 文字3-gramのJaccard係数のしきい値（0で完全一致のみ）
+
+# 1メッセージの処理がこれ以上かかったら区間ごとの内訳をログに出す（0で無効）
+SLOW_MESSAGE_LOG_SEC = float(os.getenv("SLOW_MESSAGE_LOG_SEC", "0"))
+
+# るびのn-gramモデル（train_ruby.py で用意したコーパスから作る）。起動時に読み込むだけで、DMからは学習しない
+# （モデルは全員で共有なので、ある相手の発言が別の相手へのフォールバック返事に出てしまう）
+RUBY_MODEL_PATH = os.getenv("RUBY_MODEL_PATH", "ruby_model.bin")
+
+# 連投は INPUT_DEBOUNCE_SEC 静かになるまで（最初の1件から最大 INPUT_DEBOUNCE_MAX_SEC）ためて、1ターンとして返す（0で無効）
+# 返事を作っている途中に次が来たら作り直す（送り始めた後に来た分は次のターン）
+INPUT_DEBOUNCE_SEC = float(os.getenv("INPUT_DEBOUNCE_SEC", "0.8"))
+INPUT_DEBOUNCE_MAX_SEC = float(os.getenv("INPUT_DEBOUNCE_MAX_SEC", "4"))
+# 終了するときは、ためている連投と作りかけの返事を送り終えるまで最大この秒数待つ
+INPUT_DRAIN_TIMEOUT_SEC = float(os.getenv("INPUT_DRAIN_TIMEOUT_SEC", "10"))
+
+# OpenAIへの送信: 同時実行数・送信ペース(0で無制限)・429/5xxの再試行回数
+# 同じ相手の連投は OPENAI_COALESCE_SEC 待ってから、最後のメッセージの分だけまとめて1回送る
+# （入力段でまとめているときは二重に待たないよう既定で 0）
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "4"))
+OPENAI_RATE_PER_SEC = float(os.getenv("OPENAI_RATE_PER_SEC", "0"))
+OPENAI_BURST = float(os.getenv("OPENAI_BURST", "4"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+OPENAI_COALESCE_SEC = float(os.getenv("OPENAI_COALESCE_SEC", "0" if INPUT_DEBOUNCE_SEC > 0 else "0.6"))
+
+# 相手ごとの制限（ちちは対象外）。超えたらAPIは呼ばず、ローカルのるびが相手をする
+# 1日(JST)の上限はスライディングウィンドウ、連投は RATE_BURST 回まで・毎分 RATE_PER_MIN 回ずつ戻る（0で無効）
+# 回数はメモリで数え、RATE_CHECKPOINT_SEC ごとにユーザー状態の daily_counts へまとめて書く
+DAILY_LIMIT = int(os.getenv("DAILY_LIMIT", "50"))
+RATE_PER_MIN = float(os.getenv("RATE_PER_MIN", "6"))
+RATE_BURST = float(os.getenv("RATE_BURST", "5"))
+RATE_CHECKPOINT_SEC = float(os.getenv("RATE_CHECKPOINT_SEC", "300"))
+# 再試行は scheduler 側でやるので SDK の自動再試行は切る
+aai = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL, max_retries=0)
+scheduler = OpenAIScheduler(
+    max_concurrency=OPENAI_MAX_CONCURRENCY,
+    rate_per_sec=OPENAI_RATE_PER_SEC,
+    burst=OPENAI_BURST,
+    max_retries=OPENAI_MAX_RETRIES,
+    coalesce_window=OPENAI_COALESCE_SEC,
+)
 
 RUBY_SYSTEM = """
 あなたは「るび」。
@@ -74,6 +155,78 @@ MOOD_GUIDE = """
 - shy: てれ
 """
 
+DYNAMIC_GUIDE = """
+最後のシステムメッセージ「いまの状況」の読み方：
+- 呼び名: 相手の呼び名。必ずこの名前で呼ぶ。
+- 感情タグ / 今日の気分タグ: 声色に反映する（気分タグは少しだけ）。
+- 深夜=あり: 語尾をふにゃっとさせる。文は短め。『……』『〜』を多め。眠そうでやさしい声色。元気すぎる表現や強いテンションは避ける。
+- 朝の挨拶=あり: 相手が朝の挨拶をした。『おはよう』は冒頭に1回だけ返してよい。繰り返し禁止。
+- 朝の挨拶=なし: 朝の挨拶のターンではない。『おはよう/こんにちは/こんばんは』など挨拶は言わない。
+- 帰宅=あり: 帰宅の挨拶なので「おかえり」は1回だけOK。
+- 帰宅=なし: 帰宅挨拶は言わない。
+"""
+
+# 毎回まったく同じ内容・順番で先頭に置く部分（プロバイダ側のプロンプトキャッシュに乗せる）
+# 相手ごと・ターンごとに変わるものは build_messages で末尾のシステムメッセージ1つにまとめる
+STATIC_PREFIX = {
+    persona: ({"role": "system", "content": "".join(parts).strip()},)
+    for persona, parts in {
+        "chichi": (RUBY_SYSTEM, CHICHI_SYSTEM, EMOTION_GUIDE, MOOD_GUIDE, DYNAMIC_GUIDE),
+        "normal": (RUBY_SYSTEM, EMOTION_GUIDE, MOOD_GUIDE, DYNAMIC_GUIDE),
+    }.items()
+}
+
+# 送ったリクエストのトークン数（cached = プレフィックスキャッシュに当たった分）
+usage_stats = {"requests": 0, "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0}
+
+ruby = Ruby()
+if RUBY_MODEL_PATH and os.path.exists(RUBY_MODEL_PATH):
+    try:
+        ruby.load_model(RUBY_MODEL_PATH)
+        print(f"Ruby model loaded: {RUBY_MODEL_PATH} ({len(ruby.base)} keys)")
+    except Exception as e:
+        print("Ruby model load ERROR:", e)
+route_stats = {"openai": 0, "cache": 0, "local_trivial": 0, "local_limit": 0, "local_fallback": 0, "local_busy": 0,
+               "coalesced": 0}
+
+reply_cache = ReplyCache(
+    max_entries=REPLY_CACHE_MAX_ENTRIES,
+    ttl=REPLY_CACHE_TTL_SEC,
+    max_chars=REPLY_CACHE_MAX_CHARS,
+    fuzzy_threshold=REPLY_CACHE_FUZZY,
+)
+
+rate_limiter = RateLimiter(
+    daily_limit=DAILY_LIMIT,
+    per_minute=RATE_PER_MIN,
+    burst=RATE_BURST,
+    clock=lambda: jst_now(),
+    aload=lambda uid, days: load_daily_counts(uid, days),
+)
+
+input_pipeline = DebouncePipeline(
+    lambda ch_id, turn: handle_turn(ch_id, turn),
+    window=INPUT_DEBOUNCE_SEC,
+    max_wait=INPUT_DEBOUNCE_MAX_SEC,
+)
+
+# ---------- /metrics ----------
+# 区間: memory_load / emotion / prompt_build / openai（ストリーミング時は送信込み）/ send / store / total
+STAGE_LATENCY = REGISTRY.histogram("ruby_message_stage_seconds", "Time spent per on_message stage", ("stage",))
+REGISTRY.gauge("ruby_messages_total", "Handled messages by route",
+               lambda: {(k,): v for k, v in route_stats.items()}, ("route",), kind="counter")
+REGISTRY.gauge("ruby_openai_tokens_total", "OpenAI tokens (cached = served from the prompt cache)",
+               lambda: {(k[:-len("_tokens")],): v for k, v in usage_stats.items() if k.endswith("_tokens")},
+               ("kind",), kind="counter")
+REGISTRY.gauge("ruby_openai_scheduler", "OpenAI scheduler counters and queue state",
+               lambda: {(k,): v for k, v in scheduler.stats().items()}, ("field",))
+REGISTRY.gauge("ruby_reply_cache", "Reply cache counters",
+               lambda: {(k,): v for k, v in reply_cache.stats().items()}, ("field",))
+REGISTRY.gauge("ruby_rate_limiter", "Per-user rate limiter counters",
+               lambda: {(k,): v for k, v in rate_limiter.stats().items()}, ("field",))
+REGISTRY.gauge("ruby_input_pipeline", "Debounced input turns",
+               lambda: {(k,): v for k, v in input_pipeline.stats().items()}, ("field",))
+
 intents = discord.Intents.default()
 intents.message_content = True
 intents.dm_messages = True
@@ -82,9 +235,26 @@ client = discord.Client(intents=intents)
 async def start_web_server():
     async def health(request):
         return web.Response(text="ok")
+    async def stats(request):
+        return web.json_response({
+            "routes": route_stats,
+            "openai": scheduler.stats(),
+            "usage": usage_stats,
+            "cache": memory_store.cache_stats(),
+            "flush": memory_store.flush_stats(),
+            "coordination": memory_store.coordination_stats(),
+            "reply_cache": reply_cache.stats(),
+            "rate_limit": rate_limiter.stats(),
+            "input": input_pipeline.stats(),
+        })
+    async def metrics(request):
+        return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Prometheus-Format": "0.0.4"})
     app = web.Application()
     app.router.add_get("/", health)
     app.router.add_get("/healthz", health)
+    app.router.add_get("/stats", stats)
+    app.router.add_get("/metrics", metrics)
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, "0.0.0.0", PORT)
@@ -92,7 +262,7 @@ async def start_web_server():
     print(f"Web server listening on {PORT}")
 
 def today_str():
-    return date.today().isoformat()
+    return jst_now().date().isoformat()
 
 def jst_now():
     if ZoneInfo:
@@ -103,9 +273,7 @@ def is_chichi(uid: str) -> bool:
     return bool(OWNER_ID) and str(uid) == str(OWNER_ID)
 
 def is_homecoming(text: str) -> bool:
-    t = (text or "").strip()
-    keys = ["ただいま", "帰った", "帰宅", "いま帰った", "戻った"]
-    return any(k in t for k in keys)
+    return "homecoming" in analyze(text or "")
 
 def is_deep_night() -> bool:
     hour = jst_now().hour
@@ -130,8 +298,7 @@ def mood_with_night_bias(uid: str) -> str:
 
 # --- morning greet (1 day 1 time) ---
 def user_said_morning_greet(text: str) -> bool:
-    t = (text or "").strip()
-    return ("おはよう" in t) or (re.search(r"(おは(よ|ょ)?|おはー)", t) is not None)
+    return "morning" in analyze(text or "")
 
 def allow_morning_greet(uid: str, text: str) -> bool:
     if not user_said_morning_greet(text):
@@ -152,57 +319,247 @@ def strip_greetings_if_needed(reply: str, allow_greet: bool) -> str:
     r = re.sub(r"^(おは(よう)?|こんにちは|こんばんは|やあ|はろー|ハロー)[!！。…〜\s]+", "", r, count=1)
     return r.strip() if r.strip() else reply.strip()
 
-def build_messages(display_name, history, user_text, chichi, homecoming, emo_tag, daily_mood, allow_greet):
-    msgs = [{"role": "system", "content": RUBY_SYSTEM}]
-    if chichi:
-        msgs.append({"role": "system", "content": CHICHI_SYSTEM})
-        msgs.append({"role": "system", "content": "相手の呼び名は「ちち」。"})
-    else:
-        msgs.append({"role": "system", "content": f"相手の呼び名は「{display_name}」。"})
-
-    msgs.append({"role": "system", "content": EMOTION_GUIDE})
-    msgs.append({"role": "system", "content": MOOD_GUIDE})
-    msgs.append({"role": "system", "content": f"現在の感情タグ: {emo_tag}"})
-    msgs.append({"role": "system", "content": f"今日の気分タグ: {daily_mood}（少しだけ反映）"})
-
-    if is_deep_night():
-        msgs.append({
-            "role": "system",
-            "content": (
-                "現在は深夜（2時以降）。語尾をふにゃっとさせる。"
-                "文は短め。『……』『〜』を多め。眠そうでやさしい声色。"
-                "元気すぎる表現や強いテンションは避ける。"
-            )
-        })
+def persona_of(chichi: bool) -> str:
+    return "chichi" if chichi else "normal"
 
-    if allow_greet:
-        msgs.append({"role": "system", "content": "相手が朝の挨拶をした。『おはよう』は冒頭に1回だけ返してよい。繰り返し禁止。"})
-    else:
-        msgs.append({"role": "system", "content": "朝の挨拶のターンではない。『おはよう/こんにちは/こんばんは』など挨拶は言わない。"})
+def build_messages(display_name, history, user_text, chichi, homecoming, emo_tag, daily_mood, allow_greet,
+                   summary: str = ""):
+    # [固定プレフィックス] → [要約] → [履歴] → [いまの状況（1つ）] → [ユーザー発言]
+    # 履歴は呼び出し側でトークン予算に収めてある
+    msgs = list(STATIC_PREFIX[persona_of(chichi)])
 
-    if homecoming:
-        msgs.append({"role": "system", "content": "帰宅の挨拶なので「おかえり」は1回だけOK。"})
-    else:
-        msgs.append({"role": "system", "content": "帰宅挨拶は言わない。"})
+    if summary:
+        msgs.append({"role": "system", "content": f"これまでの会話の要約: {summary}"})
 
-    for role, content in history[-8:]:
+    for role, content in history:
         msgs.append({"role": role, "content": content})
 
+    yes_no = lambda b: "あり" if b else "なし"
+    name = "ちち" if chichi else display_name
+    msgs.append({"role": "system", "content": (
+        f"いまの状況: 呼び名={name} / 感情タグ={emo_tag} / 今日の気分タグ={daily_mood} / "
+        f"深夜={yes_no(is_deep_night())} / 朝の挨拶={yes_no(allow_greet)} / 帰宅={yes_no(homecoming)}"
+    )})
+
     msgs.append({"role": "user", "content": user_text})
     return msgs
 
-def call_openai(messages, chichi: bool):
-    resp = ai.responses.create(
+def finalize_reply(reply: str, allow_greet: bool) -> str:
+    reply = (reply or "").strip()
+    if not reply:
+        reply = "……もう一回、聞いてもいい……？"
+    return strip_greetings_if_needed(reply, allow_greet)[:1900]
+
+def record_usage(usage, persona: str):
+    if usage is None:
+        return
+    details = getattr(usage, "input_tokens_details", None)
+    cached = getattr(details, "cached_tokens", 0) or 0
+    usage_stats["requests"] += 1
+    usage_stats["input_tokens"] += usage.input_tokens
+    usage_stats["cached_tokens"] += cached
+    usage_stats["output_tokens"] += usage.output_tokens
+    print(f"OpenAI usage [{persona}]: input={usage.input_tokens} (cached={cached}) output={usage.output_tokens}")
+
+async def call_openai(messages, chichi: bool):
+    persona = persona_of(chichi)
+    resp = await aai.responses.create(
         model="gpt-4o-mini",
         input=messages,
         temperature=0.95 if chichi else 0.75,
         max_output_tokens=260 if chichi else 160,
+        prompt_cache_key=f"ruby-{persona}",
     )
+    record_usage(resp.usage, persona)
     return (resp.output_text or "").strip()
 
+def local_reply(text: str, chichi: bool, display_name: str, allow_greet: bool) -> str:
+    """ローカルのるび(文字n-gram)で返事を作る"""
+    reply = ruby.gen(text)
+    if not chichi:
+        # ruby_core の定型文は「ちち」向けに書かれているので呼び名を差し替える
+        reply = reply.replace("ちち", display_name)
+    return finalize_reply(reply, allow_greet)
+
+async def stream_reply(channel, messages, chichi: bool, allow_greet: bool, deadline: float | None = None,
+                       on_first_send=None) -> str:
+    """
+    返信をストリーミングで受け取りながらDiscordに出す
+    STREAM_FIRST_CHARS 文字たまったら送信し、以降は STREAM_EDIT_INTERVAL_SEC ごとに編集する
+    最後に finalize_reply を通した全文で仕上げて、その文字列を返す
+    deadline（loop.time() の時刻）までに最初の送信まで行かなければ TimeoutError（まだ何も出していないのでフォールバックできる）
+    scheduler が再試行しても持ち時間が延びないよう、deadline は submit の前に1回だけ決めて渡す
+    on_first_send(): 最初の送信の直前に呼ぶ
+    """
+    loop = asyncio.get_running_loop()
+
+    def remaining():
+        return None if deadline is None else max(0.0, deadline - loop.time())
+
+    persona = persona_of(chichi)
+    stream = await asyncio.wait_for(aai.responses.create(
+        model="gpt-4o-mini",
+        input=messages,
+        temperature=0.95 if chichi else 0.75,
+        max_output_tokens=260 if chichi else 160,
+        prompt_cache_key=f"ruby-{persona}",
+        stream=True,
+    ), remaining())
+    events = stream.__aiter__()
+    text = ""
+    sent = None
+    shown = ""
+    last_edit = 0.0
+    try:
+        while True:
+            try:
+                event = await asyncio.wait_for(events.__anext__(), remaining() if sent is None else None)
+            except StopAsyncIteration:
+                break
+            if event.type == "response.completed":
+                record_usage(event.response.usage, persona)
+            if event.type != "response.output_text.delta":
+                continue
+            text += event.delta
+            # 冒頭の挨拶を消すかどうかが決まるくらいの長さになるまでは出さない
+            if len(text.strip()) < STREAM_FIRST_CHARS:
+                continue
+            preview = strip_greetings_if_needed(text.strip(), allow_greet)[:1900]
+            if not preview or preview == shown:
+                continue
+            if sent is None:
+                if on_first_send is not None:
+                    on_first_send()
+                sent = await channel.send(preview)
+            elif loop.time() - last_edit >= STREAM_EDIT_INTERVAL_SEC:
+                await sent.edit(content=preview)
+            else:
+                continue
+            shown = preview
+            last_edit = loop.time()
+    except Exception as e:
+        if sent is None:
+            raise
+        # 途中まで出ているなら、そこまでの文で締める
+        print("OpenAI stream ERROR:", e)
+
+    reply = finalize_reply(text, allow_greet)
+    if sent is None:
+        if on_first_send is not None:
+            on_first_send()
+        await channel.send(reply)
+    elif reply != shown:
+        await sent.edit(content=reply)
+    return reply
+
+SUMMARY_SYSTEM = """
+あなたは会話ログの要約係。
+「これまでの要約」と「新しい発言」をまとめて、ひとつの要約に書き直す。
+・日本語、{max_chars}字以内。箇条書きではなく短い文で。
+・相手の好み、出来事、予定、約束、気持ちの変化など、あとの会話で役立つ事実を優先する。
+・挨拶や相づちは省く。推測で事実を足さない。
+"""
+
+_summarizing = set()   # 要約を更新中のチャンネル
+_background = set()    # 返信の後ろで走らせているタスク（参照を持っておかないと途中で回収される）
+
+def _background_done(task: asyncio.Task):
+    _background.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print("background task ERROR:", repr(task.exception()))
+
+def spawn_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background.add(task)
+    task.add_done_callback(_background_done)
+    return task
+
+def build_summary_messages(prev: str, backlog: list, uid: str, display_name: str):
+    lines = []
+    for _, aid, content in backlog:
+        who = "るび" if aid == "BOT" else (display_name if str(aid) == str(uid) else "相手")
+        lines.append(f"{who}: {content}")
+    return [
+        {"role": "system", "content": SUMMARY_SYSTEM.format(max_chars=SUMMARY_MAX_CHARS).strip()},
+        {"role": "user", "content": f"これまでの要約:\n{prev or '（なし）'}\n\n新しい発言:\n" + "\n".join(lines)},
+    ]
+
+async def call_summary(messages):
+    resp = await aai.responses.create(
+        model="gpt-4o-mini",
+        input=messages,
+        temperature=0.3,
+        max_output_tokens=400,
+        prompt_cache_key="ruby-summary",
+    )
+    record_usage(resp.usage, "summary")
+    return (resp.output_text or "").strip()
+
+async def refresh_summary(ch_id: str, uid: str, display_name: str):
+    """
+    履歴の予算からあふれた発言が SUMMARY_BATCH 件以上たまっていたら要約に畳み込む
+    返信の後ろで spawn_background して呼ぶ（返信は待たせない）
+    """
+    if SUMMARY_BATCH <= 0 or ch_id in _summarizing:
+        return
+    _summarizing.add(ch_id)
+    try:
+        await memory_store.aget_channel(ch_id)
+        window = memory_store.get_message_window(ch_id)
+        # 次のターンの compose と同じ切り方で、履歴に入りきらなくなった範囲を決める（次は帰宅のターンではない前提）
+        _, first_kept = fit_history(history_entries(window, uid), HISTORY_TOKEN_BUDGET, HISTORY_ALIGN)
+        summary = memory_store.get_channel_summary(ch_id)
+        backlog = summary_backlog(window, summary["upto"], first_kept)
+        if len(backlog) < SUMMARY_BATCH:
+            return
+        text = await scheduler.submit(
+            f"summary:{ch_id}",
+            lambda: build_summary_messages(summary["text"], backlog, uid, display_name),
+            call_summary,
+        )
+        if text:
+            async with memory_store.claimed(chid=ch_id):
+                await memory_store.aget_channel(ch_id)
+                memory_store.set_channel_summary(ch_id, text[:SUMMARY_MAX_CHARS], backlog[-1][0])
+    except Exception as e:
+        print("summary ERROR:", repr(e))
+    finally:
+        _summarizing.discard(ch_id)
+
+async def checkpoint_rate_limits():
+    """メモリで数えた回数をユーザー状態の daily_counts に足す（相手ごとに1回の書き換えで済む）"""
+    for uid, days in rate_limiter.take_pending().items():
+        try:
+            async with memory_store.claimed(uid=uid):
+                await memory_store.aget_user(uid)
+                for ymd, n in days.items():
+                    memory_store.increment_daily_count(uid, ymd, n)
+        except Exception as e:
+            print("rate-limit checkpoint ERROR:", uid, repr(e))
+            rate_limiter.requeue(uid, days)
+
+async def rate_limit_checkpointer():
+    while True:
+        await asyncio.sleep(RATE_CHECKPOINT_SEC)
+        await checkpoint_rate_limits()
+
+_warmed = False
+_rate_checkpointer = None
+
 @client.event
 async def on_ready():
-    await asyncio.to_thread(memory_store.init_db)
+    global _warmed, _rate_checkpointer
+    memory_store.init_db()
+    memory_store.start_flush_task()
+    if _rate_checkpointer is None:
+        _rate_checkpointer = asyncio.create_task(rate_limit_checkpointer())
+    if memory_store.WARM_START_FILES > 0 and not _warmed:
+        # 再接続で何度も呼ばれるので先読みは1回だけ
+        _warmed = True
+        try:
+            await memory_store.warm_start()
+        except Exception as e:
+            print("warm-start ERROR:", e)
     print(f"Ruby ready! Logged in as {client.user}")
 
 @client.event
@@ -219,8 +576,8 @@ async def on_message(message: discord.Message):
     uid = str(message.author.id)
     ch_id = str(message.channel.id)
 
-    chichi = is_chichi(uid)
-    homecoming = is_homecoming(text)
+    if not await route_dm(message):
+        return
 
     if text == "!whoami":
         await message.channel.send(f"あなたのIDは `{uid}` だよ✨")
@@ -228,57 +585,192 @@ async def on_message(message: discord.Message):
 
     if text.startswith("!name "):
         name = text[6:].strip()[:20]
-        memory_store.set_nickname(uid, name)
+        try:
+            async with memory_store.claimed(uid=uid):
+                await memory_store.aget_user(uid)
+                memory_store.set_nickname(uid, name)
+        except memory_store.ClaimTimeout as e:
+            print("coordination:", e)
+            await message.channel.send("……ごめんね、いまちょっと覚えられなかった……もう一回言ってくれる……？")
+            return
         await message.channel.send(f"了解……✨ これから {name} って呼ぶね……えへへ😊")
-        await asyncio.to_thread(memory_store.maybe_flush)
         return
 
-    if not chichi:
-        today = today_str()
-        if memory_store.get_daily_count(uid, today) >= DAILY_LIMIT:
-            await message.channel.send("今日はたくさんお話ししたね……😊 また明日ね……🌙")
-            return
-        memory_store.increment_daily_count(uid, today)
-
-    allow_greet = allow_morning_greet(uid, text)
-
-    v, a, t, emo_tag = memory_store.update_emotion_by_text(uid, text, chichi)
-    daily_mood = mood_with_night_bias(uid)
-
-    display_name = memory_store.get_nickname(uid) or "あなた"
-
-    memory_store.add_channel_message(ch_id, uid, text)
-    recent = memory_store.get_recent_messages(ch_id, limit=20)
-
-    history = []
-    for aid, content in recent:
-        role = "user" if str(aid) == str(uid) else "assistant"
-        history.append((role, content))
-
-    if not homecoming:
-        history = [(r, c) for r, c in history if ("ただいま" not in c and "おかえり" not in c)]
-
-    messages = build_messages(display_name, history, text, chichi, homecoming, emo_tag, daily_mood, allow_greet)
+    if INPUT_DEBOUNCE_SEC > 0:
+        # 連投は入力段でためて、静かになってから handle_turn でまとめて返す
+        input_pipeline.submit(ch_id, (message, text))
+        return
+    await handle_turn(ch_id, Turn(ch_id, [(message, text)]))
 
+async def route_dm(message) -> bool:
+    """このDMにこのプロセスが返事をするか（複数プロセスのうち1つだけが True になる）"""
+    if WORKER_COUNT > 1 and shard_of(message.author.id, WORKER_COUNT) != WORKER_INDEX:
+        await asyncio.sleep(ROUTE_GRACE_SEC)
     try:
-        reply = await asyncio.to_thread(call_openai, messages, chichi)
+        return await memory_store.claim_once(f"dm:{message.id}")
     except Exception as e:
-        print("OpenAI ERROR:", e)
-        await message.channel.send("……ごめん……今ちょっとつまずいた……💦")
-        return
-
-    if not reply:
-        reply = "……もう一回、聞いてもいい……？"
-
-    reply = strip_greetings_if_needed(reply, allow_greet)
-    await message.channel.send(reply[:1900])
-
-    if allow_greet:
-        mark_morning_greet_done(uid)
+        # 調整役が使えないときは受け持ちだけが返事をする
+        print("coordination ERROR:", repr(e))
+        return WORKER_COUNT <= 1 or shard_of(message.author.id, WORKER_COUNT) == WORKER_INDEX
+
+async def load_daily_counts(uid: str, days: list) -> list:
+    # rate_limiter が初めて見る相手の回数（キャッシュミスならループを止めずに読み込む）
+    await memory_store.aget_user(uid)
+    return [memory_store.get_daily_count(uid, d) for d in days]
+
+async def handle_turn(ch_id: str, turn: Turn):
+    """1ターン（連投をまとめたもの）に返事をする。turn.items は [(message, text), ...]"""
+    message = turn.items[-1][0]
+    uid = str(message.author.id)
+    chichi = is_chichi(uid)
+    homecoming = any(is_homecoming(text) for _, text in turn.items)
 
-    memory_store.add_channel_message(ch_id, "BOT", reply[:1900])
+    trace = MessageTrace(STAGE_LATENCY, SLOW_MESSAGE_LOG_SEC)
+    route = None
+    try:
+        route = await respond(message, turn, uid, ch_id, chichi, homecoming, trace)
+    except asyncio.CancelledError:
+        # 返事を作っている途中に次の発言が来た（入力段がまとめて作り直す）
+        route = "restarted"
+        raise
+    finally:
+        trace.finish(uid=uid, route=route or "error", messages=len(turn.items))
+
+async def respond(message, turn: Turn, uid: str, ch_id: str, chichi: bool, homecoming: bool, trace: MessageTrace):
+    """返事をして、通った経路（route_stats のキー）を返す"""
+    # 連投はまとめて1つの発言として返事をする（履歴には1件ずつ入れる）
+    texts = [t for _, t in turn.items]
+    text = "\n".join(texts)
 
-    await asyncio.to_thread(memory_store.maybe_flush)
+    try:
+        # 記憶を読んで書き換える間だけ押さえる（OpenAIを待つ間は別のプロセスが使える）
+        async with memory_store.claimed(uid=uid, chid=ch_id):
+            # キャッシュミス時のGitHub読み込みはここで非同期に済ませる（以降の同期APIはキャッシュのみ）
+            with trace.span("memory_load"):
+                await asyncio.gather(memory_store.aget_user(uid), memory_store.aget_channel(ch_id))
+
+            # 上限を超えたらAPIは呼ばず、ローカルのるびが相手をする（数えるのはメモリ上だけ）
+            # 数えるのは1ターンに1回。作り直しのときは最初に数えた結果を使う
+            if "over_limit" not in turn.state:
+                turn.state["over_limit"] = not chichi and await rate_limiter.ahit(uid) is not None
+
+            allow_greet = allow_morning_greet(uid, text)
+
+            # 作り直しのときは、前の試みで取り込み済みの発言をもう一度入れない（新しく来た分は必ずある）
+            fresh = [t for _, t in turn.take_fresh()]
+            for t in fresh:
+                memory_store.add_channel_message(ch_id, uid, t)
+
+            with trace.span("emotion"):
+                v, a, t, emo_tag = memory_store.update_emotion_by_text(uid, "\n".join(fresh), chichi)
+                daily_mood = mood_with_night_bias(uid)
+
+            display_name = memory_store.get_nickname(uid) or "あなた"
+    except memory_store.ClaimTimeout as e:
+        # 別のプロセスがずっと持っている: 記憶には触らず、ローカルのるびが返事だけする
+        print("coordination:", e)
+        reply = local_reply(text, chichi, "あなた", False)
+        turn.commit()
+        with trace.span("send"):
+            await message.channel.send(reply)
+        route_stats["local_busy"] += 1
+        return "local_busy"
+    over_limit = turn.state["over_limit"]
+
+    # 返事のキャッシュは build_messages に効く状況ごとに分ける
+    cache_ctx = (persona_of(chichi), "ちち" if chichi else display_name, emo_tag, daily_mood,
+                 allow_greet, homecoming, is_deep_night())
+    # 連投をまとめて返した返事と、履歴・要約を見て作った返事はキャッシュしない
+    composed = {"cacheable": False}
+
+    async def compose():
+        # 送る直前に履歴から組み立てる（まとめ待ちの間に届いた連投も入る）
+        await memory_store.aget_channel(ch_id)
+        window = memory_store.get_message_window(ch_id)
+        n = len(texts)
+        single = n == 1 and (len(window) < 2 or str(window[-2][1]) != str(uid))
+        with trace.span("prompt_build"):
+            # 最後の n 件は今のターンの発言（build_messages がまとめて user として足す）
+            entries = history_entries(window, uid, n, homecoming)
+            kept, _ = fit_history(entries, HISTORY_TOKEN_BUDGET, HISTORY_ALIGN)
+            history = [(role, content) for _, role, content in kept]
+            summary = memory_store.get_channel_summary(ch_id)["text"]
+            composed["cacheable"] = single and not history and not summary
+
+            return build_messages(display_name, history, text, chichi, homecoming, emo_tag, daily_mood, allow_greet,
+                                  summary=summary)
+
+    route = "openai"
+    if over_limit:
+        route = "local_limit"
+    elif LOCAL_TRIVIAL_REPLIES and ruby.local_intent(text):
+        route = "local_trivial"
+    elif REPLY_CACHE and len(texts) == 1:
+        reply = reply_cache.lookup(uid, text, cache_ctx)
+        if reply is not None:
+            route = "cache"
+            turn.commit()
+            with trace.span("send"):
+                await message.channel.send(reply)
+
+    if route == "openai":
+        started = asyncio.get_running_loop().time()
+        # 持ち時間は再試行も含めて1回分（ここで決めた時刻を scheduler と stream_reply で共有する）
+        deadline = started + OPENAI_LATENCY_BUDGET_SEC
+        try:
+            with trace.span("openai"):
+                if STREAM_REPLIES:
+                    # ストリーミングは送信まで済ませて返ってくる（持ち時間は最初の送信まで）
+                    reply = await scheduler.submit(uid, compose, lambda msgs: stream_reply(
+                        message.channel, msgs, chichi, allow_greet, deadline, turn.commit), deadline=deadline)
+                else:
+                    reply = await asyncio.wait_for(
+                        scheduler.submit(uid, compose, lambda msgs: call_openai(msgs, chichi), deadline=deadline),
+                        OPENAI_LATENCY_BUDGET_SEC,
+                    )
+        except Exception as e:
+            print("OpenAI ERROR:", repr(e))
+            route = "local_fallback"
+        else:
+            if reply is None:
+                # 同じ相手の新しいメッセージにまとめられた（返事はそっちでする）
+                route_stats["coalesced"] += 1
+                return "coalesced"
+            if not STREAM_REPLIES:
+                reply = finalize_reply(reply, allow_greet)
+                turn.commit()
+                with trace.span("send"):
+                    await message.channel.send(reply)
+            if REPLY_CACHE and composed["cacheable"]:
+                reply_cache.store(uid, text, cache_ctx, reply, asyncio.get_running_loop().time() - started)
+
+    if route not in ("openai", "cache"):
+        reply = local_reply(text, chichi, display_name, allow_greet)
+        turn.commit()
+        with trace.span("send"):
+            await message.channel.send(reply)
+    route_stats[route] += 1
+    if route != "cache":
+        # キャッシュから返すときに、直前と同じ返事を選ばないように
+        reply_cache.remember(uid, reply)
+
+    with trace.span("store"):
+        try:
+            async with memory_store.claimed(uid=uid, chid=ch_id):
+                # 返信を待っている間にキャッシュから追い出された / 別のプロセスが書いたことがあるので載せ直す
+                await asyncio.gather(memory_store.aget_user(uid), memory_store.aget_channel(ch_id))
+
+                if allow_greet:
+                    mark_morning_greet_done(uid)
+
+                memory_store.add_channel_message(ch_id, "BOT", reply)
+        except memory_store.ClaimTimeout as e:
+            # 返事はもう送ってあるので、履歴に残せなかったことだけ記録する
+            print("coordination: 返事を履歴に残せませんでした:", e)
+
+    if route == "openai":
+        spawn_background(refresh_summary(ch_id, uid, display_name))
+    return route
 
 async def main():
     if not DISCORD_TOKEN:
@@ -287,9 +779,34 @@ async def main():
         raise RuntimeError("OPENAI_API_KEY が未設定")
     if not OWNER_ID:
         raise RuntimeError("OWNER_ID が未設定（ちちのDiscordユーザーID）")
+    if WORKER_COUNT > 1 and memory_store.COORDINATOR == "local":
+        raise RuntimeError("WORKER_COUNT > 1 には COORDINATOR=sqlite などの共有の調整役が必要")
+
+    # SIGTERM（ホスティング側の停止）/ SIGINT で、待っている返事を送ってから client を閉じ、下の finally で最後の flush まで済ませる
+    async def shutdown():
+        try:
+            await asyncio.wait_for(input_pipeline.drain(), INPUT_DRAIN_TIMEOUT_SEC)
+        except asyncio.TimeoutError:
+            print("input drain timed out:", input_pipeline.stats())
+        await client.close()
+
+    def on_signal(sig):
+        print(f"{sig.name} received, shutting down")
+        asyncio.ensure_future(shutdown())
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, on_signal, sig)
+        except (NotImplementedError, RuntimeError):
+            pass   # Windows など
 
     await start_web_server()
-    await client.start(DISCORD_TOKEN)
+    try:
+        await client.start(DISCORD_TOKEN)
+    finally:
+        await checkpoint_rate_limits()
+        await memory_store.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
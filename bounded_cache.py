@@ -0,0 +1,176 @@
+import time
+from collections import OrderedDict
+
+
+class BoundedCache:
+    """
+    LRU + アイドルTTL で上限を守る dict 風キャッシュ
+    - max_entries: 件数の上限（0なら無制限）
+    - max_bytes: sizeof() で見積もったサイズ合計の上限（0なら無制限）
+    - ttl: 最後に触ってから ttl 秒たったものは sweep() で落とす（0なら無効）
+    - on_evict(key, value): 追い出す直前に呼ばれる（dirtyの退避などに使う）
+    hits / misses は get() で数える。`in` では数えない
+    resize(key) は印をつけるだけで、sizeof() は次に上限を確かめるとき（追加・sweep・stats）にまとめて呼ぶ
+    """
+
+    def __init__(self, max_entries: int = 0, max_bytes: int = 0, ttl: float = 0.0,
+                 sizeof=None, on_evict=None, clock=time.monotonic):
+        self.max_entries = int(max_entries)
+        self.max_bytes = int(max_bytes)
+        self.ttl = float(ttl)
+        self.sizeof = sizeof or (lambda v: 0)
+        self.on_evict = on_evict
+        self.clock = clock
+
+        self._data = OrderedDict()   # key -> [value, size, last_access]（先頭が一番古い）
+        self._stale = set()          # 書き換えられてサイズを測り直していない key
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(list(self._data))
+
+    def keys(self):
+        return list(self._data)
+
+    def values(self):
+        return [e[0] for e in self._data.values()]
+
+    def items(self):
+        return [(k, e[0]) for k, e in self._data.items()]
+
+    def _touch(self, key):
+        e = self._data[key]
+        e[2] = self.clock()
+        self._data.move_to_end(key)
+        return e[0]
+
+    def __getitem__(self, key):
+        return self._touch(key)
+
+    def get(self, key, default=None):
+        if key in self._data:
+            self.hits += 1
+            return self._touch(key)
+        self.misses += 1
+        return default
+
+    def peek(self, key, default=None):
+        """LRU順もヒット数も変えずに覗く"""
+        e = self._data.get(key)
+        return default if e is None else e[0]
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(value)
+        old = self._data.pop(key, None)
+        if old is not None:
+            self.bytes -= old[1]
+        self._stale.discard(key)
+        self._data[key] = [value, size, self.clock()]
+        self.bytes += size
+        self._enforce(keep=key)
+
+    def setdefault(self, key, value):
+        if key in self._data:
+            return self._touch(key)
+        self[key] = value
+        return value
+
+    def pop(self, key, default=None):
+        e = self._data.pop(key, None)
+        if e is None:
+            return default
+        self._stale.discard(key)
+        self.bytes -= e[1]
+        return e[0]
+
+    def clear(self):
+        self._data.clear()
+        self._stale.clear()
+        self.bytes = 0
+
+    def resize(self, key, delta: int | None = None):
+        """
+        値を書き換えたあとにサイズ見積もりを更新する
+        delta（増えたバイト数）が分かっていればそれを足す。分からなければ次に上限を確かめるときに測り直す
+        """
+        e = self._data.get(key)
+        if e is None:
+            return
+        if delta is None or key in self._stale:
+            self._stale.add(key)
+            return
+        e[1] += delta
+        self.bytes += delta
+        self._enforce(keep=key)
+
+    def _settle(self):
+        # 印のついたものだけ sizeof() し直す（何度書き換えても1回で済む）
+        for key in self._stale:
+            e = self._data.get(key)
+            if e is None:
+                continue
+            size = self.sizeof(e[0])
+            self.bytes += size - e[1]
+            e[1] = size
+        self._stale.clear()
+
+    def _evict(self, key):
+        value, size, _ = self._data.pop(key)
+        self._stale.discard(key)
+        self.bytes -= size
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def _over(self) -> bool:
+        if self.max_entries and len(self._data) > self.max_entries:
+            return True
+        return bool(self.max_bytes) and self.bytes > self.max_bytes
+
+    def _enforce(self, keep=None):
+        self._settle()
+        while self._over() and len(self._data) > 1:
+            key = next(iter(self._data))
+            if key == keep:
+                # 今入れた/触ったものは残す
+                self._data.move_to_end(key)
+                key = next(iter(self._data))
+                if key == keep:
+                    break
+            self._evict(key)
+
+    def sweep(self) -> int:
+        """アイドルTTLを過ぎたものを落とす。落とした件数を返す"""
+        self._settle()
+        if not self.ttl:
+            return 0
+        limit = self.clock() - self.ttl
+        n = 0
+        while self._data:
+            key, e = next(iter(self._data.items()))
+            if e[2] > limit:
+                break
+            self._evict(key)
+            n += 1
+        return n
+
+    def stats(self) -> dict:
+        self._settle()
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits / total) if total else 0.0,
+        }
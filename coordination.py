@@ -0,0 +1,218 @@
+"""
+複数プロセスで同じ記憶（ruby_mem）を扱うときの調整役
+
+- リース: ユーザー/チャンネルの path を書き換える前に claim() する。他のプロセスが持っている間は取れない
+  持ち主は保存し終わって手が空いたら release() する。落ちたプロセスのリースは ttl で切れる
+- 無効化: 保存したら publish() で「この path は新しくなった」と残す。他のプロセスは poll() で
+  受け取ってキャッシュを捨て、次に使うときに読み直す
+- wanted: 取れなかった側は want() で印をつけておく。持ち主は wanted() を見て早めに保存・解放する
+  解放されたリースはしばらく（want_hold 秒）待っていた側のために取っておく（持ち主がすぐ取り直して横取りしないように）
+- 1回だけの処理: DM はどのプロセスにも届くので、memory_store.claim_once() が "once:{message id}" を
+  claim して、取れた1プロセスだけが返事をする（印は ttl で切れるまで残し、切れたら publish() が掃除する）
+  どのプロセスが先に取りにいくかは shard_of() で相手ごとに決める（他のプロセスは少し待ってから取りにいく）
+
+実装は2つ:
+    LocalCoordinator  : 1プロセスだけで動かすとき（何もしない）
+    SQLiteCoordinator : 同じマシンの複数プロセス用（テストやローカルでの分割起動向け）
+別のマシンにまたがるなら、同じメソッドを持つクラス（Redis など）を用意して memory_store._make_coordinator() に足す
+"""
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+
+def default_node_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def shard_of(snowflake, shard_count: int) -> int:
+    """Discord と同じ (id >> 22) % shard_count。相手（ユーザーID）を先に受け持つプロセスを決めるのに使う"""
+    if shard_count <= 1:
+        return 0
+    return (int(snowflake) >> 22) % shard_count
+
+
+class LocalCoordinator:
+    name = "local"
+
+    def __init__(self, node_id: str | None = None):
+        self.node_id = node_id or default_node_id()
+
+    def claim(self, path: str, ttl: float) -> bool:
+        return True
+
+    def renew(self, paths, ttl: float):
+        pass
+
+    def release(self, paths):
+        pass
+
+    def want(self, path: str):
+        pass
+
+    def wanted(self, paths) -> list:
+        return []
+
+    def publish(self, paths):
+        pass
+
+    def poll(self) -> list:
+        return []
+
+    def close(self):
+        pass
+
+
+COORD_SCHEMA = """
+CREATE TABLE IF NOT EXISTS leases (
+    path TEXT PRIMARY KEY,
+    node TEXT NOT NULL,          -- 解放したら ''
+    expires REAL NOT NULL,
+    wanted_by TEXT,
+    wanted_at REAL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS invalidations (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL,
+    node TEXT NOT NULL,
+    t REAL NOT NULL
+);
+"""
+
+
+class SQLiteCoordinator:
+    """
+    リースと無効化の記録を1つの SQLite ファイル（WAL）で共有する
+    claim は BEGIN IMMEDIATE の中で読んで書くので、2プロセスが同時に取ることはない
+    """
+    name = "sqlite"
+
+    def __init__(self, db_path: str, node_id: str | None = None, keep_invalidations_sec: float = 3600.0,
+                 want_hold: float = 2.0, clock=time.time):
+        self.db_path = db_path
+        self.node_id = node_id or default_node_id()
+        self.keep_invalidations_sec = float(keep_invalidations_sec)
+        self.want_hold = float(want_hold)
+        self.clock = clock
+        self._lock = threading.Lock()
+        d = os.path.dirname(db_path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(COORD_SCHEMA)
+        # 起動前の無効化は関係ない（キャッシュは空から始まる）ので、今の末尾から読む
+        row = self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM invalidations").fetchone()
+        self._last_seq = row[0]
+
+    def _tx(self, fn):
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(conn)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return result
+
+    # ---------- リース ----------
+    def claim(self, path: str, ttl: float) -> bool:
+        now = self.clock()
+
+        def run(conn):
+            row = conn.execute("SELECT node, expires, wanted_by, wanted_at FROM leases WHERE path = ?",
+                               (path,)).fetchone()
+            if row is not None:
+                node, expires, wanted_by, wanted_at = row
+                if node == self.node_id and expires > now:
+                    # 自分が持っている。待っている人がいればその印は残す
+                    conn.execute("UPDATE leases SET expires = ? WHERE path = ?", (now + ttl, path))
+                    return True
+                if node and expires > now:
+                    return False
+                if wanted_by and wanted_by != self.node_id and (wanted_at or 0) > now - self.want_hold:
+                    return False   # 待っていた側のために取っておく
+            conn.execute(
+                "INSERT OR REPLACE INTO leases (path, node, expires, wanted_by, wanted_at) VALUES (?, ?, ?, NULL, NULL)",
+                (path, self.node_id, now + ttl),
+            )
+            return True
+
+        return self._tx(run)
+
+    def renew(self, paths, ttl: float):
+        paths = list(paths)
+        if not paths:
+            return
+        expires = self.clock() + ttl
+        self._tx(lambda conn: conn.executemany(
+            "UPDATE leases SET expires = ? WHERE path = ? AND node = ?",
+            [(expires, p, self.node_id) for p in paths],
+        ))
+
+    def release(self, paths):
+        paths = list(paths)
+        if not paths:
+            return
+        self._tx(lambda conn: conn.executemany(
+            "UPDATE leases SET node = '', expires = 0 WHERE path = ? AND node = ?", [(p, self.node_id) for p in paths],
+        ))
+
+    def want(self, path: str):
+        self._tx(lambda conn: conn.execute(
+            "UPDATE leases SET wanted_by = ?, wanted_at = ? WHERE path = ? AND node != ?",
+            (self.node_id, self.clock(), path, self.node_id),
+        ))
+
+    def wanted(self, paths) -> list:
+        """自分が持っている paths のうち、他のプロセスが待っているもの"""
+        paths = set(paths)
+        if not paths:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path FROM leases WHERE node = ? AND wanted_by IS NOT NULL", (self.node_id,),
+            ).fetchall()
+        return [p for (p,) in rows if p in paths]
+
+    # ---------- 無効化 ----------
+    def publish(self, paths):
+        paths = list(paths)
+        if not paths:
+            return
+        now = self.clock()
+
+        def run(conn):
+            conn.executemany("INSERT INTO invalidations (path, node, t) VALUES (?, ?, ?)",
+                             [(p, self.node_id, now) for p in paths])
+            conn.execute("DELETE FROM invalidations WHERE t < ?", (now - self.keep_invalidations_sec,))
+            conn.execute("DELETE FROM leases WHERE node = '' AND (wanted_at IS NULL OR wanted_at < ?)",
+                         (now - self.want_hold,))
+            conn.execute("DELETE FROM leases WHERE path LIKE 'once:%' AND expires < ?", (now,))
+
+        self._tx(run)
+
+    def poll(self) -> list:
+        """前回から他のプロセスが保存した path（重複なし）"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT seq, path, node FROM invalidations WHERE seq > ? ORDER BY seq", (self._last_seq,),
+            ).fetchall()
+            if rows:
+                self._last_seq = rows[-1][0]
+        return list(dict.fromkeys(p for _, p, node in rows if node != self.node_id))
+
+    def close(self):
+        with self._lock:
+            try:
+                # claim_once の印は返さない（返すと別のプロセスが同じDMにもう一度返事をしてしまう）
+                self._conn.execute("UPDATE leases SET node = '', expires = 0 WHERE node = ? AND path NOT LIKE 'once:%'",
+                                   (self.node_id,))
+            finally:
+                self._conn.close()
@@ -0,0 +1,167 @@
+"""
+感情状態(v, a, t)の更新エンジン
+
+- 語と重みは emotion_lexicon.json（EMOTION_LEXICON_PATH）から読む。ファイルを書き換えれば
+  次の更新時に読み直すので、辞書の調整に再デプロイはいらない
+- 減衰は「1メッセージごとに何割」ではなく、前回更新(ts)からの経過時間で半減期どおりに効かせる
+- 語の判定は keywords の共有マッチャーに相乗りするので、1メッセージの走査は1回のまま
+
+辞書ファイルの形:
+    {
+      "half_life_sec": {"v": 500, "a": 400, "t": 700},
+      "clamp": [-1.0, 1.0],
+      "owner_bonus": {"v": 0.03, "t": 0.06},
+      "categories": {
+        "pos": {"deltas": {"v": 0.25, "a": 0.10}, "words": {"好き": 1.0, ...}},
+        ...
+      }
+    }
+カテゴリに当たった語のうち一番重いものの重み × deltas を足す（同じカテゴリの語がいくつ出ても1回分）
+"""
+import json
+import os
+import time
+
+import keywords
+
+DIMS = ("v", "a", "t")
+CATEGORY_PREFIX = "emo_"
+
+
+class EmotionEngine:
+
+    def __init__(self, path: str, reload_check_sec: float = 5.0):
+        self.path = path
+        self.reload_check_sec = float(reload_check_sec)
+        self.half_life = {d: 0.0 for d in DIMS}
+        self.clamp = (-1.0, 1.0)
+        self.owner_bonus = {}
+        self.deltas = {}          # keywordsのカテゴリ名 -> (dv, da, dt)
+        self.weights = {}         # keywordsのカテゴリ名 -> {語: 重み}
+        self._mtime = None
+        self._checked = 0.0
+        self.reload()
+
+    # ---------- 辞書 ----------
+    def reload(self) -> bool:
+        """辞書ファイルを読み直す。読めなかったら前の辞書のまま False"""
+        try:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, encoding="utf-8") as f:
+                lex = json.load(f)
+            half_life = {d: float(lex.get("half_life_sec", {}).get(d, 0.0)) for d in DIMS}
+            lo, hi = lex.get("clamp", [-1.0, 1.0])
+            owner_bonus = {d: float(x) for d, x in lex.get("owner_bonus", {}).items() if d in DIMS}
+            deltas, weights = {}, {}
+            for name, cat in lex.get("categories", {}).items():
+                key = CATEGORY_PREFIX + name
+                deltas[key] = tuple(float(cat.get("deltas", {}).get(d, 0.0)) for d in DIMS)
+                weights[key] = {w: float(x) for w, x in cat.get("words", {}).items() if w}
+        except Exception as e:
+            print("Emotion lexicon load ERROR:", self.path, e)
+            return False
+
+        keywords.set_categories({k: list(ws) for k, ws in weights.items()}, CATEGORY_PREFIX)
+        self.half_life, self.clamp, self.owner_bonus = half_life, (float(lo), float(hi)), owner_bonus
+        self.deltas, self.weights = deltas, weights
+        self._mtime = mtime
+        return True
+
+    def maybe_reload(self):
+        now = time.monotonic()
+        if now - self._checked < self.reload_check_sec:
+            return
+        self._checked = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self._mtime = mtime   # 壊れたファイルでも、直るまで毎回エラーを出し続けないように
+            self.reload()
+
+    # ---------- スコア ----------
+    def score(self, text: str):
+        """text が足す (dv, da, dt)。keywords.analyze の結果（キャッシュ共有）から出す"""
+        best = {}
+        for m in keywords.analyze(text or "").matches:
+            w = self.weights.get(m.category, {}).get(m.word)
+            if w is not None and w > best.get(m.category, 0.0):
+                best[m.category] = w
+        dv = da = dt = 0.0
+        for cat, w in best.items():
+            cv, ca, ct = self.deltas[cat]
+            dv += w * cv
+            da += w * ca
+            dt += w * ct
+        return dv, da, dt
+
+    def score_batch(self, texts) -> list:
+        """
+        履歴の再計算用: 各テキストの (dv, da, dt) をまとめて出す
+        テキストごとに「カテゴリの重み」の行を作り、カテゴリ × 次元の deltas 行列を一度に掛ける
+        """
+        cats = list(self.deltas)
+        col = {c: i for i, c in enumerate(cats)}
+        rows = []
+        for text in texts:
+            row = [0.0] * len(cats)
+            for m in keywords.analyze(text or "").matches:
+                i = col.get(m.category)
+                if i is None:
+                    continue
+                w = self.weights[m.category].get(m.word, 0.0)
+                if w > row[i]:
+                    row[i] = w
+            rows.append(row)
+        matrix = [self.deltas[c] for c in cats]
+        return [
+            tuple(sum((r[i] * matrix[i][d] for i in range(len(cats)) if r[i]), 0.0) for d in range(len(DIMS)))
+            for r in rows
+        ]
+
+    # ---------- 状態の更新 ----------
+    def decay(self, emo: dict, now: float) -> dict:
+        """前回の ts から now までの経過時間ぶん 0 に近づける"""
+        out = {d: float(emo.get(d, 0.0)) for d in DIMS}
+        ts = emo.get("ts")
+        if ts is None:
+            return out
+        dt = max(0.0, now - float(ts))
+        for d in DIMS:
+            hl = self.half_life[d]
+            if hl > 0 and dt:
+                out[d] *= 0.5 ** (dt / hl)
+        return out
+
+    def _apply(self, state: dict, delta, owner: bool) -> dict:
+        lo, hi = self.clamp
+        for d, x in zip(DIMS, delta):
+            state[d] += x
+        if owner:
+            for d, x in self.owner_bonus.items():
+                state[d] += x
+        for d in DIMS:
+            state[d] = max(lo, min(hi, state[d]))
+        return state
+
+    def update(self, emo: dict, text: str, now: float = None, owner: bool = False) -> dict:
+        """emo（保存されている状態）に text を反映した新しい {v, a, t, ts} を返す"""
+        self.maybe_reload()
+        now = time.time() if now is None else float(now)
+        state = self._apply(self.decay(emo, now), self.score(text), owner)
+        state["ts"] = now
+        return state
+
+    def replay(self, events, emo: dict = None) -> dict:
+        """
+        (ts, text, owner) の列を古い順に流して状態を作り直す
+        スコアは score_batch で一度に出し、減衰と足し込みだけ順番に回す
+        """
+        events = list(events)
+        deltas = self.score_batch(text for _, text, _ in events)
+        state = dict(emo or {})
+        for (ts, _, owner), delta in zip(events, deltas):
+            state = self._apply(self.decay(state, ts), delta, owner)
+            state["ts"] = float(ts)
+        return state
@@ -0,0 +1,254 @@
+"""
+GitHub API のローカル代用サーバー（オフライン確認用）
+
+memory_store が使う範囲だけ実装している:
+- Contents API: GET / PUT /repos/{owner}/{repo}/contents/{path}
+- Git Data API: ref / commits / trees / blobs
+
+使い方:
+    python fake_github.py --port 8765
+    GITHUB_API=http://127.0.0.1:8765 GITHUB_TOKEN=dummy GITHUB_REPO=owner/repo python bot.py
+"""
+import argparse
+import base64
+import hashlib
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+def _sha1(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+def _blob_sha(data: bytes) -> str:
+    return _sha1(b"blob %d\0" % len(data) + data)
+
+
+class FakeRepo:
+    """1リポジトリ分の状態。tree は path -> blob sha のフラットなdictで持つ"""
+
+    def __init__(self, branch: str = "main"):
+        self.lock = threading.Lock()
+        self.blobs = {}       # sha -> bytes
+        self.trees = {}       # sha -> {path: blob_sha}
+        self.commits = {}     # sha -> {"tree": sha, "parents": [...], "message": str}
+        self.refs = {}        # branch -> commit sha
+        self.stats = {}       # "METHOD kind" -> count
+        self._seq = 0
+
+        root = self._put_tree({})
+        self.refs[branch] = self._put_commit(root, [], "init")
+
+    # ---- objects ----
+    def _put_blob(self, data: bytes) -> str:
+        sha = _blob_sha(data)
+        self.blobs[sha] = data
+        return sha
+
+    def _put_tree(self, entries: dict) -> str:
+        sha = _sha1(json.dumps(sorted(entries.items())).encode("utf-8"))
+        self.trees[sha] = dict(entries)
+        return sha
+
+    def _put_commit(self, tree: str, parents: list, message: str) -> str:
+        self._seq += 1
+        sha = _sha1(f"{tree}:{parents}:{message}:{self._seq}".encode("utf-8"))
+        self.commits[sha] = {"tree": tree, "parents": list(parents), "message": message}
+        return sha
+
+    def head_tree(self, branch: str) -> dict:
+        return self.trees[self.commits[self.refs[branch]]["tree"]]
+
+    def files(self, branch: str = "main") -> dict:
+        """path -> 文字列（確認用）"""
+        return {p: self.blobs[s].decode("utf-8") for p, s in self.head_tree(branch).items()}
+
+    def count(self, key: str):
+        self.stats[key] = self.stats.get(key, 0) + 1
+
+
+class _Handler(BaseHTTPRequestHandler):
+    repo: FakeRepo = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, payload=None):
+        raw = json.dumps(payload if payload is not None else {}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def _body(self) -> dict:
+        n = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(n).decode("utf-8")) if n else {}
+
+    def _route(self, method: str):
+        url = urlparse(self.path)
+        q = parse_qs(url.query)
+        m = re.match(r"^/repos/[^/]+/[^/]+/(contents|git)/(.*)$", url.path)
+        if not m:
+            return self._send(404, {"message": "Not Found"})
+        kind, rest = m.groups()
+        repo = self.repo
+        with repo.lock:
+            repo.count(f"{method} {kind}/{rest.split('/')[0] if kind == 'git' else ''}".rstrip("/"))
+            if kind == "contents":
+                return self._contents(method, rest, q)
+            return self._git(method, rest, q)
+
+    # ---- Contents API ----
+    def _contents(self, method: str, path: str, q: dict):
+        repo = self.repo
+        branch = (q.get("ref") or ["main"])[0]
+        if method == "GET":
+            if branch not in repo.refs:
+                return self._send(404, {"message": "No commit found for the ref"})
+            tree = repo.head_tree(branch)
+            if path in tree:
+                sha = tree[path]
+                return self._send(200, {
+                    "type": "file", "path": path, "sha": sha,
+                    "content": base64.b64encode(repo.blobs[sha]).decode("utf-8"),
+                    "encoding": "base64",
+                })
+            prefix = path.rstrip("/") + "/"
+            children = sorted(p for p in tree if p.startswith(prefix) and "/" not in p[len(prefix):])
+            if children:
+                return self._send(200, [
+                    {"type": "file", "path": p, "name": p[len(prefix):], "sha": tree[p]}
+                    for p in children
+                ])
+            return self._send(404, {"message": "Not Found"})
+
+        if method == "PUT":
+            body = self._body()
+            branch = body.get("branch") or "main"
+            tree = dict(repo.head_tree(branch))
+            current = tree.get(path)
+            if current and body.get("sha") != current:
+                return self._send(409, {"message": f"{path} does not match {body.get('sha')}"})
+            if not current and body.get("sha"):
+                return self._send(409, {"message": f"{path} does not exist"})
+            sha = repo._put_blob(base64.b64decode(body["content"]))
+            tree[path] = sha
+            commit = repo._put_commit(repo._put_tree(tree), [repo.refs[branch]], body.get("message", ""))
+            repo.refs[branch] = commit
+            return self._send(201 if not current else 200, {"content": {"path": path, "sha": sha}, "commit": {"sha": commit}})
+
+        return self._send(405, {"message": "Method Not Allowed"})
+
+    # ---- Git Data API ----
+    def _git(self, method: str, rest: str, q: dict):
+        repo = self.repo
+        m = re.match(r"^refs?/heads/(.+)$", rest)
+        if m:
+            branch = m.group(1)
+            if method == "GET":
+                if branch not in repo.refs:
+                    return self._send(404, {"message": "Not Found"})
+                return self._send(200, {"ref": f"refs/heads/{branch}", "object": {"sha": repo.refs[branch], "type": "commit"}})
+            if method == "PATCH":
+                body = self._body()
+                new = body["sha"]
+                if new not in repo.commits:
+                    return self._send(422, {"message": "Object does not exist"})
+                if not body.get("force") and repo.refs.get(branch) not in repo.commits[new]["parents"]:
+                    return self._send(422, {"message": "Update is not a fast forward"})
+                repo.refs[branch] = new
+                return self._send(200, {"ref": f"refs/heads/{branch}", "object": {"sha": new, "type": "commit"}})
+
+        m = re.match(r"^commits/?([0-9a-f]*)$", rest)
+        if m:
+            sha = m.group(1)
+            if method == "GET" and sha in repo.commits:
+                c = repo.commits[sha]
+                return self._send(200, {"sha": sha, "tree": {"sha": c["tree"]}, "parents": [{"sha": p} for p in c["parents"]], "message": c["message"]})
+            if method == "POST" and not sha:
+                body = self._body()
+                if body["tree"] not in repo.trees:
+                    return self._send(422, {"message": "Tree does not exist"})
+                new = repo._put_commit(body["tree"], body.get("parents", []), body.get("message", ""))
+                return self._send(201, {"sha": new, "tree": {"sha": body["tree"]}})
+
+        m = re.match(r"^trees/?([^/]*)$", rest)
+        if m:
+            sha = m.group(1)
+            # tree-ish としてブランチ名 / commit sha も受け付ける
+            if sha in repo.refs:
+                sha = repo.refs[sha]
+            if sha in repo.commits:
+                sha = repo.commits[sha]["tree"]
+            if method == "GET" and sha in repo.trees:
+                # recursive 指定の有無に関わらずフラットに全部返す
+                entries = [{"path": p, "type": "blob", "mode": "100644", "sha": s, "size": len(repo.blobs[s])}
+                           for p, s in sorted(repo.trees[sha].items())]
+                return self._send(200, {"sha": sha, "tree": entries, "truncated": False})
+            if method == "POST" and not sha:
+                body = self._body()
+                tree = dict(repo.trees.get(body.get("base_tree"), {}))
+                for e in body.get("tree", []):
+                    if "content" in e:
+                        tree[e["path"]] = repo._put_blob(e["content"].encode("utf-8"))
+                    elif e.get("sha") is None:
+                        tree.pop(e["path"], None)
+                    else:
+                        tree[e["path"]] = e["sha"]
+                return self._send(201, {"sha": repo._put_tree(tree)})
+
+        m = re.match(r"^blobs/?([0-9a-f]*)$", rest)
+        if m:
+            sha = m.group(1)
+            if method == "GET" and sha in repo.blobs:
+                return self._send(200, {"sha": sha, "content": base64.b64encode(repo.blobs[sha]).decode("utf-8"),
+                                        "encoding": "base64", "size": len(repo.blobs[sha])})
+            if method == "POST" and not sha:
+                body = self._body()
+                data = body["content"].encode("utf-8")
+                if body.get("encoding") == "base64":
+                    data = base64.b64decode(body["content"])
+                return self._send(201, {"sha": repo._put_blob(data)})
+
+        return self._send(404, {"message": "Not Found"})
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_PUT(self):
+        self._route("PUT")
+
+    def do_POST(self):
+        self._route("POST")
+
+    def do_PATCH(self):
+        self._route("PATCH")
+
+
+def start_fake_github(port: int = 0, branch: str = "main"):
+    """
+    バックグラウンドスレッドで起動して (server, base_url) を返す
+    server.repo で中身とリクエスト数(stats)を覗ける
+    """
+    repo = FakeRepo(branch=branch)
+    handler = type("Handler", (_Handler,), {"repo": repo})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.repo = repo
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="GitHub API のローカル代用サーバー")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--branch", default="main")
+    args = ap.parse_args()
+    server, url = start_fake_github(args.port, args.branch)
+    print(f"fake GitHub API listening on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,194 @@
+"""
+OpenAI Responses API のローカル代用サーバー（オフライン確認用）
+
+bot.py が使う POST /v1/responses だけ実装している（stream=True なら SSE で返す）
+
+使い方:
+    python fake_openai.py --port 8766 --reply "えへへ……きてくれてうれしい……✨"
+    OPENAI_BASE_URL=http://127.0.0.1:8766/v1 OPENAI_API_KEY=dummy python bot.py
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOpenAIState:
+    """返す内容と、届いたリクエストの記録"""
+
+    def __init__(self, reply: str, chunk_size: int = 4, chunk_delay: float = 0.05, delay: float = 0.0,
+                 cache_min_tokens: int = 1024):
+        self.lock = threading.Lock()
+        self.reply = reply
+        self.chunk_size = max(1, int(chunk_size))
+        self.chunk_delay = float(chunk_delay)
+        self.delay = float(delay)       # 最初の応答までの待ち
+        self.fail_next = []             # 次のリクエストから順に返すエラーstatus（429/500など）
+        self.requests = []              # 受け取ったリクエストbody
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.cache_min_tokens = int(cache_min_tokens)
+        self.prompt_cache = {}          # prompt_cache_key -> 直近の input（プレフィックスキャッシュの真似）
+        self._seq = 0
+
+    def next_id(self) -> int:
+        with self.lock:
+            self._seq += 1
+            return self._seq
+
+
+def _flatten(body: dict) -> str:
+    return "".join(f"{m.get('role')}:{m.get('content') or ''}\n" for m in body.get("input", []) if isinstance(m, dict))
+
+
+def _cached_tokens(state: FakeOpenAIState, body: dict) -> int:
+    """
+    本家のプロンプトキャッシュの真似: 同じ prompt_cache_key の直近リクエストと先頭が一致した分のうち、
+    cache_min_tokens 以上なら128トークン単位で切り捨てた分を cached とする
+    """
+    flat = _flatten(body)
+    key = body.get("prompt_cache_key") or ""
+    with state.lock:
+        recent = state.prompt_cache.setdefault(key, [])
+        common = 0
+        for prev in recent:
+            n = 0
+            for a, b in zip(prev, flat):
+                if a != b:
+                    break
+                n += 1
+            common = max(common, n)
+        recent.append(flat)
+        del recent[:-16]
+    if common < state.cache_min_tokens:
+        return 0
+    return common // 128 * 128
+
+
+def _usage(body: dict, text: str, cached: int = 0) -> dict:
+    # ざっくり1文字1トークン
+    n_in = len(_flatten(body))
+    return {
+        "input_tokens": n_in,
+        "input_tokens_details": {"cached_tokens": cached},
+        "output_tokens": len(text),
+        "output_tokens_details": {"reasoning_tokens": 0},
+        "total_tokens": n_in + len(text),
+    }
+
+
+def _response(rid: int, body: dict, text: str, status: str = "completed", cached: int = 0) -> dict:
+    return {
+        "id": f"resp_{rid}",
+        "object": "response",
+        "created_at": int(time.time()),
+        "model": body.get("model", "gpt-4o-mini"),
+        "status": status,
+        "output": [{
+            "type": "message",
+            "id": f"msg_{rid}",
+            "role": "assistant",
+            "status": status,
+            "content": [{"type": "output_text", "text": text, "annotations": []}],
+        }] if text else [],
+        "parallel_tool_calls": True,
+        "tool_choice": "auto",
+        "tools": [],
+        "usage": _usage(body, text, cached) if status == "completed" else None,
+    }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    state: FakeOpenAIState = None
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, status: int, payload: dict):
+        raw = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def _sse(self, event: dict):
+        self.wfile.write(f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def do_POST(self):
+        st = self.state
+        n = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(n).decode("utf-8")) if n else {}
+        if not self.path.rstrip("/").endswith("/responses"):
+            return self._json(404, {"error": {"message": "Not Found"}})
+
+        with st.lock:
+            st.requests.append(body)
+            fail = st.fail_next.pop(0) if st.fail_next else None
+            st.in_flight += 1
+            st.max_in_flight = max(st.max_in_flight, st.in_flight)
+        try:
+            if st.delay:
+                time.sleep(st.delay)
+            if fail:
+                return self._json(fail, {"error": {"message": f"fake error {fail}", "type": "fake", "code": None}})
+
+            rid = st.next_id()
+            text = st.reply
+            cached = _cached_tokens(st, body)
+            if not body.get("stream"):
+                return self._json(200, _response(rid, body, text, cached=cached))
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            seq = 0
+            self._sse({"type": "response.created", "sequence_number": seq, "response": _response(rid, body, "", "in_progress")})
+            for i in range(0, len(text), st.chunk_size):
+                seq += 1
+                time.sleep(st.chunk_delay)
+                self._sse({
+                    "type": "response.output_text.delta", "sequence_number": seq,
+                    "item_id": f"msg_{rid}", "output_index": 0, "content_index": 0,
+                    "delta": text[i:i + st.chunk_size], "logprobs": [],
+                })
+            seq += 1
+            self._sse({"type": "response.completed", "sequence_number": seq, "response": _response(rid, body, text, cached=cached)})
+        finally:
+            with st.lock:
+                st.in_flight -= 1
+
+
+def start_fake_openai(port: int = 0, reply: str = "えへへ……うれしい……✨ 今日はどんな日だった……？", **kwargs):
+    """
+    バックグラウンドスレッドで起動して (server, base_url) を返す
+    server.state で返答内容の変更・エラー注入・リクエスト記録の確認ができる
+    """
+    state = FakeOpenAIState(reply, **kwargs)
+    handler = type("Handler", (_Handler,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="OpenAI Responses API のローカル代用サーバー")
+    ap.add_argument("--port", type=int, default=8766)
+    ap.add_argument("--reply", default="えへへ……うれしい……✨ 今日はどんな日だった……？")
+    ap.add_argument("--chunk-size", type=int, default=4)
+    ap.add_argument("--chunk-delay", type=float, default=0.05)
+    ap.add_argument("--delay", type=float, default=0.0)
+    ap.add_argument("--cache-min-tokens", type=int, default=1024)
+    args = ap.parse_args()
+    server, url = start_fake_openai(args.port, args.reply, chunk_size=args.chunk_size,
+                                    chunk_delay=args.chunk_delay, delay=args.delay,
+                                    cache_min_tokens=args.cache_min_tokens)
+    print(f"fake OpenAI API listening on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,75 @@
+"""
+会話履歴をトークン予算に収める & 予算からあふれた古い発言を要約に回すための道具
+
+- estimate_tokens(): tiktoken があればそれで数え、なければ文字種からざっくり見積もる
+- history_entries(): 保存済みの発言窓から、プロンプトに入れる履歴の候補を作る
+- fit_history(): 新しい方から予算に入るだけ残す。残す範囲の先頭は align 件単位でしか動かさないので、
+  数ターンのあいだ履歴の先頭が変わらず、プロンプトのプレフィックスキャッシュに乗りやすい
+- summary_backlog(): まだ要約に入っていない & もう履歴に入りきらない発言
+
+履歴は (seq, role, content) のリスト（古い順）。seq はチャンネル通算の連番
+"""
+try:
+    import tiktoken
+    _enc = tiktoken.get_encoding("o200k_base")
+except Exception:
+    tiktoken = None
+    _enc = None
+
+MSG_OVERHEAD_TOKENS = 4   # role などメッセージ1件ごとのおまけ
+
+
+def estimate_tokens(text: str) -> int:
+    text = text or ""
+    if _enc is not None:
+        return len(_enc.encode(text))
+    # 日本語(かな漢字・記号・絵文字)は1文字≒1トークン、ASCIIは4文字≒1トークン
+    n_ascii = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - n_ascii) + (n_ascii + 3) // 4
+
+
+def message_tokens(content: str) -> int:
+    return estimate_tokens(content) + MSG_OVERHEAD_TOKENS
+
+
+def history_entries(window: list, uid: str, n_current: int = 0, homecoming: bool = False) -> list:
+    """
+    window（[(seq, author, content), ...]）から履歴の (seq, role, content) を作る
+    最後の n_current 件は今のターンの発言なので入れない。帰宅のターンでなければ「ただいま/おかえり」は入れない
+    返事を組み立てるときと、要約に回す範囲を決めるときで同じものを fit_history に渡す
+    """
+    if n_current:
+        window = window[:-n_current]
+    entries = []
+    for seq, aid, content in window:
+        if not homecoming and ("ただいま" in content or "おかえり" in content):
+            continue
+        entries.append((seq, "user" if str(aid) == str(uid) else "assistant", content))
+    return entries
+
+
+def fit_history(entries: list, budget: int, align: int = 1) -> tuple:
+    """
+    entries のうち新しい方から budget トークンに収まる分を残す -> (残した entries, 先頭のseq)
+    先頭は align の倍数+1 の seq に切り上げる（少しだけ予算を余らせる代わりに、先頭が毎ターン動かない）
+    一番新しい1件だけは予算を超えていても残す
+    """
+    if not entries:
+        return [], 0
+    align = max(1, int(align))
+    used = 0
+    first_fit = entries[-1][0]
+    for seq, _, content in reversed(entries):
+        used += message_tokens(content)
+        if used > budget:
+            break
+        first_fit = seq
+    start = ((first_fit - 1 + align - 1) // align) * align + 1
+    start = min(start, entries[-1][0])
+    kept = [e for e in entries if e[0] >= start]
+    return kept, kept[0][0]
+
+
+def summary_backlog(entries: list, summary_upto: int, first_kept_seq: int) -> list:
+    """要約済み(summary_upto)より新しく、履歴の先頭(first_kept_seq)より古い発言"""
+    return [e for e in entries if summary_upto < e[0] < first_kept_seq]
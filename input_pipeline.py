@@ -0,0 +1,142 @@
+"""
+連投を1ターンにまとめる入力段（チャンネルごと）
+
+- submit(key, item) で受けたものを window 秒ためる。その間に次が来たら待ち直す（最初の1件から max_wait 秒で打ち切り）
+- 静かになったら handler(key, turn) を1回呼ぶ
+    turn.items        : このターンにまとめた全部（古い順）
+    turn.take_fresh() : まだ取り込んでいない分（履歴・感情に入れる分）。取ったらもう返さない
+    turn.commit()     : 送信を始める直前に呼ぶ。これより後は作り直さない
+    turn.state        : handler が作り直しをまたいで持ち越したいもの（レート制限で数えたか など）
+- handler が返事を作っている途中（commit 前）に次が来たら、そのタスクを cancel して、前の分 + 新しい分で待ち直す
+  commit 後に来た分と、最初の1件から max_wait 秒を過ぎてから来た分は、そのターンが終わってから次のターンになる
+  （返事の順番は入れ替わらない。途切れずに送られ続けても返事が出ないままにはならない）
+- clock / sleep は差し替えられる（テストで時間を進める用）
+
+    pipeline = DebouncePipeline(handle_turn, window=0.8, max_wait=4.0)
+    pipeline.submit(ch_id, (message, text))
+"""
+import asyncio
+import time
+
+
+class Turn:
+    __slots__ = ("key", "items", "fresh", "committed", "state")
+
+    def __init__(self, key, items: list, fresh: list | None = None, state: dict | None = None):
+        self.key = key
+        self.items = items
+        self.fresh = list(items) if fresh is None else fresh
+        self.committed = False
+        self.state = {} if state is None else state
+
+    def take_fresh(self) -> list:
+        fresh, self.fresh = self.fresh, []
+        return fresh
+
+    def commit(self):
+        self.committed = True
+
+
+class _Channel:
+    __slots__ = ("buffer", "carried", "carried_fresh", "carried_state", "first_at", "last_at", "timer", "task", "turn",
+                 "turn_first_at")
+
+    def __init__(self):
+        self.buffer = []          # 待っている間に来た分
+        self.carried = []         # 作り直しで引き継いだ分（items）
+        self.carried_fresh = []   # そのうちまだ取り込まれていない分
+        self.carried_state = None # 作り直しで引き継いだ turn.state
+        self.first_at = 0.0
+        self.last_at = 0.0
+        self.timer = None         # 静かになるのを待つタスク
+        self.task = None          # handler を動かしているタスク
+        self.turn = None          # task が作っている Turn（cancel したら None）
+        self.turn_first_at = 0.0  # turn の最初の1件が来た時刻
+
+
+class DebouncePipeline:
+
+    def __init__(self, handler, window: float = 0.8, max_wait: float = 4.0,
+                 clock=time.monotonic, sleep=asyncio.sleep):
+        self.handler = handler
+        self.window = float(window)
+        self.max_wait = max(self.window, float(max_wait))
+        self.clock = clock
+        self.sleep = sleep
+        self._channels = {}
+        self.counters = {"submitted": 0, "turns": 0, "merged": 0, "restarted": 0, "errors": 0}
+
+    def submit(self, key, item):
+        ch = self._channels.get(key)
+        if ch is None:
+            ch = self._channels[key] = _Channel()
+        now = self.clock()
+        self.counters["submitted"] += 1
+        if ch.turn is not None and not ch.turn.committed and now - ch.turn_first_at < self.max_wait:
+            # 返事を作っている途中: やめて、前の分と一緒に作り直す
+            ch.carried = ch.turn.items
+            ch.carried_fresh = ch.turn.fresh
+            ch.carried_state = ch.turn.state
+            ch.first_at = ch.turn_first_at
+            ch.turn = None
+            ch.task.cancel()
+            self.counters["restarted"] += 1
+        elif not ch.buffer and not ch.carried:
+            ch.first_at = now
+        ch.buffer.append(item)
+        ch.last_at = now
+        if ch.timer is None:
+            ch.timer = asyncio.ensure_future(self._wait(key, ch))
+
+    async def _wait(self, key, ch: _Channel):
+        while True:
+            delay = min(ch.last_at + self.window, ch.first_at + self.max_wait) - self.clock()
+            if delay > 0:
+                await self.sleep(delay)
+                continue
+            if ch.task is not None:
+                # 前のターン（送信中 / cancel 済みの後片付け）が終わるのを待つ
+                await asyncio.wait([ch.task])
+                continue
+            break
+        items = ch.carried + ch.buffer
+        turn = Turn(key, items, ch.carried_fresh + ch.buffer, ch.carried_state)
+        self.counters["turns"] += 1
+        ch.buffer, ch.carried, ch.carried_fresh, ch.carried_state = [], [], [], None
+        ch.timer = None
+        ch.turn = turn
+        ch.turn_first_at = ch.first_at
+        ch.task = asyncio.ensure_future(self._run(key, ch, turn))
+
+    async def _run(self, key, ch: _Channel, turn: Turn):
+        try:
+            await self.handler(key, turn)
+            self.counters["merged"] += len(turn.items) - 1
+        except asyncio.CancelledError:
+            if ch.turn is turn:
+                raise          # 作り直しではない cancel（終了時など）
+        except Exception as e:
+            self.counters["errors"] += 1
+            print("input pipeline ERROR:", key, repr(e))
+        finally:
+            ch.task = None
+            if ch.turn is turn:
+                ch.turn = None
+            if ch.timer is None and not ch.buffer:
+                self._channels.pop(key, None)
+
+    async def drain(self):
+        """ためている分もふくめて全部のターンが終わるまで待つ"""
+        while self._channels:
+            tasks = [t for ch in self._channels.values() for t in (ch.timer, ch.task) if t is not None]
+            if not tasks:
+                break
+            await asyncio.wait(tasks)
+
+    def stats(self) -> dict:
+        chans = self._channels.values()
+        return {
+            **self.counters,
+            "buffered": sum(len(ch.buffer) + len(ch.carried) for ch in chans),
+            "in_flight": sum(1 for ch in chans if ch.task is not None),
+        }
@@ -0,0 +1,140 @@
+"""
+キーワード判定をまとめて1回の走査で済ませるための辞書とマッチャー
+
+感情・挨拶・帰宅・質問などの判定は、それぞれ `any(w in s for w in ...)` で
+同じメッセージを何度もなめていた。ここで全カテゴリの語を1つの Aho–Corasick
+オートマトンにまとめておき、analyze(text) で一度だけ走査して
+「どのカテゴリのどの語がどこに出たか」を返す。
+
+    hits = analyze(text)
+    if "homecoming" in hits: ...
+    hits.words("greeting")       # -> ["おはよう", ...]（出てきた順）
+    hits.matches                 # -> (Match(category, word, start, end), ...)
+
+同じ文字列を続けて聞かれることが多い（bot / memory_store / ruby_core が同じ
+メッセージを見る）ので、結果は直近の分だけキャッシュしている。
+"""
+from collections import deque
+from functools import lru_cache
+from typing import NamedTuple
+
+# カテゴリ -> 語のリスト。語を増やしても1メッセージあたりの走査は1回のまま
+# 感情の語（emo_*）は emotion_engine が emotion_lexicon.json から set_categories() で足す
+LEXICON = {
+    # bot.is_homecoming / bot.user_said_morning_greet
+    "homecoming": ["ただいま", "帰った", "帰宅", "いま帰った", "戻った"],
+    "morning": ["おは"],   # おはよう / おはよ / おはょ / おはー は全部「おは」で始まる
+
+    # ruby_core.Ruby
+    "greeting": ["おはよう", "おやすみ", "おつかれ"],
+    "question": ["?", "？", "なに", "何", "どれ", "どっち", "いつ", "どこ", "だれ", "誰", "どう", "なんで", "理由"],
+    "distress": ["眠い", "つらい", "しんどい", "無理", "きつい", "不安", "こわい", "寂しい", "イライラ", "疲れた", "だるい"],
+}
+
+
+class Match(NamedTuple):
+    category: str
+    word: str
+    start: int
+    end: int
+
+
+class KeywordMatcher:
+    """
+    Aho–Corasick による複数語マッチャー
+    patterns: {カテゴリ: [語, ...]}。同じ語が複数カテゴリにあってもよい
+    """
+
+    def __init__(self, patterns: dict):
+        self.patterns = {cat: list(words) for cat, words in patterns.items()}
+        self._goto = [{}]        # node -> {文字: 次のnode}
+        self._fail = [0]
+        self._out = [()]         # node -> ((category, word), ...)（failリンク先の分も含める）
+
+        for cat, words in self.patterns.items():
+            for w in words:
+                if not w:
+                    continue
+                node = 0
+                for ch in w:
+                    nxt = self._goto[node].get(ch)
+                    if nxt is None:
+                        nxt = len(self._goto)
+                        self._goto[node][ch] = nxt
+                        self._goto.append({})
+                        self._fail.append(0)
+                        self._out.append(())
+                    node = nxt
+                self._out[node] += ((cat, w),)
+
+        # 幅優先で failリンクを張る
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                f = self._goto[f].get(ch, 0)
+                self._fail[nxt] = f if f != nxt else 0
+                self._out[nxt] += self._out[self._fail[nxt]]
+
+    def scan(self, text: str) -> list:
+        """text を1回だけ走査して、全カテゴリのマッチを出現位置順に返す（重なりも全部）"""
+        goto, fail, out = self._goto, self._fail, self._out
+        found = []
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                for cat, w in out[node]:
+                    found.append(Match(cat, w, i + 1 - len(w), i + 1))
+        found.sort(key=lambda m: (m.start, m.end))
+        return found
+
+
+class TextHits:
+    """analyze() の結果。`category in hits` で判定、words()/matches で中身を見る"""
+
+    __slots__ = ("matches", "categories")
+
+    def __init__(self, matches):
+        self.matches = tuple(matches)
+        self.categories = frozenset(m.category for m in self.matches)
+
+    def __contains__(self, category):
+        return category in self.categories
+
+    def words(self, category: str) -> list:
+        return [m.word for m in self.matches if m.category == category]
+
+    def __repr__(self):
+        return f"TextHits({sorted(self.categories)})"
+
+
+MATCHER = KeywordMatcher(LEXICON)
+
+
+@lru_cache(maxsize=256)
+def analyze(text: str) -> TextHits:
+    return TextHits(MATCHER.scan(text or ""))
+
+
+def set_categories(categories: dict, prefix: str):
+    """
+    prefix で始まるカテゴリを丸ごと categories に置き換えて、マッチャーを作り直す
+    （辞書ファイルを読み直したときに使う。他のカテゴリはそのまま）
+    """
+    global MATCHER
+    bad = [c for c in categories if not c.startswith(prefix)]
+    if bad:
+        raise ValueError(f"カテゴリ名は {prefix!r} で始めてください: {bad}")
+    for cat in [c for c in LEXICON if c.startswith(prefix)]:
+        del LEXICON[cat]
+    for cat, words in categories.items():
+        LEXICON[cat] = list(words)
+    MATCHER = KeywordMatcher(LEXICON)
+    analyze.cache_clear()
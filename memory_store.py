@@ -1,33 +1,143 @@
 import os
 import json
 import time
+import heapq
+import atexit
+import asyncio
 import base64
+import hashlib
+import itertools
 import urllib.request
 import urllib.error
+from collections import deque
+from contextlib import asynccontextmanager
 from datetime import date
 
+from bounded_cache import BoundedCache
+from coordination import LocalCoordinator, SQLiteCoordinator
+from emotion_engine import EmotionEngine
+from metrics import REGISTRY
+from state_merge import merge_user
+
+try:
+    import aiohttp
+except Exception:
+    aiohttp = None
+
 # ===== GitHub env =====
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 GITHUB_REPO = os.getenv("GITHUB_REPO")                 # "owner/repo"
 GITHUB_BRANCH = os.getenv("GITHUB_BRANCH", "main")
 GITHUB_PATH_BASE = os.getenv("GITHUB_PATH_BASE", "ruby_mem")  # ★ベースフォルダ
 
-GITHUB_API = "https://api.github.com"
+GITHUB_API = os.getenv("GITHUB_API", "https://api.github.com")  # fake_github.py 等に差し替え可
+# "batch": Git Data APIで dirty 全部を1コミットにまとめる / "contents": 1ファイル1コミット(旧方式)
+GITHUB_FLUSH_MODE = os.getenv("GITHUB_FLUSH_MODE", "batch")
+
+# ===== storage backend =====
+# "github": GitHubに直接保存 / "sqlite": ローカルSQLite(WAL)に保存
+MEMORY_BACKEND = os.getenv("MEMORY_BACKEND", "github")
+MEMORY_SQLITE_PATH = os.getenv("MEMORY_SQLITE_PATH", "ruby_mem.sqlite3")
+# "github" を指定すると、メインのバックエンドに加えてGitHubへ定期的にバックアップする
+MEMORY_BACKUP = os.getenv("MEMORY_BACKUP", "")
+MEMORY_BACKUP_INTERVAL_SEC = int(os.getenv("MEMORY_BACKUP_INTERVAL_SEC", "600"))
+
+# ===== warm-start =====
+# 起動時に最近アクティブだったファイルを先読みする件数（0なら無効）と同時取得数
+WARM_START_FILES = int(os.getenv("WARM_START_FILES", "0"))
+WARM_START_CONCURRENCY = int(os.getenv("WARM_START_CONCURRENCY", "8"))
+ACTIVITY_INDEX_MAX = 2000
+# 最終保存時刻の索引は変わっていてもこの間隔でしか書かない（あとは終了時に1回）
+ACTIVITY_INDEX_INTERVAL_SEC = float(os.getenv("ACTIVITY_INDEX_INTERVAL_SEC", "900"))
+
+# ===== channel history =====
+# batchモードではチャンネル履歴を追記セグメント(JSONL)で保存し、この数たまったらスナップショットに畳む
+CHANNEL_COMPACT_SEGMENTS = int(os.getenv("CHANNEL_COMPACT_SEGMENTS", "8"))
+
+# ===== daily counts =====
+# 日ごとの回数は新しい方からこの日数だけ残し、古い日は月ごとの合計に畳む（月の合計もこの数まで）
+DAILY_COUNTS_KEEP_DAYS = max(1, int(os.getenv("DAILY_COUNTS_KEEP_DAYS", "7")))
+MONTHLY_COUNTS_KEEP = int(os.getenv("MONTHLY_COUNTS_KEEP", "12"))
 
 # ===== flush policy =====
 MIN_FLUSH_INTERVAL_SEC = 60
 FORCE_FLUSH_AFTER_DIRTY_SEC = 180
+# 汚れてから最低この秒数は待つ（続けて来た変更を同じ書き込みにまとめる）
+FLUSH_COALESCE_SEC = float(os.getenv("FLUSH_COALESCE_SEC", "5"))
+# 1回の書き込み（batchなら1コミット）に載せるパスの上限
+FLUSH_MAX_BATCH = int(os.getenv("FLUSH_MAX_BATCH", "200"))
+# 書き込みがこれより遅い / 失敗したら、次の書き込みまで間をあける（倍々で FLUSH_BACKOFF_MAX_SEC まで）
+FLUSH_SLOW_SEC = float(os.getenv("FLUSH_SLOW_SEC", "5"))
+FLUSH_BACKOFF_MAX_SEC = float(os.getenv("FLUSH_BACKOFF_MAX_SEC", "120"))
 MAX_MSG_PER_CHANNEL = 80
 
+# ===== multi-process =====
+# "sqlite" にすると同じマシンの複数プロセスで同じ記憶を扱える（書く前にリースを取り、保存したら他のプロセスのキャッシュを捨てさせる）
+COORDINATOR = os.getenv("COORDINATOR", "local")
+COORD_SQLITE_PATH = os.getenv("COORD_SQLITE_PATH", "ruby_coord.sqlite3")
+COORD_NODE_ID = os.getenv("COORD_NODE_ID") or None            # 未設定なら hostname:pid
+COORD_LEASE_SEC = float(os.getenv("COORD_LEASE_SEC", "90"))    # 持ち主が落ちたときに切れるまでの時間
+COORD_CLAIM_TIMEOUT_SEC = float(os.getenv("COORD_CLAIM_TIMEOUT_SEC", "10"))
+COORD_POLL_SEC = float(os.getenv("COORD_POLL_SEC", "0.5"))     # リースを持っている間、待っている人がいないか見る間隔
+COORD_MESSAGE_TTL_SEC = float(os.getenv("COORD_MESSAGE_TTL_SEC", "600"))   # claim_once() の印を残す時間
+
+# ===== emotion =====
+# 感情の語と重み・半減期（書き換えると数秒以内に読み直す）
+EMOTION_LEXICON_PATH = os.getenv(
+    "EMOTION_LEXICON_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "emotion_lexicon.json"))
+_emotion = EmotionEngine(EMOTION_LEXICON_PATH)
+
+# ===== cache policy =====
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "5000"))
+USER_CACHE_MAX_BYTES = int(os.getenv("USER_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+CHANNEL_CACHE_MAX_ENTRIES = int(os.getenv("CHANNEL_CACHE_MAX_ENTRIES", "2000"))
+CHANNEL_CACHE_MAX_BYTES = int(os.getenv("CHANNEL_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_IDLE_TTL_SEC = float(os.getenv("CACHE_IDLE_TTL_SEC", "3600"))
+
+def _approx_size(obj: dict) -> int:
+    # 直列化した長さでざっくり見積もる
+    return len(json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=list))
+
+def _on_evict_user(uid, obj):
+    _on_evict(_user_path(uid), obj)
+
+def _on_evict_channel(chid, obj):
+    _on_evict(_channel_path(chid), obj)
+
 # caches
-_user_cache = {}          # uid -> dict
-_channel_cache = {}       # chid -> dict
+_user_cache = BoundedCache(USER_CACHE_MAX_ENTRIES, USER_CACHE_MAX_BYTES, CACHE_IDLE_TTL_SEC,
+                           sizeof=_approx_size, on_evict=_on_evict_user)          # uid -> dict
+_channel_cache = BoundedCache(CHANNEL_CACHE_MAX_ENTRIES, CHANNEL_CACHE_MAX_BYTES, CACHE_IDLE_TTL_SEC,
+                              sizeof=_approx_size, on_evict=_on_evict_channel)    # chid -> dict
 _sha_cache = {}           # path -> sha
+_base_raw = {}            # user path -> 最後に読んだ/書いた中身（保存が競合したときの 3-way merge の base）
+_last_head = None         # 最後に自分で進めたブランチの commit（batch。違っていたら他の書き手がいる）
+_evicted_dirty = {}       # path -> dict（未保存のまま追い出されたもの。次のflushで書いてから手放す）
 
 _dirty_paths = set()      # set of github paths
 _dirty_since = {}         # path -> ts
 _last_flush = {}          # path -> ts
 
+# async
+_inflight = {}            # path -> asyncio.Task（同じファイルの同時ロードは1本にまとめる）
+_session = None           # aiohttp.ClientSession
+_flush_lock = asyncio.Lock()
+_flush_task = None
+_flush_heap = []          # (deadline, path)。_flush_deadline と合わないものは取り出したときに捨てる
+_flush_deadline = {}      # path -> 書く予定の時刻
+_flush_wakeup = asyncio.Event()   # 今より早い deadline が入ったら flush タスクを起こす
+_flush_backoff = 0.0      # バックエンドが遅いときに書き込みの間にあける秒数
+_flush_urgent = set()     # 他のプロセスが待っているので間隔を無視して書く path
+_backend = None           # init_db() で決まる
+
+# multi-process
+_coord = None             # init_db() で決まる
+_held = set()             # リースを持っている path
+_to_release = set()       # 手が空いたので返す path（flush タスク / claimed() の終わりにスレッドで返す）
+_lease_lock = asyncio.Lock()   # claim と release の順番を守る（返している最中に取り直して消されないように）
+_pins = {}                # path -> claimed() の中で使っている数（0になるまで手放さない）
+_coord_renewed = 0.0
+
 
 # ---------------- GitHub helpers ----------------
 def _ensure_env():
@@ -42,29 +152,74 @@ def _ensure_env():
 def _now():
     return time.time()
 
-def _gh_request(method: str, url: str, body: dict | None = None):
+def _gh_headers(data: bytes | None):
     headers = {
         "Authorization": f"Bearer {GITHUB_TOKEN}",
         "Accept": "application/vnd.github+json",
         "User-Agent": "ruby-bot",
     }
-    data = None
-    if body is not None:
-        data = json.dumps(body).encode("utf-8")
+    if data is not None:
         headers["Content-Type"] = "application/json"
+    return headers
+
+# GitHub API の呼び出し回数と所要時間（/metrics）。例外で終わったものは status="error"
+GH_REQUESTS = REGISTRY.counter("ruby_github_requests_total", "GitHub API requests", ("method", "status"))
+GH_LATENCY = REGISTRY.histogram("ruby_github_request_seconds", "GitHub API request latency", ("method", "status"))
+FLUSH_LATENCY = REGISTRY.histogram("ruby_memory_flush_seconds", "Time spent writing dirty paths", ("backend",))
+MERGES = REGISTRY.counter("ruby_memory_merges_total", "User states merged with a concurrent remote write")
+
+def _record_gh(method: str, status, started: float):
+    labels = {"method": method, "status": str(status)}
+    GH_REQUESTS.inc(**labels)
+    GH_LATENCY.observe(time.perf_counter() - started, **labels)
+
+def _gh_request(method: str, url: str, body: dict | None = None):
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    headers = _gh_headers(data)
 
     req = urllib.request.Request(url, data=data, headers=headers, method=method)
+    started = time.perf_counter()
+    status = "error"
     try:
         with urllib.request.urlopen(req, timeout=20) as resp:
+            status = resp.status
             raw = resp.read().decode("utf-8")
             return resp.status, json.loads(raw) if raw else {}
     except urllib.error.HTTPError as e:
+        status = e.code
         raw = e.read().decode("utf-8") if e.fp else ""
         try:
             payload = json.loads(raw) if raw else {}
         except Exception:
             payload = {"raw": raw}
         return e.code, payload
+    finally:
+        _record_gh(method, status, started)
+
+async def _get_session():
+    global _session
+    if aiohttp is None:
+        raise RuntimeError("aiohttp が未インストールのため非同期APIは使えません")
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=20))
+    return _session
+
+async def _agh_request(method: str, url: str, body: dict | None = None):
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    session = await _get_session()
+    started = time.perf_counter()
+    status = "error"
+    try:
+        async with session.request(method, url, data=data, headers=_gh_headers(data)) as resp:
+            status = resp.status
+            raw = await resp.text()
+            try:
+                payload = json.loads(raw) if raw else {}
+            except Exception:
+                payload = {"raw": raw}
+            return resp.status, payload
+    finally:
+        _record_gh(method, status, started)
 
 def _contents_url(path: str):
     return f"{GITHUB_API}/repos/{GITHUB_REPO}/contents/{path}?ref={GITHUB_BRANCH}"
@@ -78,17 +233,101 @@ def _b64_encode(s: str) -> str:
 def _b64_decode(b64: str) -> str:
     return base64.b64decode(b64).decode("utf-8")
 
-def _mark_dirty(path: str):
+def _mark_dirty(path: str, delta: int | None = None):
+    # delta: 書き換えで増えたバイト数（分かる場合）。None ならキャッシュ側で後からまとめて測り直す
     _dirty_paths.add(path)
     if path not in _dirty_since:
         _dirty_since[path] = _now()
+    cache, key = _cache_for_path(path)
+    if cache is not None:
+        cache.resize(key, delta)
+    _schedule_flush(path)
+
+def _flush_due_at(path: str, now: float) -> float:
+    """path を書くべき時刻（_due_paths と同じ条件 + まとめ待ち）"""
+    if path in _evicted_dirty or path in _flush_urgent:
+        return now
+    since = _dirty_since.get(path, now)
+    due = min(_last_flush.get(path, 0.0) + MIN_FLUSH_INTERVAL_SEC, since + FORCE_FLUSH_AFTER_DIRTY_SEC)
+    return max(due, since + FLUSH_COALESCE_SEC)
+
+def _schedule_flush(path: str, deadline: float | None = None):
+    # 書くのは flush タスク。ここは予定を積むだけ（I/Oなし）
+    if deadline is None:
+        deadline = _flush_due_at(path, _now())
+    current = _flush_deadline.get(path)
+    if current is not None and current <= deadline:
+        return
+    _flush_deadline[path] = deadline
+    heapq.heappush(_flush_heap, (deadline, path))
+    if _flush_heap[0][1] == path:
+        _flush_wakeup.set()
+
+def _pop_due_flushes(now: float) -> list:
+    # もうすぐ期限のもの（FLUSH_COALESCE_SEC の半分以内）も同じ書き込みに相乗りさせる
+    horizon = now + FLUSH_COALESCE_SEC / 2
+    paths = []
+    while _flush_heap and _flush_heap[0][0] <= horizon and len(paths) < FLUSH_MAX_BATCH:
+        deadline, path = heapq.heappop(_flush_heap)
+        if _flush_deadline.get(path) != deadline:
+            continue
+        del _flush_deadline[path]
+        if path not in _dirty_paths:
+            continue
+        # 積んだあとに保存された / 退避されたなどで予定が変わっていることがある
+        due = _flush_due_at(path, now)
+        if due > horizon:
+            _schedule_flush(path, due)
+            continue
+        paths.append(path)
+    return paths
+
+async def _aowned(paths: list, retry_at: float | None = None) -> list:
+    """paths のうちリースを持っている（取れた）もの。取れないものは retry_at に予定し直す"""
+    if not _shared():
+        return paths
+    owned = []
+    for path in paths:
+        if path not in _held:
+            if not await _aclaim_one(_coord, path):
+                # claimed() を通らずに書き換えられたもの。リースが取れるまで待つ
+                if retry_at is not None:
+                    _schedule_flush(path, retry_at)
+                continue
+            _held.add(path)
+        owned.append(path)
+    return owned
+
+def _cache_for_path(path: str):
+    key = os.path.splitext(os.path.basename(path))[0]
+    if "/users/" in path:
+        return _user_cache, key
+    if "/channels/" in path:
+        return _channel_cache, key
+    return None, key
+
+def _on_evict(path: str, obj: dict):
+    if path in _dirty_paths:
+        # まだ保存していないので、次のflushで書くまで退避しておく（メモリを空けたいのですぐ書く）
+        _evicted_dirty[path] = obj
+        _schedule_flush(path, _now())
+        return
+    _forget(path)
+    _release_idle([path])
+
+def _forget(path: str):
+    _last_flush.pop(path, None)
+    if _backend is not None:
+        _backend.forget(path)
 
 def _default_user_state(uid: str):
     return {
         "uid": uid,
         "nick": None,
-        "daily_counts": {},            # ymd -> count
+        "daily_counts": {},            # ymd -> count（直近 DAILY_COUNTS_KEEP_DAYS 日分）
+        "monthly_counts": {},          # "YYYY-MM" -> count（daily_counts から畳んだ古い日の合計）
         "kv": {},                      # key -> value(str)
+        "kv_t": {},                    # key -> 書いた時刻（保存が競合したときに新しい方を残す）
         "emotion": {"v": 0.0, "a": 0.0, "t": 0.0, "tag": "neutral"},
         "meta": {"version": 1, "last_saved": None},
     }
@@ -106,34 +345,114 @@ def _user_path(uid: str) -> str:
 def _channel_path(chid: str) -> str:
     return f"{GITHUB_PATH_BASE}/channels/{chid}.json"
 
+def _activity_path() -> str:
+    # 最終保存時刻の索引（batchモードのコミットに同梱する。warm-startの優先順位用）
+    return f"{GITHUB_PATH_BASE}/_activity.json"
+
+def _merge_activity(ours: dict, theirs: dict) -> dict:
+    # path ごとに新しい方の時刻を残し、新しい順に ACTIVITY_INDEX_MAX 件まで
+    merged = dict(theirs)
+    for path, ts in ours.items():
+        merged[path] = max(float(ts), float(merged.get(path, 0.0)))
+    return dict(sorted(merged.items(), key=lambda kv: kv[1], reverse=True)[:ACTIVITY_INDEX_MAX])
+
+def _dump_activity(activity: dict) -> str:
+    return json.dumps(activity, separators=(",", ":"))
+
+def _segment_dir(path: str) -> str:
+    # channels/{chid}.json の追記セグメントは channels/{chid}.d/{先頭seq}.jsonl
+    return path[:-len(".json")] + ".d"
+
+def _segment_path(path: str, first_seq: int) -> str:
+    return f"{_segment_dir(path)}/{first_seq:012d}.jsonl"
+
+def _dump_json(obj: dict) -> str:
+    obj.setdefault("meta", {})
+    obj["meta"]["last_saved"] = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=list)
+
+def _channel_fields_sig(obj: dict | None) -> str | None:
+    # メッセージ以外のフィールド（要約など）が変わったかの判定用
+    if obj is None:
+        return None
+    rest = {k: v for k, v in obj.items() if k not in ("messages", "seq", "meta")}
+    return json.dumps(rest, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=list)
+
+def _dump_jsonl(rows) -> str:
+    return "".join(json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n" for r in rows)
+
+def _git_url(suffix: str):
+    return f"{GITHUB_API}/repos/{GITHUB_REPO}/git/{suffix}"
+
+def _git_blob_sha(raw: str) -> str:
+    # Contents APIが返すshaと同じ（git blobのハッシュ）
+    data = raw.encode("utf-8")
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
 def _load_json_from_github(path: str, default_obj: dict):
     _ensure_env()
     status, payload = _gh_request("GET", _contents_url(path), None)
+    return _parse_loaded(path, default_obj, status, payload)
+
+async def _aload_json_from_github(path: str, default_obj: dict):
+    _ensure_env()
+    status, payload = await _agh_request("GET", _contents_url(path), None)
+    return _parse_loaded(path, default_obj, status, payload)
+
+def _parse_loaded(path: str, default_obj: dict, status: int, payload: dict):
     if status == 200 and "content" in payload:
         _sha_cache[path] = payload.get("sha")
         decoded = _b64_decode(payload["content"])
+        _set_base(path, decoded)
         try:
             return json.loads(decoded)
         except Exception:
             return default_obj
     if status == 404:
         _sha_cache[path] = None
+        _set_base(path, None)
         return default_obj
     raise RuntimeError(f"GitHub読み込み失敗: {path} HTTP {status} {payload}")
 
-def _save_json_to_github(path: str, obj: dict, force: bool = False):
-    _ensure_env()
-
-    # flush throttling
-    now = _now()
-    last = _last_flush.get(path, 0.0)
-    if (not force) and (now - last < MIN_FLUSH_INTERVAL_SEC):
+def _set_base(path: str, raw: str | None):
+    if _cache_for_path(path)[0] is not _user_cache:
         return
+    if raw is None:
+        _base_raw.pop(path, None)
+    else:
+        _base_raw[path] = raw
 
-    obj.setdefault("meta", {})
-    obj["meta"]["last_saved"] = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+def _merge_remote(path: str, ours: str, theirs: str) -> str:
+    """
+    他の書き手が先に書いたユーザー状態と手元を 3-way merge した raw（ユーザー以外・読めないものは手元のまま）
+    活動の索引は path ごとに新しい方を残す
+    """
+    if path == _activity_path():
+        try:
+            return _dump_activity(_merge_activity(json.loads(ours), json.loads(theirs)))
+        except Exception as e:
+            print("merge ERROR:", path, repr(e))
+            return ours
+    if _cache_for_path(path)[0] is not _user_cache:
+        return ours
+    try:
+        base = _base_raw.get(path)
+        merged = merge_user(json.loads(base) if base else None, json.loads(ours), json.loads(theirs))
+    except Exception as e:
+        print("merge ERROR:", path, repr(e))
+        return ours
+    MERGES.inc()
+    return _dump_json(merged)
+
+def _adopt_merged(obj: dict, sent: str, written: str):
+    """競合で取り込んだリモートの変更を手元の obj にも入れる（送ってから手元で変わった分はそのまま重ねる）"""
+    merged = merge_user(json.loads(sent), obj, json.loads(written))
+    obj.clear()
+    obj.update(merged)
 
-    raw = json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+def _put_raw_to_github(path: str, raw: str) -> str:
+    """書いた中身を返す（競合してリモートと merge したときは merge 後のもの）"""
+    _ensure_env()
     body = {
         "message": f"Update ruby memory: {path}",
         "content": _b64_encode(raw),
@@ -150,18 +469,20 @@ def _save_json_to_github(path: str, obj: dict, force: bool = False):
             new_sha = payload.get("content", {}).get("sha")
             if new_sha:
                 _sha_cache[path] = new_sha
-            _last_flush[path] = now
-            _dirty_paths.discard(path)
-            _dirty_since.pop(path, None)
-            return
+            _set_base(path, raw)
+            return raw
 
         if status == 409:
-            # refetch sha then retry
+            # 他の書き手が先に書いた: 中身ごと取り直して merge してから載せ直す
             st2, p2 = _gh_request("GET", _contents_url(path), None)
             if st2 == 200 and "sha" in p2:
                 _sha_cache[path] = p2["sha"]
                 body["sha"] = _sha_cache[path]
-                time.sleep(0.4)
+                if "content" in p2:
+                    theirs = _b64_decode(p2["content"])
+                    raw = _merge_remote(path, raw, theirs)
+                    body["content"] = _b64_encode(raw)
+                    _set_base(path, theirs)
                 continue
             if st2 == 404:
                 _sha_cache[path] = None
@@ -174,62 +495,959 @@ def _save_json_to_github(path: str, obj: dict, force: bool = False):
 
     raise RuntimeError(f"GitHub保存が競合で失敗しました: {path}")
 
-# ---------------- public API ----------------
-def init_db():
-    # 遅延ロード方式なので、環境変数チェックだけしておく
+def _batch_commit_flow(files: dict):
+    """
+    files: path -> raw json文字列
+    Git Data APIで tree を1つ作り、ブランチrefを1回だけ進める（1 flush = 1 commit）
+    blobは tree エントリの content で渡すので、ファイル数に関係なくリクエストは5回で済む
+
+    headが最後に自分で進めたものと違えば（他の書き手がいる）、ユーザー状態のうち
+    リモートで書き換わっていたものを取ってきて 3-way merge してから載せる
+
+    同期/非同期の両方から使うため、(method, url, body) を yield して
+    (status, payload) を send してもらうジェネレータになっている
+    戻り値: merge した path -> 書いた raw
+    """
+    global _last_head
+    files = dict(files)
+    merged = {}
+    message = f"Update ruby memory: {len(files)} files"
+
+    # refが先に進んでいたら(422/409) 最新のheadに載せ直して再試行
+    for _ in range(5):
+        status, ref = yield ("GET", _git_url(f"ref/heads/{GITHUB_BRANCH}"), None)
+        if status != 200:
+            raise RuntimeError(f"GitHub ref取得失敗: {GITHUB_BRANCH} HTTP {status} {ref}")
+        head = ref["object"]["sha"]
+
+        status, commit = yield ("GET", _git_url(f"commits/{head}"), None)
+        if status != 200:
+            raise RuntimeError(f"GitHub commit取得失敗: {head} HTTP {status} {commit}")
+
+        if head != _last_head:
+            remote = yield from _remote_changes_flow(commit["tree"]["sha"], files)
+            for path, (sha, theirs) in remote.items():
+                files[path] = merged[path] = _merge_remote(path, files[path], theirs)
+                _sha_cache[path] = sha
+                _set_base(path, theirs)
+
+        # raw が None のものは削除（畳んだセグメントなど）
+        tree = [
+            {"path": path, "mode": "100644", "type": "blob", "content": raw} if raw is not None
+            else {"path": path, "mode": "100644", "type": "blob", "sha": None}
+            for path, raw in sorted(files.items())
+        ]
+        status, new_tree = yield ("POST", _git_url("trees"), {
+            "base_tree": commit["tree"]["sha"],
+            "tree": tree,
+        })
+        if status != 201:
+            raise RuntimeError(f"GitHub tree作成失敗: HTTP {status} {new_tree}")
+
+        status, new_commit = yield ("POST", _git_url("commits"), {
+            "message": message,
+            "tree": new_tree["sha"],
+            "parents": [head],
+        })
+        if status != 201:
+            raise RuntimeError(f"GitHub commit作成失敗: HTTP {status} {new_commit}")
+
+        status, payload = yield ("PATCH", _git_url(f"refs/heads/{GITHUB_BRANCH}"), {
+            "sha": new_commit["sha"],
+            "force": False,
+        })
+        if status == 200:
+            _last_head = new_commit["sha"]
+            for path, raw in files.items():
+                if raw is None:
+                    _sha_cache.pop(path, None)
+                else:
+                    _sha_cache[path] = _git_blob_sha(raw)
+                    _set_base(path, raw)
+            return merged
+
+        if status in (409, 422):
+            continue
+
+        raise RuntimeError(f"GitHub ref更新失敗: HTTP {status} {payload}")
+
+    raise RuntimeError(f"GitHub一括保存が競合で失敗しました: {len(files)} files")
+
+def _remote_changes_flow(tree_sha: str, files: dict):
+    """files のユーザー状態と活動の索引のうち、最後に読んだ/書いたときからリモートで変わっているもの -> path -> (sha, raw)"""
+    users = [p for p, raw in files.items()
+             if raw is not None and (_cache_for_path(p)[0] is _user_cache or p == _activity_path())]
+    if not users:
+        return {}
+    status, tree = yield ("GET", _git_url(f"trees/{tree_sha}?recursive=1"), None)
+    if status != 200:
+        raise RuntimeError(f"GitHub tree取得失敗: {tree_sha} HTTP {status} {tree}")
+    remote = {e["path"]: e["sha"] for e in tree.get("tree", []) if e.get("type") == "blob"}
+    changed = {}
+    for path in users:
+        sha = remote.get(path)
+        if sha is None or sha == _sha_cache.get(path) or sha == _git_blob_sha(files[path]):
+            continue
+        status, blob = yield ("GET", _git_url(f"blobs/{sha}"), None)
+        if status != 200:
+            raise RuntimeError(f"GitHub blob取得失敗: {path} HTTP {status} {blob}")
+        changed[path] = (sha, _b64_decode(blob["content"]))
+    return changed
+
+def _drive(flow):
+    """*_flow ジェネレータを urllib で最後まで回して戻り値を返す"""
+    try:
+        req = next(flow)
+        while True:
+            req = flow.send(_gh_request(*req))
+    except StopIteration as e:
+        return e.value
+
+async def _adrive(flow):
+    """*_flow ジェネレータを aiohttp で最後まで回して戻り値を返す"""
+    try:
+        req = next(flow)
+        while True:
+            req = flow.send(await _agh_request(*req))
+    except StopIteration as e:
+        return e.value
+
+def _commit_batch_to_github(files: dict) -> dict:
     _ensure_env()
+    if not files:
+        return {}
+    return _drive(_batch_commit_flow(files))
 
-def flush(force: bool = False):
-    init_db()
-    # dirty全部を順に保存
+async def _acommit_batch_to_github(files: dict) -> dict:
+    _ensure_env()
+    if not files:
+        return {}
+    return await _adrive(_batch_commit_flow(files))
+
+def _segments_flow(path: str):
+    """チャンネルの追記セグメントを一覧して中身を取る。[(segment_path, raw), ...]（seq順）"""
+    status, listing = yield ("GET", _contents_url(_segment_dir(path)), None)
+    if status == 404:
+        return []
+    if status != 200 or not isinstance(listing, list):
+        raise RuntimeError(f"GitHubセグメント一覧失敗: {path} HTTP {status}")
+    segs = []
+    for e in sorted(listing, key=lambda e: e["name"]):
+        if not e["name"].endswith(".jsonl"):
+            continue
+        status, blob = yield ("GET", _git_url(f"blobs/{e['sha']}"), None)
+        if status != 200:
+            raise RuntimeError(f"GitHubセグメント取得失敗: {e['path']} HTTP {status}")
+        segs.append((e["path"], _b64_decode(blob["content"])))
+    return segs
+
+def _due_paths(force: bool) -> list:
+    now = _now()
+    due = []
     for path in list(_dirty_paths):
-        # 強制 or 汚れっぱなしが長いなら保存
-        if force:
-            _save_json_to_github(path, _obj_for_path(path), force=True)
+        since = _dirty_since.get(path, 0.0)
+        last = _last_flush.get(path, 0.0)
+        # 強制 / 前回保存から間隔が空いた / 汚れっぱなしが長い
+        if force or path in _evicted_dirty or (now - last >= MIN_FLUSH_INTERVAL_SEC) or (since and now - since >= FORCE_FLUSH_AFTER_DIRTY_SEC):
+            due.append(path)
+    return due
+
+# ---------------- storage backends ----------------
+class GitHubBackend:
+    """
+    GitHub Contents / Git Data API に保存する（従来の方式）
+    load() は未保存なら None を返す。save() は path -> obj をまとめて書く
+    """
+    name = "github"
+
+    def __init__(self):
+        self._activity = {}   # path -> 最後に保存した時刻
+        self._activity_gen = 0          # _activity を変えるたびに増える
+        self._activity_written = 0      # 最後に書けた _activity_gen（同じなら書かない）
+        self._activity_saved_at = _now()
+        # channel path -> {"seq": 保存済みの最大seq, "files": [segment path], "snapshot": bool,
+        #                  "fields": スナップショットにあるメッセージ以外のフィールド}
+        self._segments = {}
+
+    def check(self):
+        _ensure_env()
+
+    def load(self, path: str):
+        obj = _load_json_from_github(path, None)
+        if _cache_for_path(path)[0] is _channel_cache:
+            return self._assemble_channel(path, obj, _drive(_segments_flow(path)))
+        return obj
+
+    async def aload(self, path: str):
+        obj = await _aload_json_from_github(path, None)
+        if _cache_for_path(path)[0] is _channel_cache:
+            return self._assemble_channel(path, obj, await _adrive(_segments_flow(path)))
+        return obj
+
+    def _assemble_channel(self, path: str, snapshot: dict | None, segs: list):
+        """スナップショットの後ろに追記セグメントを seq 順に重ねる（スナップショットより古い行は捨てる）"""
+        self._segments[path] = {"seq": 0, "files": [p for p, _ in segs], "snapshot": snapshot is not None,
+                                "fields": _channel_fields_sig(snapshot)}
+        if snapshot is None and not segs:
+            return None
+        obj = snapshot if snapshot is not None else _default_channel_state(_cache_for_path(path)[1])
+        msgs = list(obj.get("messages", []))
+        seq = int(obj.get("seq", len(msgs)))
+        for seg_path, raw in segs:
+            first = int(os.path.basename(seg_path).split(".")[0])
+            for i, line in enumerate(l for l in raw.splitlines() if l.strip()):
+                if first + i <= seq:
+                    continue
+                msgs.append(json.loads(line))
+                seq = first + i
+        obj["messages"] = msgs[-MAX_MSG_PER_CHANNEL:]
+        obj["seq"] = seq
+        self._segments[path]["seq"] = seq
+        return obj
+
+    def _channel_files(self, path: str, obj: dict, files: dict, staged: dict):
+        """
+        batchモードのチャンネル保存: 新しいメッセージだけを1セグメントとして書く
+        初回 / セグメントが溜まった / 追いきれない差分 のときはスナップショットに畳んでセグメントを消す
+        """
+        state = self._segments.get(path)
+        msgs = obj.get("messages", [])
+        seq = int(obj.get("seq", len(msgs)))
+        fields = _channel_fields_sig(obj)
+        # 要約などメッセージ以外が変わったときもスナップショットに畳む（セグメントはメッセージしか持てない）
+        if (state is None or not state["snapshot"] or len(state["files"]) >= CHANNEL_COMPACT_SEGMENTS
+                or seq - state["seq"] > len(msgs) or fields != state.get("fields")):
+            files[path] = _dump_json(obj)
+            for seg_path in (state or {}).get("files", []):
+                files[seg_path] = None
+            staged[path] = {"seq": seq, "files": [], "snapshot": True, "fields": fields}
+            return
+        n_new = seq - state["seq"]
+        if n_new <= 0:
+            return
+        seg_path = _segment_path(path, state["seq"] + 1)
+        files[seg_path] = _dump_jsonl(itertools.islice(msgs, len(msgs) - n_new, None))
+        staged[path] = {"seq": seq, "files": state["files"] + [seg_path], "snapshot": True, "fields": fields}
+
+    def _files(self, docs: dict) -> tuple:
+        files = {}
+        staged = {}
+        batch = GITHUB_FLUSH_MODE == "batch"
+        for path, obj in docs.items():
+            if batch and _cache_for_path(path)[0] is _channel_cache:
+                self._channel_files(path, obj, files, staged)
+            else:
+                files[path] = _dump_json(obj)
+        if files and batch:
+            now = _now()
+            for path in docs:
+                self._activity[path] = now
+            self._activity_gen += 1
+            # 索引は大きいので毎回は載せない（間隔が空いたときだけ相乗りさせる）
+            if now - self._activity_saved_at >= ACTIVITY_INDEX_INTERVAL_SEC:
+                self._stage_activity(files, staged)
+        return files, staged
+
+    def _stage_activity(self, files: dict, staged: dict):
+        self._activity = _merge_activity(self._activity, {})
+        files[_activity_path()] = _dump_activity(self._activity)
+        staged[_activity_path()] = self._activity_gen
+
+    def _commit_staged(self, staged: dict):
+        gen = staged.pop(_activity_path(), None)
+        if gen is not None:
+            self._activity_written = max(self._activity_written, gen)
+            self._activity_saved_at = _now()
+        self._segments.update(staged)
+
+    def _put_files(self, files: dict) -> dict:
+        """merge した path -> 書いた raw"""
+        if GITHUB_FLUSH_MODE == "batch":
+            return _commit_batch_to_github(files)
+        merged = {}
+        for path, raw in files.items():
+            written = _put_raw_to_github(path, raw)
+            if written != raw:
+                merged[path] = written
+        return merged
+
+    def _adopt_merged(self, docs: dict, files: dict, merged: dict):
+        for path, written in merged.items():
+            if path == _activity_path():
+                # 他のプロセスの索引を取り込んだもの（送ってから手元で増えた分も残す）
+                self._activity = _merge_activity(self._activity, json.loads(written))
+                continue
+            _adopt_merged(docs[path], files[path], written)
+
+    def save(self, docs: dict):
+        files, staged = self._files(docs)
+        self._adopt_merged(docs, files, self._put_files(files))
+        self._commit_staged(staged)
+
+    async def asave(self, docs: dict):
+        # 直列化はここで済ませる（await中の変更は次回のflushに回る）
+        files, staged = self._files(docs)
+        if GITHUB_FLUSH_MODE == "batch":
+            merged = await _acommit_batch_to_github(files)
         else:
-            since = _dirty_since.get(path, 0.0)
-            if (_now() - since) >= FORCE_FLUSH_AFTER_DIRTY_SEC:
-                _save_json_to_github(path, _obj_for_path(path), force=True)
+            # 旧方式(contents)は同期実装をスレッドで
+            merged = await asyncio.to_thread(self._put_files, files)
+        # 競合で取り込んだ変更は手元にも入れる（await中の手元の変更はそのまま重なる）
+        self._adopt_merged(docs, files, merged)
+        self._commit_staged(staged)
+
+    async def aflush_index(self):
+        """まだ書いていない索引の変更を書く（終了時に呼ぶ）"""
+        if GITHUB_FLUSH_MODE != "batch" or self._activity_gen == self._activity_written:
+            return
+        files, staged = {}, {}
+        self._stage_activity(files, staged)
+        self._adopt_merged({}, files, await _acommit_batch_to_github(files))
+        self._commit_staged(staged)
+
+    def forget(self, path: str):
+        # 次に読み込むときにshaも取り直す
+        _sha_cache.pop(path, None)
+        _base_raw.pop(path, None)
+        self._segments.pop(path, None)
+
+    async def _afetch_blob(self, sha: str) -> str:
+        status, payload = await _agh_request("GET", _git_url(f"blobs/{sha}"))
+        if status != 200:
+            raise RuntimeError(f"GitHub blob取得失敗: {sha} HTTP {status} {payload}")
+        return _b64_decode(payload["content"])
+
+    async def awarm(self, limit: int, concurrency: int) -> list:
+        """
+        ブランチのtreeを1回で一覧して、最近保存されたものから limit 件を並列に取ってくる
+        戻り値: [(path, obj, bytes), ...]（新しい順）
+        """
+        _ensure_env()
+        status, tree = await _agh_request("GET", _git_url(f"trees/{GITHUB_BRANCH}?recursive=1"))
+        if status != 200:
+            raise RuntimeError(f"GitHub tree取得失敗: {GITHUB_BRANCH} HTTP {status} {tree}")
+        prefix = f"{GITHUB_PATH_BASE}/"
+        blobs = {
+            e["path"]: e["sha"] for e in tree.get("tree", [])
+            if e.get("type") == "blob" and e["path"].startswith(prefix)
+        }
+
+        index_sha = blobs.pop(_activity_path(), None)
+        if index_sha:
+            try:
+                self._activity = _merge_activity(self._activity, json.loads(await self._afetch_blob(index_sha)))
+                # 次に書くときは、ここから変わっていなければ取り直さずに上書きできる
+                _sha_cache[_activity_path()] = index_sha
+            except Exception as e:
+                print("warm-start: activity index ERROR:", e)
+
+        candidates = [p for p in blobs if _cache_for_path(p)[0] is not None and p.endswith(".json")]
+        candidates.sort(key=lambda p: self._activity.get(p, 0.0), reverse=True)
+        picked = candidates[:limit]
+        seg_files = {
+            path: sorted(p for p in blobs if p.startswith(_segment_dir(path) + "/") and p.endswith(".jsonl"))
+            for path in picked if _cache_for_path(path)[0] is _channel_cache
+        }
+
+        sem = asyncio.Semaphore(max(1, concurrency))
+
+        async def fetch(path):
+            async with sem:
+                return path, await self._afetch_blob(blobs[path])
+
+        wanted = picked + [p for segs in seg_files.values() for p in segs]
+        raws = dict(await asyncio.gather(*(fetch(p) for p in wanted)))
+
+        out = []
+        for path in picked:
+            raw = raws[path]
+            try:
+                obj = json.loads(raw)
+            except Exception:
+                continue
+            _sha_cache[path] = blobs[path]
+            _set_base(path, raw)
+            size = len(raw.encode("utf-8"))
+            if path in seg_files:
+                segs = [(p, raws[p]) for p in seg_files[path]]
+                obj = self._assemble_channel(path, obj, segs)
+                size += sum(len(r.encode("utf-8")) for _, r in segs)
+            out.append((path, obj, size))
+        return out
+
+    def close(self):
+        pass
+
+
+class MirroredBackend:
+    """
+    primary に保存しつつ、backup(GitHub) へ interval 秒ごとにまとめてエクスポートする
+    primary に無いデータは backup から読み込んで primary に取り込む（移行用）
+    """
+
+    def __init__(self, primary, backup, interval: float):
+        self.primary = primary
+        self.backup = backup
+        self.interval = interval
+        self.name = f"{primary.name}+{backup.name}"
+        self._pending = {}        # path -> obj（バックアップ待ち）
+        self._last_backup = _now()
+
+    def check(self):
+        self.primary.check()
+        self.backup.check()
+
+    def load(self, path: str):
+        obj = self.primary.load(path)
+        if obj is None:
+            obj = self.backup.load(path)
+            if obj is not None:
+                self.primary.save({path: obj})
+        return obj
+
+    async def aload(self, path: str):
+        obj = await self.primary.aload(path)
+        if obj is None:
+            obj = await self.backup.aload(path)
+            if obj is not None:
+                await self.primary.asave({path: obj})
+        return obj
+
+    def _backup_due(self, docs: dict) -> bool:
+        self._pending.update(docs)
+        return bool(self._pending) and (_now() - self._last_backup >= self.interval)
+
+    def save(self, docs: dict):
+        self.primary.save(docs)
+        if self._backup_due(docs):
+            pending, self._pending = self._pending, {}
+            try:
+                self.backup.save(pending)
+                self._last_backup = _now()
+            except Exception as e:
+                # バックアップ失敗は本体の保存を止めない
+                print("backup ERROR:", e)
+                self._pending = {**pending, **self._pending}
+
+    async def asave(self, docs: dict):
+        await self.primary.asave(docs)
+        if self._backup_due(docs):
+            pending, self._pending = self._pending, {}
+            try:
+                await self.backup.asave(pending)
+                self._last_backup = _now()
+            except Exception as e:
+                print("backup ERROR:", e)
+                self._pending = {**pending, **self._pending}
+
+    async def awarm(self, limit: int, concurrency: int) -> list:
+        return await self.primary.awarm(limit, concurrency)
+
+    async def aflush_index(self):
+        await self.primary.aflush_index()
+        await self.backup.aflush_index()
+
+    def forget(self, path: str):
+        self.primary.forget(path)
+        if path not in self._pending:
+            self.backup.forget(path)
+
+    def close(self):
+        self.primary.close()
+        self.backup.close()
+
+
+def _make_backend():
+    if MEMORY_BACKEND == "github":
+        backend = GitHubBackend()
+    elif MEMORY_BACKEND == "sqlite":
+        from sqlite_backend import SQLiteBackend
+        backend = SQLiteBackend(MEMORY_SQLITE_PATH, max_messages=MAX_MSG_PER_CHANNEL, path_base=GITHUB_PATH_BASE)
+    else:
+        raise RuntimeError(f"未知の MEMORY_BACKEND: {MEMORY_BACKEND}")
+    if MEMORY_BACKUP == "github" and backend.name != "github":
+        backend = MirroredBackend(backend, GitHubBackend(), MEMORY_BACKUP_INTERVAL_SEC)
+    return backend
+
+def _get_backend():
+    global _backend
+    if _backend is None:
+        _backend = _make_backend()
+    return _backend
+
+def _take_dirty(paths: list) -> tuple:
+    # 先にdirtyを外してから保存する（保存中の変更は次回のflushに回る）
+    since = {}
+    docs = {}
+    for path in paths:
+        since[path] = _dirty_since.pop(path, None)
+        _dirty_paths.discard(path)
+        _flush_deadline.pop(path, None)
+        _flush_urgent.discard(path)
+        docs[path] = _obj_for_path(path)
+    return docs, since
+
+def _restore_dirty(since: dict, retry_at: float | None = None):
+    for path, ts in since.items():
+        _dirty_paths.add(path)
+        if ts is not None:
+            _dirty_since[path] = min(ts, _dirty_since.get(path, ts))
+        _schedule_flush(path, retry_at)
+
+def _mark_flushed(paths):
+    now = _now()
+    for path in paths:
+        _last_flush[path] = now
+        # 退避していたものは書けたので手放す（保存中にまた汚れたものは次回）
+        if path in _evicted_dirty and path not in _dirty_paths:
+            del _evicted_dirty[path]
+            _forget(path)
+    # 他のプロセスに読み直させてから、手の空いたリースを返す（調整役への書き込みは呼び出し側で）
+    _release_idle(paths)
+
+# ---------------- multi-process ----------------
+class ClaimTimeout(RuntimeError):
+    pass
+
+def _make_coordinator():
+    if COORDINATOR == "local":
+        return LocalCoordinator(COORD_NODE_ID)
+    if COORDINATOR == "sqlite":
+        return SQLiteCoordinator(COORD_SQLITE_PATH, COORD_NODE_ID)
+    raise RuntimeError(f"未知の COORDINATOR: {COORDINATOR}")
+
+def _get_coordinator():
+    global _coord
+    if _coord is None:
+        _coord = _make_coordinator()
+    return _coord
+
+def _shared() -> bool:
+    return _get_coordinator().name != "local"
+
+def _owns(path: str) -> bool:
+    # 同期API（flush() など、イベントループの外）用。ループの中では _aowned() を使う
+    if path in _held or not _shared():
+        return True
+    _to_release.discard(path)
+    if _coord.claim(path, COORD_LEASE_SEC):
+        _held.add(path)
+        return True
+    return False
+
+def _release_idle(paths):
+    """保存済みで使っていないリースを返す予定にする（I/Oなし。返すのは _arelease / _release_now）"""
+    idle = [p for p in paths if p in _held and p not in _dirty_paths and not _pins.get(p)]
+    if not idle:
+        return
+    _held.difference_update(idle)
+    _to_release.update(idle)
+    _flush_wakeup.set()
+
+def _take_release() -> list:
+    # _lease_lock の中で呼ぶ。返す前にまた取ったものは外す
+    paths = [p for p in _to_release if p not in _held]
+    _to_release.clear()
+    return paths
+
+async def _arelease():
+    if _coord is None or not _to_release:
+        return
+    async with _lease_lock:
+        paths = _take_release()
+        if paths:
+            await asyncio.to_thread(_coord.release, paths)
+
+def _release_now():
+    if _coord is not None and _to_release:
+        _coord.release(_take_release())
+
+def _apply_invalidations(paths):
+    """他のプロセスが保存した path のキャッシュを捨てる（次に使うときに読み直す）"""
+    for path in paths:
+        if path in _dirty_paths:
+            # リースを持たずに書き換えたときだけ起きる。こちらの変更を優先する
+            print("coordination: 未保存の変更があるので読み直しません:", path)
+            continue
+        cache, key = _cache_for_path(path)
+        if cache is not None:
+            cache.pop(key)
+        _forget(path)
+
+async def _aclaim_one(coord, path: str) -> bool:
+    async with _lease_lock:
+        _to_release.discard(path)
+        return await asyncio.to_thread(coord.claim, path, COORD_LEASE_SEC)
+
+async def _aclaim(paths: list):
+    coord = _get_coordinator()
+    deadline = time.monotonic() + COORD_CLAIM_TIMEOUT_SEC
+    for path in paths:
+        if path in _held:
+            continue
+        delay = 0.02
+        while not await _aclaim_one(coord, path):
+            # 持ち主に早めに保存・解放してもらう（待っている間は印を更新し続ける）
+            await asyncio.to_thread(coord.want, path)
+            if time.monotonic() >= deadline:
+                raise ClaimTimeout(f"リースが取れません: {path}")
+            await asyncio.sleep(delay)
+            delay = min(0.25, delay * 2)
+        _held.add(path)
+    _apply_invalidations(await asyncio.to_thread(coord.poll))
+
+@asynccontextmanager
+async def claimed(uid: str | None = None, chid: str | None = None):
+    """
+    このプロセスだけが uid / chid の記憶を書き換えられるようにする（COORDINATOR=local なら何もしない）
+        async with memory_store.claimed(uid=uid, chid=ch_id):
+            await memory_store.aget_user(uid) ...
+    他のプロセスが持っていたら空くまで待つ（COORD_CLAIM_TIMEOUT_SEC で ClaimTimeout）
+    """
+    if not _shared():
+        yield
+        return
+    paths = ([_user_path(str(uid))] if uid is not None else []) + \
+            ([_channel_path(str(chid))] if chid is not None else [])
+    for p in paths:
+        _pins[p] = _pins.get(p, 0) + 1
+    try:
+        await _aclaim(paths)
+        yield
+    finally:
+        for p in paths:
+            n = _pins.get(p, 0) - 1
+            if n > 0:
+                _pins[p] = n
             else:
-                _save_json_to_github(path, _obj_for_path(path), force=False)
+                _pins.pop(p, None)
+        _release_idle(paths)
+        await _arelease()
+
+async def claim_once(key: str) -> bool:
+    """
+    どれか1つのプロセスだけが扱うもの（全プロセスに届くDMなど）の取り合い。取れたら True（COORDINATOR=local なら常に True）
+    印は COORD_MESSAGE_TTL_SEC で消えるまで返さない（後から来たプロセスが同じものをもう一度扱わないように）
+    """
+    if not _shared():
+        return True
+    return await asyncio.to_thread(_coord.claim, f"once:{key}", COORD_MESSAGE_TTL_SEC)
+
+async def _coordinate():
+    """リースの延長と、他のプロセスが待っている path の早出し・手の空いたリースの返却（flush タスクから呼ぶ）"""
+    global _coord_renewed
+    await _arelease()
+    if _coord is None or not _held:
+        return
+    held = list(_held)
+    now = time.monotonic()
+    if now - _coord_renewed >= COORD_LEASE_SEC / 3:
+        _coord_renewed = now
+        await asyncio.to_thread(_coord.renew, held, COORD_LEASE_SEC)
+    for path in await asyncio.to_thread(_coord.wanted, held):
+        if path in _dirty_paths:
+            _flush_urgent.add(path)
+            _schedule_flush(path, _now())
+        else:
+            _release_idle([path])
+    await _arelease()
+
+def coordination_stats() -> dict:
+    return {"coordinator": _get_coordinator().name, "node": _coord.node_id, "held": len(_held),
+            "pinned": len(_pins), "urgent": len(_flush_urgent)}
+
+def _write_paths(paths: list):
+    if not paths:
+        return
+    docs, since = _take_dirty(paths)
+    started = time.perf_counter()
+    try:
+        _get_backend().save(docs)
+    except Exception:
+        _restore_dirty(since)
+        raise
+    finally:
+        FLUSH_LATENCY.observe(time.perf_counter() - started, backend=MEMORY_BACKEND)
+    _mark_flushed(paths)
+    if _coord is not None:
+        _coord.publish(paths)
+        _release_now()
+
+async def _awrite_paths(paths: list):
+    if not paths:
+        return
+    docs, since = _take_dirty(paths)
+    started = time.perf_counter()
+    try:
+        await _get_backend().asave(docs)
+    except BaseException:
+        # キャンセル（終了時）でも dirty に戻して、最後の flush で書けるようにする
+        _restore_dirty(since, _now() + max(1.0, _flush_backoff))
+        raise
+    finally:
+        FLUSH_LATENCY.observe(time.perf_counter() - started, backend=MEMORY_BACKEND)
+    _mark_flushed(paths)
+    if _coord is not None:
+        await asyncio.to_thread(_coord.publish, paths)
+        await _arelease()
+
+# ---------------- public API ----------------
+def init_db():
+    # 遅延ロード方式なので、バックエンドの準備（GitHubなら環境変数チェック）だけしておく
+    _get_backend().check()
+    _get_coordinator()
+
+def flush(force: bool = False):
+    init_db()
+    # 保存対象をまとめて書く（batchなら1コミット）。リースが取れないものは持ち主に任せる
+    _write_paths([p for p in _due_paths(force) if _owns(p)])
 
 def maybe_flush():
     init_db()
-    for path in list(_dirty_paths):
-        since = _dirty_since.get(path, 0.0)
-        last = _last_flush.get(path, 0.0)
+    _write_paths([p for p in _due_paths(False) if _owns(p)])
+
+async def aflush(force: bool = False):
+    init_db()
+    async with _flush_lock:
+        await _awrite_paths(await _aowned(_due_paths(force)))
+
+async def _wait_flush_wakeup(timeout: float):
+    try:
+        await asyncio.wait_for(_flush_wakeup.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    _flush_wakeup.clear()
+
+async def _flush_loop(interval: float):
+    """
+    deadline の一番早いパスまで寝て、その時点で期限の来ているパスをまとめて1回で書く
+    書き込みが遅い / 失敗したら間をあけ（その間に来た変更は次の1回にまとまる）、速ければ間を縮める
+    """
+    global _flush_backoff
+    next_sweep = time.monotonic() + interval
+    while True:
+        timeout = interval
+        if _flush_heap:
+            timeout = min(interval, max(0.0, _flush_heap[0][0] - _now()))
+        if _held:
+            timeout = min(timeout, COORD_POLL_SEC)
+        await _wait_flush_wakeup(timeout)
+        try:
+            await _coordinate()
+        except Exception as e:
+            print("coordination ERROR:", e)
+
+        if time.monotonic() >= next_sweep:
+            next_sweep = time.monotonic() + interval
+            sweep_caches()
+
         now = _now()
-        if now - last >= MIN_FLUSH_INTERVAL_SEC:
-            _save_json_to_github(path, _obj_for_path(path), force=False)
-        elif since and (now - since >= FORCE_FLUSH_AFTER_DIRTY_SEC):
-            _save_json_to_github(path, _obj_for_path(path), force=True)
+        paths = await _aowned(_pop_due_flushes(now), now + 1.0)
+        if not paths:
+            continue
+        started = time.monotonic()
+        try:
+            async with _flush_lock:
+                await _awrite_paths(paths)
+        except Exception as e:
+            print("flush ERROR:", e)
+            slow = True
+        else:
+            slow = time.monotonic() - started >= FLUSH_SLOW_SEC
+        if slow:
+            _flush_backoff = min(FLUSH_BACKOFF_MAX_SEC, max(1.0, _flush_backoff * 2))
+        else:
+            _flush_backoff = _flush_backoff / 2 if _flush_backoff >= 1.0 else 0.0
+        if _flush_backoff:
+            await asyncio.sleep(_flush_backoff)
+
+def start_flush_task(interval: float = 10.0):
+    """メッセージ処理とは別に、バックグラウンドの1タスクだけが書く（interval はキャッシュ掃除の間隔も兼ねる）"""
+    global _flush_task
+    if _flush_task is None or _flush_task.done():
+        # すでに dirty なものも予定に載せる
+        for path in list(_dirty_paths):
+            _schedule_flush(path)
+        _flush_task = asyncio.get_running_loop().create_task(_flush_loop(interval))
+    return _flush_task
+
+def flush_stats() -> dict:
+    return {
+        "dirty_paths": len(_dirty_paths),
+        "scheduled": len(_flush_deadline),
+        "next_in_sec": max(0.0, min(_flush_deadline.values()) - _now()) if _flush_deadline else None,
+        "backoff_sec": _flush_backoff,
+    }
+
+@atexit.register
+def _flush_at_exit():
+    # close() を通らずに終わったとき（例外で落ちたなど）の最後の砦。書けなければ諦める
+    if not _dirty_paths or _backend is None:
+        return
+    try:
+        # リースが取れないものは、持っているプロセスの書き込みに任せる
+        _write_paths([p for p in _dirty_paths if _owns(p)])
+    except Exception as e:
+        print("final flush ERROR:", e)
+
+async def close(final_flush: bool = True):
+    global _flush_task, _session, _coord
+    if _flush_task is not None:
+        # 書き込み中ならキャンセルで dirty に戻るので、終わるのを待ってから最後の flush をする
+        _flush_task.cancel()
+        await asyncio.gather(_flush_task, return_exceptions=True)
+        _flush_task = None
+    try:
+        if final_flush and _dirty_paths:
+            await aflush(force=True)
+        if final_flush and _backend is not None:
+            await _backend.aflush_index()
+    finally:
+        if _coord is not None:
+            # 残っているリースは close() で全部返す
+            _held.clear()
+            _to_release.clear()
+            await asyncio.to_thread(_coord.close)
+            _coord = None
+        if _backend is not None:
+            _backend.close()
+        if _session is not None:
+            await _session.close()
+            _session = None
+
+async def warm_start(limit: int | None = None, concurrency: int | None = None) -> dict:
+    """
+    最近アクティブだったユーザー/チャンネルを先にキャッシュへ載せる（再起動直後の初回応答を速くする）
+    所要時間と読み込んだバイト数を返す
+    """
+    init_db()
+    limit = WARM_START_FILES if limit is None else int(limit)
+    concurrency = WARM_START_CONCURRENCY if concurrency is None else int(concurrency)
+    t0 = time.perf_counter()
+    loaded = await _get_backend().awarm(limit, concurrency) if limit > 0 else []
+
+    files = nbytes = 0
+    # 古い順に入れて、一番新しいものがLRUの末尾に来るようにする
+    for path, obj, size in reversed(loaded):
+        cache, key = _cache_for_path(path)
+        if cache is None or key in cache or path in _evicted_dirty:
+            continue
+        cache[key] = _adopt(path, obj)
+        files += 1
+        nbytes += size
+
+    stats = {"files": files, "bytes": nbytes, "sec": round(time.perf_counter() - t0, 3)}
+    print(f"warm-start: {files} files / {nbytes} bytes in {stats['sec']}s")
+    return stats
+
+def sweep_caches() -> int:
+    """アイドルTTLを過ぎたキャッシュを落とす（dirtyなものは退避して次のflushで書く）"""
+    return _user_cache.sweep() + _channel_cache.sweep()
+
+def cache_stats() -> dict:
+    return {
+        "users": _user_cache.stats(),
+        "channels": _channel_cache.stats(),
+        "evicted_dirty": len(_evicted_dirty),
+        "dirty_paths": len(_dirty_paths),
+    }
+
+# /metrics 用（読むたびに今の値を取る）
+def _cache_gauges(field: str):
+    caches = {"users": _user_cache, "channels": _channel_cache}
+    return lambda: {(name,): cache.stats()[field] for name, cache in caches.items()}
+
+REGISTRY.gauge("ruby_memory_cache_entries", "Entries in the memory caches", _cache_gauges("entries"), ("cache",))
+REGISTRY.gauge("ruby_memory_cache_bytes", "Estimated bytes in the memory caches", _cache_gauges("bytes"), ("cache",))
+REGISTRY.gauge("ruby_memory_cache_hits_total", "Memory cache hits", _cache_gauges("hits"), ("cache",), kind="counter")
+REGISTRY.gauge("ruby_memory_cache_misses_total", "Memory cache misses", _cache_gauges("misses"), ("cache",), kind="counter")
+REGISTRY.gauge("ruby_memory_cache_evictions_total", "Memory cache evictions", _cache_gauges("evictions"), ("cache",),
+               kind="counter")
+REGISTRY.gauge("ruby_memory_dirty_paths", "Paths waiting to be flushed", lambda: len(_dirty_paths))
+REGISTRY.gauge("ruby_memory_evicted_dirty", "Unsaved objects evicted from the caches", lambda: len(_evicted_dirty))
+REGISTRY.gauge("ruby_memory_flush_backoff_seconds", "Pause between writes while the backend is slow",
+               lambda: _flush_backoff)
 
 def _obj_for_path(path: str) -> dict:
     # pathからどのキャッシュか判定
-    if "/users/" in path:
-        uid = os.path.splitext(os.path.basename(path))[0]
-        return _user_cache.get(uid) or _default_user_state(uid)
-    if "/channels/" in path:
-        chid = os.path.splitext(os.path.basename(path))[0]
-        return _channel_cache.get(chid) or _default_channel_state(chid)
+    if path in _evicted_dirty:
+        return _evicted_dirty[path]
+    cache, key = _cache_for_path(path)
+    if cache is _user_cache:
+        return cache.peek(key) or _default_user_state(key)
+    if cache is _channel_cache:
+        return cache.peek(key) or _default_channel_state(key)
     return {}
 
+def _cached(cache: BoundedCache, key: str, path: str):
+    obj = cache.get(key)
+    if obj is None and path in _evicted_dirty:
+        # 保存前に追い出されたものは読み直さずにそのまま戻す
+        obj = _evicted_dirty.pop(path)
+        cache[key] = obj
+    return obj
+
+def _adopt(path: str, obj: dict) -> dict:
+    # 読み込んだものをメモリ上の形に整える（チャンネル履歴は固定長のリングにする）
+    cache = _cache_for_path(path)[0]
+    if cache is _channel_cache:
+        obj["messages"] = deque(obj.get("messages", []), maxlen=MAX_MSG_PER_CHANNEL)
+    elif cache is _user_cache:
+        # 日ごとの回数をずっと持っていた古いファイルもここで畳む（次に保存するときに小さくなる）
+        _compact_counts(obj)
+    return obj
+
+def _load(path: str, default_obj: dict) -> dict:
+    obj = _get_backend().load(path)
+    return _adopt(path, default_obj if obj is None else obj)
+
+async def _aload(path: str, default_obj: dict) -> dict:
+    obj = await _get_backend().aload(path)
+    return _adopt(path, default_obj if obj is None else obj)
+
 def _get_user(uid: str) -> dict:
     uid = str(uid)
-    if uid not in _user_cache:
-        _user_cache[uid] = _load_json_from_github(_user_path(uid), _default_user_state(uid))
-    return _user_cache[uid]
+    path = _user_path(uid)
+    obj = _cached(_user_cache, uid, path)
+    if obj is None:
+        obj = _user_cache.setdefault(uid, _load(path, _default_user_state(uid)))
+    return obj
 
 def _get_channel(chid: str) -> dict:
     chid = str(chid)
-    if chid not in _channel_cache:
-        _channel_cache[chid] = _load_json_from_github(_channel_path(chid), _default_channel_state(chid))
-    return _channel_cache[chid]
+    path = _channel_path(chid)
+    obj = _cached(_channel_cache, chid, path)
+    if obj is None:
+        obj = _channel_cache.setdefault(chid, _load(path, _default_channel_state(chid)))
+    return obj
+
+async def _aget_cached(cache: BoundedCache, key: str, path: str, default_obj: dict) -> dict:
+    obj = _cached(cache, key, path)
+    if obj is not None:
+        return obj
+    task = _inflight.get(path)
+    if task is None:
+        task = asyncio.ensure_future(_aload(path, default_obj))
+        _inflight[path] = task
+        task.add_done_callback(lambda _t: _inflight.pop(path, None))
+    obj = await asyncio.shield(task)
+    # 待っている間に同期側で読まれていたらそちらを優先
+    return cache.setdefault(key, obj)
+
+async def aget_user(uid: str) -> dict:
+    """イベントループを止めずにユーザー状態をキャッシュへ載せる"""
+    uid = str(uid)
+    return await _aget_cached(_user_cache, uid, _user_path(uid), _default_user_state(uid))
+
+async def aget_channel(chid: str) -> dict:
+    chid = str(chid)
+    return await _aget_cached(_channel_cache, chid, _channel_path(chid), _default_channel_state(chid))
 
 # ---------- Nickname ----------
 def set_nickname(user_id: str, nickname: str):
     u = _get_user(user_id)
     u["nick"] = nickname
+    u["nick_t"] = _now()
     _mark_dirty(_user_path(str(user_id)))
 
 def get_nickname(user_id: str):
@@ -241,28 +1459,68 @@ def get_daily_count(user_id: str, ymd: str):
     u = _get_user(user_id)
     return int(u.get("daily_counts", {}).get(str(ymd), 0))
 
-def increment_daily_count(user_id: str, ymd: str):
+def increment_daily_count(user_id: str, ymd: str, n: int = 1):
     u = _get_user(user_id)
     dc = u.setdefault("daily_counts", {})
     key = str(ymd)
-    dc[key] = int(dc.get(key, 0)) + 1
+    new_day = key not in dc
+    dc[key] = int(dc.get(key, 0)) + int(n)
+    if new_day:
+        _compact_counts(u)
     _mark_dirty(_user_path(str(user_id)))
 
+def _compact_counts(u: dict):
+    """daily_counts を新しい方から DAILY_COUNTS_KEEP_DAYS 日分にし、あふれた日は月ごとの合計に足す"""
+    dc = u.get("daily_counts") or {}
+    if len(dc) <= DAILY_COUNTS_KEEP_DAYS:
+        return
+    days = sorted(dc)
+    mc = u.setdefault("monthly_counts", {})
+    for d in days[:len(days) - DAILY_COUNTS_KEEP_DAYS]:
+        ym = d[:7]
+        mc[ym] = int(mc.get(ym, 0)) + int(dc.pop(d))
+    for ym in sorted(mc)[:-MONTHLY_COUNTS_KEEP or None]:
+        del mc[ym]
+
 # ---------- Channel messages ----------
 def add_channel_message(channel_id: str, author_id: str, content: str):
     ch = _get_channel(channel_id)
-    arr = ch.setdefault("messages", [])
-    arr.append({"a": str(author_id), "c": str(content), "t": int(_now())})
-    if len(arr) > MAX_MSG_PER_CHANNEL:
-        ch["messages"] = arr[-MAX_MSG_PER_CHANNEL:]
-    _mark_dirty(_channel_path(str(channel_id)))
+    arr = ch["messages"]          # deque(maxlen=MAX_MSG_PER_CHANNEL)：古いものは自動で落ちる
+    # 通算の連番（追記型の保存が未保存分を判定するのに使う）
+    ch["seq"] = int(ch.get("seq", len(arr))) + 1
+    msg = {"a": str(author_id), "c": str(content), "t": int(_now())}
+    # サイズは足した1件（と押し出された1件）の分だけ動かす（区切りの "," の分 +1）
+    delta = _approx_size(msg) + 1
+    maxlen = getattr(arr, "maxlen", None)
+    if maxlen and len(arr) >= maxlen:
+        delta -= _approx_size(arr[0]) + 1
+    arr.append(msg)
+    _mark_dirty(_channel_path(str(channel_id)), delta)
 
 def get_recent_messages(channel_id: str, limit: int = 12):
     ch = _get_channel(channel_id)
     arr = ch.get("messages", [])
-    sliced = arr[-int(limit):]
+    sliced = itertools.islice(arr, max(0, len(arr) - int(limit)), None)
     return [(m["a"], m["c"]) for m in sliced]
 
+def get_message_window(channel_id: str):
+    """手元にある履歴を [(通算seq, author, content), ...]（古い順）で返す"""
+    ch = _get_channel(channel_id)
+    arr = ch.get("messages", [])
+    first = int(ch.get("seq", len(arr))) - len(arr) + 1
+    return [(first + i, m["a"], m["c"]) for i, m in enumerate(arr)]
+
+# ---------- Channel summary ----------
+def get_channel_summary(channel_id: str) -> dict:
+    """履歴からあふれた発言の要約 {"text": str, "upto": 要約に入っている最後のseq}"""
+    ch = _get_channel(channel_id)
+    return ch.get("summary") or {"text": "", "upto": 0}
+
+def set_channel_summary(channel_id: str, text: str, upto: int):
+    ch = _get_channel(channel_id)
+    ch["summary"] = {"text": str(text), "upto": int(upto), "t": int(_now())}
+    _mark_dirty(_channel_path(str(channel_id)))
+
 # ---------- KV ----------
 def _kv_get(user_id: str, key: str):
     u = _get_user(user_id)
@@ -271,6 +1529,7 @@ def _kv_get(user_id: str, key: str):
 def _kv_set(user_id: str, key: str, value: str):
     u = _get_user(user_id)
     u.setdefault("kv", {})[str(key)] = str(value)
+    u.setdefault("kv_t", {})[str(key)] = _now()
     _mark_dirty(_user_path(str(user_id)))
 
 def get_last_morning_greet_date(user_id: str):
@@ -280,9 +1539,6 @@ def set_last_morning_greet_date(user_id: str, ymd: str):
     _kv_set(user_id, "last_morning_greet_date", ymd)
 
 # ---------- Emotion ----------
-def _clamp(x, lo=-1.0, hi=1.0):
-    return max(lo, min(hi, x))
-
 def _tag_from_state(v, a, t):
     if t > 0.55 and v > 0.15:
         return "affectionate"
@@ -301,41 +1557,12 @@ def _tag_from_state(v, a, t):
 def update_emotion_by_text(user_id: str, text: str, chichi: bool):
     u = _get_user(user_id)
     emo = u.get("emotion", {"v": 0.0, "a": 0.0, "t": 0.0, "tag": "neutral"})
-    v, a, t = float(emo["v"]), float(emo["a"]), float(emo["t"])
-
-    s = (text or "")
-
-    v *= 0.92
-    a *= 0.90
-    t *= 0.94
-
-    pos = ["好き", "すき", "かわいい", "可愛い", "ありがとう", "ありがと", "最高", "嬉", "うれしい", "えらい", "天才", "神"]
-    neg = ["つらい", "辛い", "しんどい", "むり", "無理", "最悪", "きらい", "嫌い", "うざ", "腹立", "むかつく", "泣"]
-    excite = ["！", "!", "www", "笑", "やば", "すご", "最高"]
-    calm = ["ふぅ", "落ち着", "まったり", "のんびり", "眠", "ねむ", "ねむい"]
-    affection = ["ぎゅ", "ちゅ", "だいすき", "大好き", "会いたい", "寂", "さみしい", "すきすき"]
-
-    if any(w in s for w in pos):
-        v += 0.25
-        a += 0.10
-    if any(w in s for w in neg):
-        v -= 0.28
-        a += 0.15
-    if any(w in s for w in calm):
-        a -= 0.10
-    if any(w in s for w in affection):
-        t += 0.22
-        v += 0.10
-    if any(w in s for w in excite):
-        a += 0.12
-
-    if chichi:
-        t += 0.06
-        v += 0.03
-
-    v = _clamp(v); a = _clamp(a); t = _clamp(t)
+
+    # 前回からの経過時間で減衰 → 語の重み × deltas を足す（emotion_lexicon.json）
+    state = _emotion.update(emo, text, now=_now(), owner=chichi)
+    v, a, t = state["v"], state["a"], state["t"]
     tag = _tag_from_state(v, a, t)
 
-    u["emotion"] = {"v": v, "a": a, "t": t, "tag": tag}
+    u["emotion"] = {"v": v, "a": a, "t": t, "tag": tag, "ts": state["ts"]}
     _mark_dirty(_user_path(str(user_id)))
     return v, a, t, tag
\ No newline at end of file
@@ -0,0 +1,207 @@
+"""
+/metrics 用の小さなメトリクス置き場（Prometheus のテキスト形式で出す）
+
+prometheus_client は入れていないので、使う分（counter / histogram / 読むときに値を取るgauge）だけ自前で持つ。
+
+    GH_REQUESTS = REGISTRY.counter("ruby_github_requests_total", "GitHub API requests", ("method", "status"))
+    GH_REQUESTS.inc(method="GET", status="200")
+    STAGE.observe(0.12, stage="openai")
+    REGISTRY.gauge("ruby_cache_entries", "...", lambda: {("users",): 10, ("channels",): 3}, ("cache",))
+    text = REGISTRY.render()
+
+メッセージ1件ぶんの区間計測は MessageTrace:
+
+    trace = MessageTrace(STAGE)
+    with trace.span("memory_load"):
+        ...
+    trace.finish(uid=uid)   # 合計が slow_sec を超えていたら区間ごとの内訳をログに出す
+"""
+import math
+import time
+from contextlib import contextmanager
+
+# 秒。Discord の1メッセージ処理（数ms〜十数秒）が収まるように
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0)
+
+
+def _escape(v) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(x) -> str:
+    if x == math.inf:
+        return "+Inf"
+    if isinstance(x, float) and x.is_integer() and abs(x) < 1e15:
+        return str(int(x))
+    return repr(float(x)) if isinstance(x, float) else str(x)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: ラベルは {self.labelnames} を全部指定してください: {sorted(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._values = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> list:
+        return [f"{self.name}{_labels(self.labelnames, k)} {_num(v)}" for k, v in sorted(self._values.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        self._values = {}   # labels -> [各バケツの件数..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        row = self._values.get(key)
+        if row is None:
+            row = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, b in enumerate(self.buckets):
+            if value <= b:
+                row[i] += 1
+                break
+        row[-2] += value
+        row[-1] += 1
+
+    def count(self, **labels) -> int:
+        row = self._values.get(self._key(labels))
+        return row[-1] if row else 0
+
+    def samples(self) -> list:
+        out = []
+        for key, row in sorted(self._values.items()):
+            cum = 0
+            for b, c in zip(self.buckets, row):
+                cum += c
+                le = 'le="%s"' % _num(b)
+                out.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cum}")
+            le = 'le="+Inf"'
+            out.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {row[-1]}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_num(row[-2])}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, key)} {row[-1]}")
+        return out
+
+
+class CallbackGauge(_Metric):
+    """値はスクレイプのたびに fn() で取る。fn は数値か {ラベル値のタプル: 数値} を返す"""
+
+    def __init__(self, name, help, fn, labelnames=(), kind: str = "gauge"):
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+        self.kind = kind
+
+    def samples(self) -> list:
+        try:
+            values = self.fn()
+        except Exception as e:
+            print("metrics ERROR:", self.name, repr(e))
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{_labels(self.labelnames, k)} {_num(v)}"
+                for k, v in sorted(values.items()) if v is not None]
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _add(self, metric):
+        old = self._metrics.get(metric.name)
+        if old is not None:
+            if type(old) is not type(metric) or old.labelnames != metric.labelnames:
+                raise ValueError(f"メトリクス名が重複しています: {metric.name}")
+            return old
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()) -> Counter:
+        return self._add(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, fn, labelnames=(), kind: str = "gauge") -> CallbackGauge:
+        # コールバックは後から差し替えられるように上書きする
+        metric = CallbackGauge(name, help, fn, labelnames, kind)
+        self._metrics[name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines += metric.header()
+            lines += metric.samples()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class MessageTrace:
+    """
+    1メッセージの処理を区間(stage)ごとに計る。区間の時間は hist に stage ラベルで入れる
+    slow_sec > 0 なら、合計がそれを超えたときに内訳を1行ログに出す
+    """
+
+    def __init__(self, hist: Histogram, slow_sec: float = 0.0, clock=time.perf_counter):
+        self.hist = hist
+        self.slow_sec = float(slow_sec)
+        self.clock = clock
+        self.started = clock()
+        self.spans = {}   # stage -> 秒（同じ stage を何回か通ったら足す）
+
+    @contextmanager
+    def span(self, stage: str):
+        t0 = self.clock()
+        try:
+            yield
+        finally:
+            dt = self.clock() - t0
+            self.spans[stage] = self.spans.get(stage, 0.0) + dt
+            self.hist.observe(dt, stage=stage)
+
+    def finish(self, **info) -> float:
+        total = self.clock() - self.started
+        self.hist.observe(total, stage="total")
+        if self.slow_sec > 0 and total >= self.slow_sec:
+            parts = " ".join(f"{k}={v * 1000:.0f}ms" for k, v in self.spans.items())
+            tags = " ".join(f"{k}={v}" for k, v in info.items())
+            print(f"Slow message: total={total * 1000:.0f}ms {parts} {tags}".rstrip())
+        return total
@@ -0,0 +1,225 @@
+"""
+OpenAI へのリクエストをまとめて捌くスケジューラ
+
+- 同時実行数の上限（セマフォ）と、トークンバケットによる送信ペースの制限
+- 429 / 5xx / 接続エラーはジッター付きの指数バックオフで再試行（Retry-After があれば従う）
+- 同じ相手（key）からの連投は1本にまとめる:
+    submit() してから coalesce_window 秒のあいだに同じ key で次の submit() が来たら、
+    前の方は None を返して降りる。最後の1本だけが送られる
+    メッセージ(input)は送る直前に build() で作るので、まとめた分の発言は全部履歴に入っている
+  同じ key のリクエストは1本ずつ順番に送る（返信の順番が入れ替わらない）
+- deadline（loop.time() の時刻）を渡すと、順番待ち・再試行も含めてその時刻までに収める
+  順番が回ってこなければ、待ちきれない再試行はしないで TimeoutError。call() の中でも同じ deadline を使えば全体がその時間で切れる
+- stats() で待ち行列の長さ・待ち時間・再試行回数などが見られる
+
+    sched = OpenAIScheduler(max_concurrency=4, rate_per_sec=2, burst=4)
+    reply = await sched.submit(uid, build, call)   # build() -> messages, call(messages) -> 結果
+    if reply is None:
+        return   # もっと新しいメッセージの方でまとめて返事する
+"""
+import asyncio
+import inspect
+import random
+import time
+
+import openai
+
+
+class TokenBucket:
+    """rate_per_sec ずつ貯まり、最大 burst まで一気に使えるバケツ（0以下なら制限なし）"""
+
+    def __init__(self, rate_per_sec: float, burst: float, clock=time.monotonic):
+        self.rate = float(rate_per_sec)
+        self.capacity = max(1.0, float(burst))
+        self.tokens = self.capacity
+        self.clock = clock
+        self._last = clock()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        # 順番待ちは Lock で先着順にする
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                await asyncio.sleep((1.0 - self.tokens) / self.rate)
+
+
+def is_retryable(e: Exception) -> bool:
+    status = getattr(e, "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    if isinstance(e, openai.APIConnectionError):   # APITimeoutError もここ
+        return True
+    # asyncio.TimeoutError（呼び出し側の持ち時間切れ）は再試行しない
+    return isinstance(e, ConnectionError)
+
+
+def _retry_after(e: Exception):
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class _KeyState:
+    __slots__ = ("gen", "lock", "first_at", "waiters")
+
+    def __init__(self):
+        self.gen = 0               # submit() のたびに増える。自分の番号と違ったら新しいのが来ている
+        self.lock = asyncio.Lock()
+        self.first_at = None       # まとめ中の最初の submit() の時刻（待ち時間の計測用）
+        self.waiters = 0
+
+
+class OpenAIScheduler:
+
+    def __init__(self, max_concurrency: int = 4, rate_per_sec: float = 0.0, burst: float = 4,
+                 max_retries: int = 3, backoff_base: float = 0.5, backoff_max: float = 8.0,
+                 coalesce_window: float = 0.0, clock=time.monotonic):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.max_retries = max(0, int(max_retries))
+        self.backoff_base = float(backoff_base)
+        self.backoff_max = float(backoff_max)
+        self.coalesce_window = float(coalesce_window)
+        self.clock = clock
+        self._sem = asyncio.Semaphore(self.max_concurrency)
+        self._bucket = TokenBucket(rate_per_sec, burst, clock=clock)
+        self._keys = {}
+
+        self.queued = 0            # 送信待ち（まとめ待ち・同時実行待ち・レート待ち）
+        self.in_flight = 0
+        self.counters = {"submitted": 0, "coalesced": 0, "dispatched": 0, "ok": 0,
+                         "retries": 0, "errors": 0, "expired": 0}
+        self.max_queued = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.last_wait = 0.0
+
+    async def submit(self, key, build, call, deadline: float | None = None):
+        """
+        build(): 送る input を作る（同期でも async でもよい）。送る直前に1回だけ呼ぶ
+        call(messages): 実際に API を呼ぶ coroutine。失敗したら例外を投げる
+        deadline: 順番待ちと再試行を打ち切る時刻（asyncio のループ時刻）。None なら順番が来るまで待ち、max_retries まで
+        同じ key の新しい submit() に置き換えられたら None を返す
+        """
+        st = self._keys.get(key)
+        if st is None:
+            st = self._keys[key] = _KeyState()
+        st.gen += 1
+        my = st.gen
+        st.waiters += 1
+        if st.first_at is None:
+            st.first_at = self.clock()
+        self.counters["submitted"] += 1
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        queued = True
+        try:
+            if self.coalesce_window > 0:
+                await asyncio.sleep(self.coalesce_window)
+            if st.gen != my:
+                self.counters["coalesced"] += 1
+                return None
+            await self._until(st.lock.acquire(), deadline)
+            try:
+                if st.gen != my:
+                    self.counters["coalesced"] += 1
+                    return None
+                await self._until(self._sem.acquire(), deadline)
+                try:
+                    await self._until(self._bucket.acquire(), deadline)
+                    if st.gen != my:
+                        self.counters["coalesced"] += 1
+                        return None
+                    wait = self.clock() - st.first_at
+                    st.first_at = None
+                    self.queued -= 1
+                    queued = False
+                    self._record_wait(wait)
+
+                    messages = build()
+                    if inspect.isawaitable(messages):
+                        messages = await self._until(messages, deadline)
+                    self.in_flight += 1
+                    try:
+                        return await self._call_with_retry(call, messages, deadline)
+                    finally:
+                        self.in_flight -= 1
+                finally:
+                    self._sem.release()
+            finally:
+                st.lock.release()
+        finally:
+            if queued:
+                self.queued -= 1
+            st.waiters -= 1
+            if st.waiters == 0:
+                self._keys.pop(key, None)
+
+    async def _until(self, aw, deadline: float | None):
+        """送る前の待ち（順番・レート・build）を deadline で切る"""
+        if deadline is None:
+            return await aw
+        try:
+            return await asyncio.wait_for(aw, deadline - asyncio.get_running_loop().time())
+        except asyncio.TimeoutError:
+            self.counters["expired"] += 1
+            raise asyncio.TimeoutError("OpenAI request waited past the deadline") from None
+
+    async def _call_with_retry(self, call, messages, deadline: float | None = None):
+        self.counters["dispatched"] += 1
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            try:
+                result = await call(messages)
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    self.counters["errors"] += 1
+                    raise
+                delay = _retry_after(e)
+                if delay is None:
+                    # full jitter: 0〜上限 の一様乱数
+                    delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+                if deadline is not None and loop.time() + delay >= deadline:
+                    # 待っているうちに持ち時間が切れる
+                    self.counters["errors"] += 1
+                    raise asyncio.TimeoutError("OpenAI retry would exceed the deadline") from e
+                attempt += 1
+                self.counters["retries"] += 1
+                await asyncio.sleep(delay)
+                continue
+            self.counters["ok"] += 1
+            return result
+
+    def _record_wait(self, wait: float):
+        self.last_wait = wait
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+    def stats(self) -> dict:
+        n = self.counters["dispatched"]
+        return {
+            **self.counters,
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "wait_avg_sec": (self.wait_total / n) if n else 0.0,
+            "wait_max_sec": self.wait_max,
+            "wait_last_sec": self.last_wait,
+        }
@@ -0,0 +1,143 @@
+"""
+相手ごとの送信制限（OpenAI の予算を守る）。数えるのはメモリ上で、ユーザー状態には定期的にまとめて書く
+
+- バケツ: burst 回まで続けて使え、per_minute 回/分 のペースで戻る（連投・短時間の使いすぎ）
+- 1日の上限: JST の日ごとの回数を数え、スライディングウィンドウで daily_limit 回まで
+    見積もり = 今日の回数 + 昨日の回数 × (今日の残り割合)
+  0時ちょうどに全員の上限が一斉に戻る（0時前後で倍使える）ことがない
+- 日ごとの回数は load(uid, [今日, 昨日]) でユーザー状態から読んで始める（再起動しても数え直しにならない）
+  イベントループの上では aload（async 版）を渡して ahit() を使う（読み込みでループを止めない）
+  まだ書いていない分は take_pending() で取り出して書く。書けなかったら requeue() で戻す
+
+    limiter = RateLimiter(daily_limit=50, per_minute=6, burst=5, clock=jst_now, load=...)
+    reason = limiter.hit(uid)      # None なら通してよい（1回分使った）。"burst" / "daily" なら制限中
+    reason = await limiter.ahit(uid)   # aload を渡したとき
+"""
+from datetime import timedelta
+
+from bounded_cache import BoundedCache
+
+
+class _UserState:
+    __slots__ = ("tokens", "last", "day", "today", "yesterday")
+
+    def __init__(self, capacity: float, now: float, day: str, today: int, yesterday: int):
+        self.tokens = capacity
+        self.last = now
+        self.day = day
+        self.today = today
+        self.yesterday = yesterday
+
+
+class RateLimiter:
+
+    def __init__(self, daily_limit: int = 50, per_minute: float = 6.0, burst: float = 5.0, clock=None,
+                 load=None, aload=None, max_users: int = 10000):
+        """
+        clock(): タイムゾーン付きの datetime（bot の jst_now）。日の区切りはこの日付
+        load(uid, [ymd, ...]): ユーザー状態に保存済みの回数のリスト（なければ 0 から数える）
+        aload(uid, [ymd, ...]): load の coroutine 版。ahit() で初めて見る相手のときに使う
+        daily_limit / per_minute が 0 以下ならその制限はなし
+        """
+        self.daily_limit = int(daily_limit)
+        self.rate = float(per_minute) / 60.0
+        self.capacity = max(1.0, float(burst))
+        self.clock = clock
+        self.load = load
+        self.aload = aload
+        # 昨日の分まで効くので、2日触っていない相手は忘れてよい
+        self._users = BoundedCache(max_entries=max_users, ttl=2 * 86400, clock=self._epoch)
+        self._pending = {}   # uid -> {ymd: まだ書いていない回数}
+        self.counters = {"allowed": 0, "limited_burst": 0, "limited_daily": 0}
+
+    def _epoch(self) -> float:
+        return self.clock().timestamp()
+
+    @staticmethod
+    def _days(now) -> tuple:
+        today = now.date()
+        return today.isoformat(), (today - timedelta(days=1)).isoformat()
+
+    def _state(self, uid: str, now) -> _UserState:
+        today, yesterday = self._days(now)
+        st = self._users.get(uid)
+        if st is None:
+            counts = list(self.load(uid, [today, yesterday])) if self.load else [0, 0]
+            st = self._users[uid] = self._new_state(uid, now, counts)
+        elif st.day != today:
+            # 日付が変わった（1日以上あいたら昨日の分もない）
+            st.yesterday = st.today if st.day == yesterday else 0
+            st.today = 0
+            st.day = today
+        return st
+
+    def _new_state(self, uid: str, now, counts: list) -> _UserState:
+        today, yesterday = self._days(now)
+        pending = self._pending.get(uid, {})
+        return _UserState(self.capacity, now.timestamp(), today,
+                          int(counts[0]) + pending.get(today, 0), int(counts[1]) + pending.get(yesterday, 0))
+
+    def _daily_estimate(self, st: _UserState, now) -> float:
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        remaining = 1.0 - (now - midnight).total_seconds() / 86400.0
+        return st.today + st.yesterday * remaining
+
+    def hit(self, uid: str):
+        """通してよければ None を返して1回分数える。制限中なら理由を返す（数えない）"""
+        uid = str(uid)
+        now = self.clock()
+        st = self._state(uid, now)
+
+        t = now.timestamp()
+        if self.rate > 0:
+            st.tokens = min(self.capacity, st.tokens + max(0.0, t - st.last) * self.rate)
+        st.last = t
+
+        if self.daily_limit > 0 and self._daily_estimate(st, now) >= self.daily_limit:
+            self.counters["limited_daily"] += 1
+            return "daily"
+        if self.rate > 0 and st.tokens < 1.0:
+            self.counters["limited_burst"] += 1
+            return "burst"
+
+        if self.rate > 0:
+            st.tokens -= 1.0
+        st.today += 1
+        days = self._pending.setdefault(uid, {})
+        days[st.day] = days.get(st.day, 0) + 1
+        self.counters["allowed"] += 1
+        return None
+
+    async def ahit(self, uid: str):
+        """hit() と同じ。初めて見る相手の回数は aload で読んでから数える"""
+        uid = str(uid)
+        if self.aload is not None and uid not in self._users:
+            now = self.clock()
+            counts = list(await self.aload(uid, list(self._days(now))))
+            # 待っている間に同じ相手が入っていたらそちらを使う
+            if uid not in self._users:
+                self._users[uid] = self._new_state(uid, now, counts)
+        return self.hit(uid)
+
+    # ---------- 保存 ----------
+    def take_pending(self) -> dict:
+        """まだユーザー状態に書いていない回数 {uid: {ymd: n}} を取り出す"""
+        pending, self._pending = self._pending, {}
+        return pending
+
+    def requeue(self, uid: str, days: dict):
+        """take_pending() で取り出したけれど書けなかった分を戻す"""
+        mine = self._pending.setdefault(str(uid), {})
+        for ymd, n in days.items():
+            mine[ymd] = mine.get(ymd, 0) + n
+
+    def stats(self) -> dict:
+        self._users.sweep()
+        return {
+            **self.counters,
+            "users": len(self._users),
+            "pending_users": len(self._pending),
+            "daily_limit": self.daily_limit,
+            "per_minute": self.rate * 60.0,
+            "burst": self.capacity,
+        }
@@ -0,0 +1,178 @@
+"""
+短い定型メッセージ（おはよう / おやすみ / ただいま / 相づち など）への返事のキャッシュ
+
+- キーは「相手」+「正規化したテキスト」+「build_messages に効く状況（persona・感情タグ・今日の気分・朝の挨拶・帰宅）」
+  状況が違えば別の返事になるので、同じ文面でも別のエントリ
+  返事はその相手の会話から作られたものなので、別の相手には返さない（入れる側も履歴・要約なしで作った返事だけにする）
+- 1エントリに返事を variants 個まで貯める。同じ相手に直前と同じ返事は返さない
+  （ruby_core.Ruby._avoid_loops と同じ考え方。使える返事がなければミス扱いで API に行く）
+- fuzzy_threshold > 0 なら、文面が完全一致しなくても文字n-gram（Ruby と同じ count_ngrams）の
+  Jaccard 係数がしきい値以上の短文に当てる（「おはよ〜」→「おはよう」など）
+- 件数上限の LRU + アイドルTTL は BoundedCache に任せる
+
+    hit = cache.lookup(uid, text, ctx)
+    if hit is None:
+        reply = await 呼ぶ(); cache.store(uid, text, ctx, reply, latency)
+"""
+import re
+import time
+import unicodedata
+from collections import deque
+
+from bounded_cache import BoundedCache
+from ruby_core import count_ngrams
+
+# 末尾の記号・絵文字・伸ばし棒は文面の違いとみなさない（「おはよう！！」「おはよう〜」→「おはよう」）
+_TRAILING = re.compile(r"[\s!?！？。、.,…・~〜ーｰ♪☆★❤♡😊✨🥺💤🌙]+$")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    s = unicodedata.normalize("NFKC", text or "").lower().strip()
+    s = _SPACES.sub(" ", s)
+    t = _TRAILING.sub("", s)
+    return t or s
+
+
+def char_ngrams(text: str, n: int = 3) -> frozenset:
+    """先頭に n-1 個の空白を詰めて（Ruby.feed と同じ形）文字n-gramの集合にする"""
+    padded = " " * (n - 1) + text
+    return frozenset(p + ch for p, nexts in count_ngrams([padded], n).items() for ch in nexts)
+
+
+def jaccard(a: frozenset, b: frozenset) -> float:
+    if not a or not b:
+        return 0.0
+    inter = len(a & b)
+    return inter / (len(a) + len(b) - inter)
+
+
+class _Entry:
+    __slots__ = ("replies", "latency", "grams")
+
+    def __init__(self, grams):
+        self.replies = []       # 古い順。variants 個を超えたら古いのから落とす
+        self.latency = 0.0      # API で作ったときにかかった秒数（移動平均）
+        self.grams = grams
+
+
+class ReplyCache:
+
+    def __init__(self, max_entries: int = 2000, ttl: float = 6 * 3600, max_chars: int = 24,
+                 variants: int = 3, fuzzy_threshold: float = 0.0, ngram: int = 3,
+                 recent_per_user: int = 1, clock=time.monotonic):
+        self.max_chars = int(max_chars)
+        self.variants = max(1, int(variants))
+        self.fuzzy_threshold = float(fuzzy_threshold)
+        self.ngram = max(2, int(ngram))
+        self.clock = clock
+        self._entries = BoundedCache(max_entries=max_entries, ttl=ttl, on_evict=self._on_evict, clock=clock)
+        self._index = {}        # (ctx, n-gram) -> {key, ...}（あいまい一致の候補探し用）
+        self._recent = BoundedCache(max_entries=max(1, int(max_entries)), ttl=ttl, clock=clock)
+        self.recent_per_user = max(1, int(recent_per_user))
+
+        self.counters = {"lookups": 0, "hits": 0, "fuzzy_hits": 0, "misses": 0,
+                         "skipped_repeat": 0, "stored": 0}
+        self.saved_sec = 0.0
+
+    # ---------- キー ----------
+    def cacheable(self, text: str) -> bool:
+        return 0 < len(normalize(text)) <= self.max_chars
+
+    def _key(self, user_id: str, text: str, ctx: tuple):
+        # あいまい一致の索引も key[0] ごとに分かれるので、別の相手のエントリは候補にも入らない
+        return ((str(user_id), ctx), normalize(text))
+
+    def _on_evict(self, key, entry):
+        ctx = key[0]
+        for g in entry.grams:
+            keys = self._index.get((ctx, g))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._index[(ctx, g)]
+
+    def _fuzzy_key(self, key):
+        ctx, norm = key
+        grams = char_ngrams(norm, self.ngram)
+        candidates = set()
+        for g in grams:
+            candidates.update(self._index.get((ctx, g), ()))
+        best, best_sim = None, self.fuzzy_threshold
+        for k in candidates:
+            e = self._entries.peek(k)
+            if e is None:
+                continue
+            sim = jaccard(grams, e.grams)
+            if sim >= best_sim and (best is None or sim > best_sim):
+                best, best_sim = k, sim
+        return best
+
+    # ---------- 引く / 入れる ----------
+    def lookup(self, user_id: str, text: str, ctx: tuple):
+        """使える返事があれば返す（なければ None）。返した返事はその相手の直近として覚える"""
+        if not self.cacheable(text):
+            return None
+        self.counters["lookups"] += 1
+        key = self._key(user_id, text, ctx)
+        self._entries.sweep()
+        entry = self._entries.get(key)
+        fuzzy = False
+        if entry is None and self.fuzzy_threshold > 0:
+            k = self._fuzzy_key(key)
+            if k is not None:
+                entry, fuzzy = self._entries[k], True
+        if entry is None:
+            self.counters["misses"] += 1
+            return None
+
+        recent = self._recent.peek(user_id) or ()
+        # 新しい返事から順に、この相手に最近返していないものを使う
+        for reply in reversed(entry.replies):
+            if reply not in recent:
+                break
+        else:
+            self.counters["skipped_repeat"] += 1
+            self.counters["misses"] += 1
+            return None
+
+        self.remember(user_id, reply)
+        self.counters["fuzzy_hits" if fuzzy else "hits"] += 1
+        self.saved_sec += entry.latency
+        return reply
+
+    def remember(self, user_id: str, reply: str):
+        """相手に送った返事を覚える（キャッシュを通らなかった返事もここに入れる）"""
+        recent = self._recent.peek(user_id)
+        if recent is None:
+            recent = self._recent[user_id] = deque(maxlen=self.recent_per_user)
+        recent.append(reply)
+
+    def store(self, user_id: str, text: str, ctx: tuple, reply: str, latency: float = 0.0):
+        if not reply or not self.cacheable(text):
+            return
+        key = self._key(user_id, text, ctx)
+        entry = self._entries.peek(key)
+        if entry is None:
+            grams = char_ngrams(key[1], self.ngram) if self.fuzzy_threshold > 0 else frozenset()
+            entry = _Entry(grams)
+            self._entries[key] = entry
+            for g in grams:
+                self._index.setdefault((key[0], g), set()).add(key)
+        if reply in entry.replies:
+            entry.replies.remove(reply)
+        entry.replies.append(reply)
+        del entry.replies[:-self.variants]
+        entry.latency = latency if not entry.latency else 0.7 * entry.latency + 0.3 * latency
+        self.counters["stored"] += 1
+
+    def stats(self) -> dict:
+        c = self.counters
+        hits = c["hits"] + c["fuzzy_hits"]
+        return {
+            **c,
+            "entries": len(self._entries),
+            "evictions": self._entries.evictions,
+            "hit_rate": (hits / c["lookups"]) if c["lookups"] else 0.0,
+            "saved_latency_sec": self.saved_sec,
+        }
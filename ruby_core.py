@@ -1,6 +1,81 @@
+import heapq
+import os
 import random
 import re
-from collections import defaultdict, deque
+import sys
+from array import array
+from bisect import bisect_right
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate, islice
+
+from keywords import LEXICON, analyze
+from ruby_model import MappedModel, encode_model, write_atomic
+
+
+def _new_counter():
+    # lambdaだとpickleできないので関数にしておく
+    return defaultdict(int)
+
+
+def count_ngrams(padded_texts, n: int) -> dict:
+    """
+    feed 用に整えたテキスト（先頭に n-1 個の空白つき）から {prefix: {次の文字: 回数}} を数える
+    プロセスプールから呼ぶのでモジュール直下に置いている
+    """
+    counts = Counter()
+    for padded in padded_texts:
+        counts.update(padded[i:i + n] for i in range(len(padded) - (n - 1)))
+    # 受け取る側（メインプロセス）の仕事を減らすため、prefixごとにまとめてから返す
+    w = n - 1
+    grouped = {}
+    for gram, c in counts.items():
+        nexts = grouped.get(gram[:w])
+        if nexts is None:
+            grouped[gram[:w]] = {gram[w]: c}
+        else:
+            nexts[gram[w]] = c
+    return grouped
+
+
+class _FreqSketch:
+    """
+    prefix の出現頻度の見積もり（count-min sketch、3行）
+    モデルから追い出したprefixの頻度も覚えておけるので、よく出るのにたまたま捨てられたprefixがすぐ戻れる
+    sample 回数えるごとに全体を半分にして、昔の頻度をだんだん忘れる
+    """
+
+    def __init__(self, capacity: int):
+        width = 64
+        while width < capacity * 8 and width < (1 << 21):
+            width <<= 1
+        self.width = width
+        self.mask = width - 1
+        self.table = array("I", bytes(4 * 3 * width))
+        self.sample = max(1000, capacity * 10)
+        self.added = 0
+        self.resets = 0
+
+    # 1つのハッシュを21bitずつに分けて3行ぶんの位置にする（呼ばれる回数が多いので手で展開している）
+    def add(self, key, count: int = 1):
+        h, w, m, t = hash(key), self.width, self.mask, self.table
+        t[h & m] += count
+        t[w + ((h >> 21) & m)] += count
+        t[2 * w + ((h >> 42) & m)] += count
+        self.added += count
+        if self.added >= self.sample:
+            self._reset()
+
+    def estimate(self, key) -> int:
+        h, w, m, t = hash(key), self.width, self.mask, self.table
+        a, b, c = t[h & m], t[w + ((h >> 21) & m)], t[2 * w + ((h >> 42) & m)]
+        return a if a <= b and a <= c else (b if b <= c else c)
+
+    def _reset(self):
+        self.table = array("I", (c >> 1 for c in self.table))
+        self.added //= 2
+        self.resets += 1
+
 
 class Ruby:
     """
@@ -10,11 +85,20 @@ class Ruby:
     - 質問・選択肢・感情語に安定反応
     """
 
-    def __init__(self, n=4, max_keys=50000):
+    def __init__(self, n=4, max_keys=50000, evict_ratio=0.25):
         self.n = max(2, int(n))
-        self.model = defaultdict(lambda: defaultdict(int))
+        self.model = defaultdict(_new_counter)   # 起動後に覚えた分（prefix -> {次の文字: 回数}）
+        self.base = None                         # load_model() で読んだ学習済みモデル（読み取り専用・mmap）
         self.max_keys = max_keys
 
+        # 追い出し: 出現頻度の見積もりが低いprefixから、上限を超えたら evict_ratio 分まとめて捨てる
+        self.evict_ratio = min(0.9, max(0.0, float(evict_ratio)))
+        self._freq = None          # 最初に覚えるときに作る（読み取り専用で使うなら持たない）
+        self.evictions = 0         # まとめて捨てた回数
+        self.evicted_keys = 0      # 捨てたprefixの累計
+        # サンプリング表: prefix -> {温度: (候補文字, 累積重み)}。feedで数が変わったprefixだけ捨てる
+        self._tables = {}
+
         # 直近の返信を覚えてループ抑制
         self._recent_replies = deque(maxlen=16)
         self._recent_questions = deque(maxlen=10)
@@ -57,17 +141,19 @@ class Ruby:
             "おつかれ": ["おつかれさま……✨ 今日はどこが一番しんどかった……？", "おつかれ……ちょっと休も……"],
         }
 
-        self.emotions = ["眠い", "つらい", "しんどい", "無理", "きつい", "不安", "こわい", "寂しい", "イライラ", "疲れた", "だるい"]
+        # 判定に使う語は keywords.LEXICON（greeting / question / distress）にまとめてある
+        self.emotions = LEXICON["distress"]
 
     def _norm(self, s: str) -> str:
         s = (s or "").strip()
         s = re.sub(r"\s+", " ", s)
         return s
 
-    def feed(self, text: str):
+    def _prepare(self, text: str):
+        """学習するテキストを整えて先頭に空白を詰めたものを返す。学習しないなら None"""
         text = self._norm(text)
         if not text:
-            return
+            return None
 
         if text == self._last_fed:
             self._dup_count += 1
@@ -77,28 +163,186 @@ class Ruby:
 
         # 短すぎるのは学習しない（ループ源）
         if len(text) <= 2:
-            return
+            return None
         # 5文字以下の同文連投は食べない（えへへ対策）
         if len(text) <= 5 and self._dup_count >= 1:
-            return
+            return None
 
         if text[-1] not in "。！？!?…":
             text += "。"
 
-        padded = " " * (self.n - 1) + text
+        return " " * (self.n - 1) + text
+
+    def feed(self, text: str):
+        padded = self._prepare(text)
+        if padded is None:
+            return
+
+        tables, freq = self._tables, self._sketch()
         for i in range(len(padded) - (self.n - 1)):
-            prefix = padded[i:i + (self.n - 1)]
+            prefix = sys.intern(padded[i:i + (self.n - 1)])
             nxt = padded[i + (self.n - 1)]
             self.model[prefix][nxt] += 1
+            freq.add(prefix)
+            tables.pop(prefix, None)
 
         if len(self.model) > self.max_keys:
-            for _ in range(len(self.model) - self.max_keys):
-                k = next(iter(self.model))
-                del self.model[k]
+            self._evict()
+
+    def train(self, texts, workers: int = 0, chunk_size: int = 5000) -> dict:
+        """
+        まとめて学習する（過去ログからの立ち上げ用）
+        - 短文/同文連投のフィルタは feed と同じ（順番に見る必要があるのでここで1本で回す）
+        - n-gramの数え上げは chunk_size 件ずつプロセスプールに投げて、戻ってきた Counter をモデルに足す
+        - workers: 0ならCPU数、1ならプロセスを使わずにこのプロセスで数える
+        texts はイテレータでよい（全部はメモリに載せない）
+        """
+        workers = int(workers) or (os.cpu_count() or 1)
+        stats = {"messages": 0, "trained": 0, "ngrams": 0}
+
+        def chunks():
+            it = iter(texts)
+            while True:
+                raw = list(islice(it, chunk_size))
+                if not raw:
+                    return
+                stats["messages"] += len(raw)
+                batch = [p for p in map(self._prepare, raw) if p is not None]
+                if batch:
+                    stats["trained"] += len(batch)
+                    yield batch
+
+        if workers <= 1:
+            for batch in chunks():
+                self._merge_counts(count_ngrams(batch, self.n), stats)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                pending = deque()
+                for batch in chunks():
+                    pending.append(pool.submit(count_ngrams, batch, self.n))
+                    # 先読みしすぎないように、ワーカー数の2倍までに抑える
+                    while len(pending) >= workers * 2:
+                        self._merge_counts(pending.popleft().result(), stats)
+                while pending:
+                    self._merge_counts(pending.popleft().result(), stats)
+        return stats
+
+    def _merge_counts(self, grouped: dict, stats: dict):
+        model, freq = self.model, self._sketch()
+        for prefix, nexts in grouped.items():
+            counter = model.get(prefix)
+            if counter is None:
+                model[sys.intern(prefix)] = defaultdict(int, nexts)
+            else:
+                for ch, c in nexts.items():
+                    counter[ch] += c
+            freq.add(prefix, sum(nexts.values()))
+            stats["ngrams"] += len(nexts)
+        self._tables.clear()
+        if len(model) > self.max_keys:
+            self._evict()
+
+    def _sketch(self) -> _FreqSketch:
+        if self._freq is None:
+            self._freq = _FreqSketch(int(self.max_keys))
+        return self._freq
+
+    def _evict(self):
+        """
+        減衰つきLFU: 出現頻度の見積もりが低いprefixから、上限の evict_ratio 分をまとめて捨てる
+        （1回ごとに消すと feed のたびに走るので、余裕を作ってしばらく走らないようにする）
+        一度しか出ていない新しいprefixは、何度も出ている古いprefixより先に捨てられる
+        """
+        target = max(0, int(self.max_keys * (1.0 - self.evict_ratio)))
+        n_drop = len(self.model) - target
+        if n_drop <= 0:
+            return
+        # 見積もりが同じなら、モデル内での出現回数が少ない方 → 先に覚えた方
+        est = self._sketch().estimate
+        scored = [(est(k), sum(counter.values()), i, k) for i, (k, counter) in enumerate(self.model.items())]
+        victims = [k for *_, k in heapq.nsmallest(n_drop, scored)]
+        for k in victims:
+            del self.model[k]
+            self._tables.pop(k, None)
+        self.evictions += 1
+        self.evicted_keys += len(victims)
+
+    def model_stats(self) -> dict:
+        """モデルの大きさ（件数・おおよそのメモリ）"""
+        edges = 0
+        nbytes = sys.getsizeof(self.model)
+        if self._freq is not None:
+            nbytes += sys.getsizeof(self._freq.table)
+        for prefix, counter in self.model.items():
+            edges += len(counter)
+            nbytes += sys.getsizeof(prefix) + sys.getsizeof(counter)
+        return {
+            "keys": len(self.model),
+            "edges": edges,
+            "bytes": nbytes,
+            "max_keys": self.max_keys,
+            "base_keys": len(self.base) if self.base is not None else 0,
+            "base_bytes": self.base.nbytes() if self.base is not None else 0,
+            "tables": len(self._tables),
+            "evictions": self.evictions,
+            "evicted_keys": self.evicted_keys,
+        }
+
+    # ---------- モデルの保存 / 読み込み ----------
+    def _counts(self, prefix: str):
+        own = self.model.get(prefix)
+        if self.base is None:
+            return own or {}
+        base = self.base.get(prefix)
+        if not base:
+            return own or {}
+        if not own:
+            return base
+        for ch, c in own.items():
+            base[ch] = base.get(ch, 0) + c
+        return base
+
+    def _random_prefix(self) -> str:
+        n_base = len(self.base) if self.base is not None else 0
+        if n_base and random.random() < n_base / (n_base + len(self.model)):
+            return self.base.random_key()
+        return random.choice(list(self.model.keys()))
+
+    def dump_model(self) -> bytes:
+        """学習済み(base)と起動後に覚えた分を合わせて、保存用のバイト列にする"""
+        items = {}
+        if self.base is not None:
+            items.update(self.base.items())
+        for prefix, counter in self.model.items():
+            merged = items.get(prefix)
+            if merged is None:
+                items[prefix] = dict(counter)
+            else:
+                for ch, c in counter.items():
+                    merged[ch] = merged.get(ch, 0) + c
+        return encode_model(self.n, items.items())
+
+    def save_model(self, path: str):
+        write_atomic(path, self.dump_model())
+
+    def load_model(self, path: str):
+        """
+        保存済みモデルを mmap で読み込んで base にする（起動直後から覚えた話し方で話せる）
+        それまでに覚えた分(self.model)はそのまま上乗せされる
+        """
+        base = MappedModel(path)
+        if base.n != self.n:
+            base.close()
+            raise ValueError(f"n が違うモデルです: file n={base.n} / Ruby n={self.n}")
+        old, self.base = self.base, base
+        self._tables.clear()
+        if old is not None:
+            old.close()
 
     def _detect_greeting(self, t: str):
+        found = analyze(t).words("greeting")
         for k in self.greet_map:
-            if k in t:
+            if k in found:
                 return k
         return None
 
@@ -116,8 +360,20 @@ class Ruby:
                 return parts[0][-10:], parts[1][:10]
         return None
 
+    def local_intent(self, seed: str):
+        """
+        APIを呼ばずに答えられる定型メッセージか判定する
+        "greeting"（おはよう/おやすみ/おつかれ）/ "choice"（〜と〜どっち）/ None
+        """
+        t = self._norm(seed)
+        if self._detect_greeting(t):
+            return "greeting"
+        if "どっち" in t and self._detect_choice(t):
+            return "choice"
+        return None
+
     def _is_question(self, t: str) -> bool:
-        return ("?" in t) or ("？" in t) or any(x in t for x in ["なに", "何", "どれ", "どっち", "いつ", "どこ", "だれ", "誰", "どう", "なんで", "理由"])
+        return "question" in analyze(t)
 
     def _soft_pick(self, counter, temperature=0.95):
         items = list(counter.items())
@@ -127,8 +383,41 @@ class Ruby:
         weights = [c ** (1.0 / max(0.2, temperature)) for c in counts]
         return random.choices(chars, weights=weights, k=1)[0]
 
+    def _table(self, prefix: str, temperature: float):
+        """prefix の候補と累積重み（温度ごとに1回だけ作る）。候補なしなら None"""
+        temp = max(0.2, temperature)
+        per_prefix = self._tables.get(prefix)
+        if per_prefix is not None:
+            t = per_prefix.get(temp)
+            if t is not None:
+                return t
+        counter = self._counts(prefix)
+        if not counter:
+            return None
+        if len(self._tables) >= self.max_keys * 2:
+            # 学習済みモデルが大きいときに表だけ膨らみ続けないように
+            self._tables.clear()
+            per_prefix = None
+        chars = tuple(counter)
+        exp = 1.0 / temp
+        cum = list(accumulate(c ** exp for c in counter.values()))
+        t = (chars, cum)
+        if per_prefix is None:
+            per_prefix = self._tables[prefix] = {}
+        per_prefix[temp] = t
+        return t
+
+    def _pick(self, prefix: str, temperature=0.95):
+        # _soft_pick と同じ分布を、作り置きの累積重み + 二分探索で引く
+        t = self._table(prefix, temperature)
+        if t is None:
+            return None
+        chars, cum = t
+        i = bisect_right(cum, random.random() * cum[-1])
+        return chars[min(i, len(chars) - 1)]
+
     def _markov_generate(self, seed: str, max_len: int = 120, temperature=0.95):
-        if not self.model:
+        if not self.model and not self.base:
             return ""
         seed = self._norm(seed)
         base = seed[-(self.n - 1):] if seed else ""
@@ -136,9 +425,9 @@ class Ruby:
 
         out = []
         for _ in range(max_len):
-            nxt = self._soft_pick(self.model.get(prefix, {}), temperature=temperature)
+            nxt = self._pick(prefix, temperature=temperature)
             if nxt is None:
-                prefix = random.choice(list(self.model.keys()))
+                prefix = self._random_prefix()
                 continue
             out.append(nxt)
             prefix = prefix[1:] + nxt
@@ -198,7 +487,7 @@ class Ruby:
             return ans
 
         # 3) 感情語 → 受け止め＋小さな一手＋質問
-        if any(x in t for x in self.emotions):
+        if "distress" in analyze(t):
             plan = random.choice([
                 "水を一口→深呼吸→30秒だけ目を閉じる……",
                 "いまは『回復優先』でいい……",
@@ -0,0 +1,156 @@
+"""
+Ruby の文字n-gramモデルをファイルに保存 / mmapで読み込む
+
+フォーマット（ヘッダ以外は配列をそのまま並べるだけ）:
+    header   : magic "RBNG", version, n, n_keys, n_edges, byteorder
+    prefixes : n_keys 個 × (n-1)文字 の UTF-32-BE 固定長（バイト列順 = 文字コード順にソート済み）
+    offsets  : uint32 × (n_keys + 1)   prefix i の候補は edges[offsets[i]:offsets[i+1]]
+    chars    : uint32 × n_edges        次の文字（コードポイント）
+    counts   : uint32 × n_edges        出現回数
+
+prefix は固定長なので、mmap上のバイト列を直接二分探索できる。
+読み込み側はコピーを持たないので、複数プロセスで同じファイルを開けばページキャッシュを共有する。
+"""
+import os
+import sys
+import mmap
+import random
+import struct
+import tempfile
+from array import array
+
+MAGIC = b"RBNG"
+VERSION = 1
+_HEADER = struct.Struct("<4sIIIIB3x")   # magic, version, n, n_keys, n_edges, little(1)/big(0)
+
+
+def encode_model(n: int, items) -> bytes:
+    """items: (prefix, {char: count}) の列 → ファイルの中身"""
+    width = n - 1
+    rows = []
+    for prefix, counter in items:
+        if len(prefix) != width or not counter:
+            continue
+        rows.append((prefix.encode("utf-32-be"), counter))
+    rows.sort(key=lambda r: r[0])
+
+    prefixes = bytearray()
+    offsets = array("I", [0])
+    chars = array("I")
+    counts = array("I")
+    for key, counter in rows:
+        prefixes += key
+        for ch, c in counter.items():
+            chars.append(ord(ch))
+            counts.append(min(int(c), 0xFFFFFFFF))
+        offsets.append(len(chars))
+
+    header = _HEADER.pack(MAGIC, VERSION, n, len(rows), len(chars), 1 if sys.byteorder == "little" else 0)
+    return b"".join([header, bytes(prefixes), offsets.tobytes(), chars.tobytes(), counts.tobytes()])
+
+
+def write_atomic(path: str, data: bytes):
+    # 読み込み中の他プロセスは古いinodeをmmapしたままなので、置き換えても壊れない
+    d = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=".ruby_model.", dir=d)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class MappedModel:
+    """
+    encode_model で書いたファイルを読み取り専用で mmap したもの
+    Ruby.model と同じく get(prefix) で {char: count} を返す
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n, n_keys, n_edges, little = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self._mm.close()
+            raise ValueError(f"Rubyモデルファイルではありません: {path}")
+        self.n = n
+        self.width = n - 1
+        self.n_keys = n_keys
+        self.n_edges = n_edges
+
+        self._stride = self.width * 4
+        self._pref_off = _HEADER.size
+        off = self._pref_off + n_keys * self._stride
+        view = memoryview(self._mm)
+        native = (little == 1) == (sys.byteorder == "little")
+        self._offsets = self._uint_array(view, off, n_keys + 1, native)
+        off += (n_keys + 1) * 4
+        self._chars = self._uint_array(view, off, n_edges, native)
+        off += n_edges * 4
+        self._counts = self._uint_array(view, off, n_edges, native)
+
+    @staticmethod
+    def _uint_array(view, off: int, count: int, native: bool):
+        raw = view[off:off + count * 4]
+        if native:
+            return raw.cast("I")        # コピーなし
+        a = array("I", raw.tobytes())   # 別エンディアンで書かれたものだけコピーして並べ替える
+        a.byteswap()
+        return a
+
+    def __len__(self):
+        return self.n_keys
+
+    def _find(self, prefix: str) -> int:
+        if len(prefix) != self.width:
+            return -1
+        target = prefix.encode("utf-32-be")
+        mm, base, stride = self._mm, self._pref_off, self._stride
+        lo, hi = 0, self.n_keys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if mm[base + mid * stride: base + (mid + 1) * stride] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n_keys and mm[base + lo * stride: base + (lo + 1) * stride] == target:
+            return lo
+        return -1
+
+    def __contains__(self, prefix):
+        return self._find(prefix) >= 0
+
+    def get(self, prefix: str, default=None):
+        i = self._find(prefix)
+        if i < 0:
+            return default
+        a, b = self._offsets[i], self._offsets[i + 1]
+        return {chr(c): n for c, n in zip(self._chars[a:b], self._counts[a:b])}
+
+    def key_at(self, i: int) -> str:
+        base = self._pref_off + i * self._stride
+        return self._mm[base: base + self._stride].decode("utf-32-be")
+
+    def random_key(self, rng=random) -> str:
+        return self.key_at(rng.randrange(self.n_keys))
+
+    def items(self):
+        for i in range(self.n_keys):
+            a, b = self._offsets[i], self._offsets[i + 1]
+            yield self.key_at(i), {chr(c): n for c, n in zip(self._chars[a:b], self._counts[a:b])}
+
+    def nbytes(self) -> int:
+        return len(self._mm)
+
+    def close(self):
+        for name in ("_offsets", "_chars", "_counts"):
+            v = getattr(self, name, None)
+            if isinstance(v, memoryview):
+                v.release()
+        self._mm.close()
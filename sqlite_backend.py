@@ -0,0 +1,245 @@
+import os
+import re
+import json
+import asyncio
+import time
+import sqlite3
+import threading
+
+_PATH_RE = re.compile(r"/(users|channels)/([^/]+)\.json$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_fields (
+    uid TEXT NOT NULL,
+    field TEXT NOT NULL,
+    value TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (uid, field)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS channel_fields (
+    chid TEXT NOT NULL,
+    field TEXT NOT NULL,
+    value TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (chid, field)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS channel_messages (
+    chid TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    a TEXT NOT NULL,
+    c TEXT NOT NULL,
+    t INTEGER NOT NULL,
+    PRIMARY KEY (chid, seq)
+) WITHOUT ROWID;
+"""
+
+
+class SQLiteBackend:
+    """
+    ローカルSQLite(WAL)に保存するバックエンド
+    - ユーザー状態: トップレベルのフィールドごとに1行。変わったフィールドだけupsertする
+    - チャンネル: メッセージは追記のみ（seqで未保存分を判定）、古いものは max_messages を超えたら削除
+    memory_store からは GitHub と同じ path 単位で呼ばれる
+    """
+    name = "sqlite"
+
+    def __init__(self, db_path: str, max_messages: int = 80, path_base: str = "ruby_mem"):
+        self.db_path = db_path
+        self.max_messages = int(max_messages)
+        self.path_base = path_base
+        self._conn = None
+        self._lock = threading.Lock()
+        self._saved = {}          # (kind, key) -> {field: json}（前回保存した内容）
+        self._saved_seq = {}      # chid -> 保存済みの最大seq
+
+    def _db(self):
+        if self._conn is None:
+            d = os.path.dirname(self.db_path)
+            if d:
+                os.makedirs(d, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def check(self):
+        self._db()
+
+    @staticmethod
+    def _split(path: str):
+        m = _PATH_RE.search(path)
+        if not m:
+            raise ValueError(f"SQLiteBackend: 未知のpath: {path}")
+        return m.group(1), m.group(2)
+
+    # ---------- load ----------
+    def load(self, path: str):
+        kind, key = self._split(path)
+        with self._lock:
+            if kind == "users":
+                return self._load_user(key)
+            return self._load_channel(key)
+
+    async def aload(self, path: str):
+        return await asyncio.to_thread(self.load, path)
+
+    def _load_user(self, uid: str):
+        rows = self._db().execute(
+            "SELECT field, value FROM user_fields WHERE uid = ?", (uid,)
+        ).fetchall()
+        if not rows:
+            return None
+        self._saved[("users", uid)] = dict(rows)
+        obj = {"uid": uid}
+        for field, value in rows:
+            obj[field] = json.loads(value)
+        return obj
+
+    def _load_channel(self, chid: str):
+        db = self._db()
+        fields = db.execute(
+            "SELECT field, value FROM channel_fields WHERE chid = ?", (chid,)
+        ).fetchall()
+        rows = db.execute(
+            "SELECT seq, a, c, t FROM channel_messages WHERE chid = ? ORDER BY seq DESC LIMIT ?",
+            (chid, self.max_messages),
+        ).fetchall()
+        if not fields and not rows:
+            return None
+        self._saved[("channels", chid)] = dict(fields)
+        seq = rows[0][0] if rows else 0
+        self._saved_seq[chid] = seq
+        obj = {"chid": chid}
+        for field, value in fields:
+            obj[field] = json.loads(value)
+        obj["messages"] = [{"a": a, "c": c, "t": t} for _, a, c, t in reversed(rows)]
+        obj["seq"] = seq
+        return obj
+
+    def warm(self, limit: int) -> list:
+        """最近更新されたユーザー/チャンネルを新しい順に limit 件 [(path, obj, bytes), ...]"""
+        with self._lock:
+            db = self._db()
+            recent = db.execute(
+                "SELECT 'users', uid, MAX(updated_at) AS ts FROM user_fields GROUP BY uid "
+                "UNION ALL "
+                "SELECT 'channels', chid, MAX(t) AS ts FROM channel_messages GROUP BY chid "
+                "ORDER BY ts DESC LIMIT ?",
+                (int(limit),),
+            ).fetchall()
+            out = []
+            for kind, key, _ in recent:
+                obj = self._load_user(key) if kind == "users" else self._load_channel(key)
+                if obj is None:
+                    continue
+                size = len(json.dumps(obj, ensure_ascii=False, separators=(",", ":")))
+                out.append((f"{self.path_base}/{kind}/{key}.json", obj, size))
+            return out
+
+    async def awarm(self, limit: int, concurrency: int) -> list:
+        return await asyncio.to_thread(self.warm, limit)
+
+    async def aflush_index(self):
+        # 並べ替えは updated_at / メッセージの時刻でやるので、別に持つ索引はない
+        pass
+
+    # ---------- save ----------
+    def save(self, docs: dict):
+        self._write(self._snapshot(docs))
+
+    async def asave(self, docs: dict):
+        # 直列化はここで済ませる（書いている間の変更は次回のflushに回る）
+        snap = self._snapshot(docs)
+        await asyncio.to_thread(self._write, snap)
+
+    def _snapshot(self, docs: dict) -> list:
+        """書く内容 [(kind, key, {field: json}, messages, seq), ...]"""
+        snap = []
+        for path, obj in docs.items():
+            kind, key = self._split(path)
+            skip = ("uid",) if kind == "users" else ("chid", "messages", "seq")
+            fields = {
+                f: json.dumps(v, ensure_ascii=False, separators=(",", ":"), default=list)
+                for f, v in obj.items() if f not in skip
+            }
+            msgs = seq = None
+            if kind == "channels":
+                msgs = list(obj.get("messages", []))
+                seq = int(obj.get("seq", len(msgs)))
+            snap.append((kind, key, fields, msgs, seq))
+        return snap
+
+    def _write(self, snap: list):
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN")
+            try:
+                for kind, key, fields, msgs, seq in snap:
+                    if kind == "users":
+                        self._upsert_fields(db, "user_fields", "uid", kind, key, fields, now)
+                    else:
+                        self._upsert_fields(db, "channel_fields", "chid", kind, key, fields, now)
+                        self._append_messages(db, key, msgs, seq)
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                # どこまで書けたか分からないので、次回は全フィールドを書き直す
+                for kind, key, *_ in snap:
+                    self._saved.pop((kind, key), None)
+                    if kind == "channels":
+                        self._saved_seq.pop(key, None)
+                raise
+
+    def _upsert_fields(self, db, table: str, id_col: str, kind: str, key: str, current: dict, now: float):
+        saved = self._saved.setdefault((kind, key), {})
+        changed = [(key, f, v, now) for f, v in current.items() if saved.get(f) != v]
+        removed = [(key, f) for f in saved if f not in current]
+        if changed:
+            db.executemany(
+                f"INSERT INTO {table} ({id_col}, field, value, updated_at) VALUES (?, ?, ?, ?) "
+                f"ON CONFLICT({id_col}, field) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+                changed,
+            )
+        if removed:
+            db.executemany(f"DELETE FROM {table} WHERE {id_col} = ? AND field = ?", removed)
+        saved.clear()
+        saved.update(current)
+
+    def _append_messages(self, db, chid: str, msgs: list, seq: int):
+        if chid not in self._saved_seq:
+            row = db.execute("SELECT MAX(seq) FROM channel_messages WHERE chid = ?", (chid,)).fetchone()
+            self._saved_seq[chid] = row[0] or 0
+        saved_seq = self._saved_seq[chid]
+        n_new = min(seq - saved_seq, len(msgs))
+        if n_new <= 0:
+            return
+        new_msgs = msgs[len(msgs) - n_new:]
+        first = seq - n_new + 1
+        db.executemany(
+            "INSERT OR REPLACE INTO channel_messages (chid, seq, a, c, t) VALUES (?, ?, ?, ?, ?)",
+            [(chid, first + i, m["a"], m["c"], int(m["t"])) for i, m in enumerate(new_msgs)],
+        )
+        db.execute(
+            "DELETE FROM channel_messages WHERE chid = ? AND seq <= ?",
+            (chid, seq - self.max_messages),
+        )
+        self._saved_seq[chid] = seq
+
+    def forget(self, path: str):
+        # キャッシュから追い出されたら差分用の控えも捨てる（次のloadで取り直す）
+        kind, key = self._split(path)
+        with self._lock:
+            self._saved.pop((kind, key), None)
+            if kind == "channels":
+                self._saved_seq.pop(key, None)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
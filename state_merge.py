@@ -0,0 +1,96 @@
+"""
+ユーザー状態の 3-way merge（GitHub への保存が他の書き手と競合したとき用）
+
+    base   : 前回読んだ / 書いた内容（なければ None = まだファイルがなかった）
+    ours   : 手元の内容（これから書こうとしたもの）
+    theirs : いまリモートにある内容
+
+- daily_counts  : 回数は base からの増分を両方足す（G-counter）。片方が消したキーは消す（古い日を畳んだ）
+- monthly_counts: 月ごとに両方の増分を足したうえで、畳んだ日から直す（merge_rollup）
+                  両方が同じ日を畳んだら base の分が二重なので引く / 片方だけが畳んだら、もう片方の増分を足す
+- kv / nick    : キーごとに、片方しか変えていなければそちら。両方変えていたら更新時刻（kv_t / nick_t）が新しい方
+- emotion      : 両方変えていたら ts が新しい方（感情は足し合わせられないので丸ごと）
+- その他       : 片方しか変えていなければそちら。両方変えていたら手元
+"""
+_MISSING = object()
+
+
+def _pick(b, o, t, o_ts, t_ts):
+    """1つの値を選ぶ -> (値, 時刻)。同時刻なら手元"""
+    if o == t or t == b:
+        return o, o_ts
+    if o == b:
+        return t, t_ts
+    return (o, o_ts) if (o_ts or 0) >= (t_ts or 0) else (t, t_ts)
+
+
+def merge_counts(base: dict, ours: dict, theirs: dict) -> dict:
+    out = {}
+    for k in set(ours) | set(theirs):
+        if k in base and (k not in ours or k not in theirs):
+            continue
+        b = int(base.get(k, 0))
+        out[k] = b + max(0, int(ours.get(k, 0)) - b) + max(0, int(theirs.get(k, 0)) - b)
+    return dict(sorted(out.items()))
+
+
+def merge_rollup(base_d: dict, ours_d: dict, theirs_d: dict,
+                 base_m: dict, ours_m: dict, theirs_m: dict) -> tuple:
+    """daily_counts と、そこから畳んだ monthly_counts をまとめて merge する -> (daily, monthly)"""
+    daily = merge_counts(base_d, ours_d, theirs_d)
+    monthly = merge_counts(base_m, ours_m, theirs_m)
+    for d, b in base_d.items():
+        in_o, in_t = d in ours_d, d in theirs_d
+        ym = d[:7]
+        if (in_o and in_t) or ym not in monthly:
+            continue   # どちらも畳んでいない / 月ごと捨てられた
+        if not in_o and not in_t:
+            monthly[ym] -= int(b)
+        else:
+            rest = ours_d if in_o else theirs_d
+            monthly[ym] += max(0, int(rest[d]) - int(b))
+    return daily, monthly
+
+
+def merge_lww(base: dict, ours: dict, theirs: dict, ours_t: dict, theirs_t: dict) -> tuple:
+    """キーごとの last-writer-wins -> (値の dict, 時刻の dict)"""
+    values, times = {}, {}
+    for k in list(ours) + [k for k in theirs if k not in ours]:
+        v, ts = _pick(base.get(k, _MISSING), ours.get(k, _MISSING), theirs.get(k, _MISSING),
+                      ours_t.get(k), theirs_t.get(k))
+        if v is _MISSING:
+            continue
+        values[k] = v
+        if ts is not None:
+            times[k] = ts
+    return values, times
+
+
+def _emotion_ts(emo) -> float:
+    return float((emo or {}).get("ts") or 0)
+
+
+def merge_user(base: dict | None, ours: dict, theirs: dict) -> dict:
+    base = base or {}
+    out = {}
+    for k in list(ours) + [k for k in theirs if k not in ours]:
+        v, _ = _pick(base.get(k, _MISSING), ours.get(k, _MISSING), theirs.get(k, _MISSING), None, None)
+        if v is not _MISSING:
+            out[k] = v
+
+    out["daily_counts"], out["monthly_counts"] = merge_rollup(
+        base.get("daily_counts") or {}, ours.get("daily_counts") or {}, theirs.get("daily_counts") or {},
+        base.get("monthly_counts") or {}, ours.get("monthly_counts") or {}, theirs.get("monthly_counts") or {},
+    )
+    out["kv"], out["kv_t"] = merge_lww(base.get("kv") or {}, ours.get("kv") or {}, theirs.get("kv") or {},
+                                       ours.get("kv_t") or {}, theirs.get("kv_t") or {})
+    out["nick"], nick_t = _pick(base.get("nick"), ours.get("nick"), theirs.get("nick"),
+                                ours.get("nick_t"), theirs.get("nick_t"))
+    if nick_t is not None:
+        out["nick_t"] = nick_t
+
+    emo_o, emo_t = ours.get("emotion"), theirs.get("emotion")
+    if emo_o is not None or emo_t is not None:
+        out["emotion"], _ = _pick(base.get("emotion"), emo_o, emo_t, _emotion_ts(emo_o), _emotion_ts(emo_t))
+    out["meta"] = ours.get("meta", theirs.get("meta", {}))
+    return out
@@ -0,0 +1,59 @@
+import asyncio
+import sqlite3
+import threading
+
+import memory_store
+from coordination import SQLiteCoordinator
+
+
+def test_claim_once_is_won_by_one_node_and_survives_close(tmp_path):
+    db = str(tmp_path / "coord.sqlite3")
+    a = SQLiteCoordinator(db, node_id="a")
+    b = SQLiteCoordinator(db, node_id="b")
+    try:
+        assert a.claim("once:dm:1", 60)
+        assert not b.claim("once:dm:1", 60)
+        a.close()
+        # 閉じても印は残る（別のプロセスが同じDMにもう一度返事をしない）
+        assert not b.claim("once:dm:1", 60)
+    finally:
+        b.close()
+
+
+def test_contended_coordinator_does_not_block_the_event_loop(tmp_path, monkeypatch):
+    monkeypatch.setattr(memory_store, "MEMORY_BACKEND", "sqlite")
+    monkeypatch.setattr(memory_store, "MEMORY_SQLITE_PATH", str(tmp_path / "mem.sqlite3"))
+    monkeypatch.setattr(memory_store, "COORDINATOR", "sqlite")
+    monkeypatch.setattr(memory_store, "COORD_SQLITE_PATH", str(tmp_path / "coord.sqlite3"))
+    monkeypatch.setattr(memory_store, "_backend", None)
+    monkeypatch.setattr(memory_store, "_coord", None)
+
+    async def run():
+        memory_store.init_db()
+        async with memory_store.claimed(uid="u1"):
+            await memory_store.aget_user("u1")
+            memory_store.set_nickname("u1", "るびのともだち")
+
+        # 別のプロセスが調整役のDBを書き込みロックしている間に flush する
+        other = sqlite3.connect(str(tmp_path / "coord.sqlite3"), isolation_level=None, check_same_thread=False)
+        other.execute("BEGIN IMMEDIATE")
+        threading.Timer(0.4, lambda: other.execute("COMMIT")).start()
+
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.02)
+                ticks += 1
+
+        t = asyncio.ensure_future(ticker())
+        await memory_store.aflush(force=True)
+        t.cancel()
+        await memory_store.close()
+        other.close()
+        return ticks
+
+    ticks = asyncio.run(run())
+    # ロックが外れるまでの 0.4 秒のあいだもループは回っている
+    assert ticks >= 10
@@ -0,0 +1,27 @@
+from history_manager import fit_history, history_entries, summary_backlog
+
+
+WINDOW = [
+    (1, "u1", "きょうは面接だった"),
+    (2, "BOT", "どうだった……？"),
+    (3, "u1", "ただいま"),
+    (4, "BOT", "おかえり……"),
+    (5, "u1", "つかれた"),
+    (6, "BOT", "おつかれさま……✨"),
+    (7, "u1", "ねむい"),
+]
+
+
+def test_history_entries_drops_current_turn_and_homecoming():
+    entries = history_entries(WINDOW, "u1", n_current=1)
+    assert [e[0] for e in entries] == [1, 2, 5, 6]
+    assert entries[0][1] == "user" and entries[1][1] == "assistant"
+    assert [e[0] for e in history_entries(WINDOW, "u1", 1, homecoming=True)] == [1, 2, 3, 4, 5, 6]
+
+
+def test_summary_backlog_matches_compose_window():
+    # 要約に回す範囲は、次のターンで compose が残す先頭より前だけ
+    budget = 2 * (len("おつかれさま……✨") + 4)
+    kept, first_kept = fit_history(history_entries(WINDOW, "u1"), budget)
+    assert [e[0] for e in kept] == [6, 7]
+    assert [e[0] for e in summary_backlog(WINDOW, 0, first_kept)] == [1, 2, 3, 4, 5]
@@ -0,0 +1,132 @@
+import asyncio
+
+from input_pipeline import DebouncePipeline
+
+
+class FakeClock:
+    """DebouncePipeline の clock / sleep に渡す、手で進める時計"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleepers = []
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, delay):
+        fut = asyncio.get_running_loop().create_future()
+        self.sleepers.append((self.now + delay, fut))
+        await fut
+
+    async def advance(self, dt):
+        self.now += dt
+        for entry in list(self.sleepers):
+            when, fut = entry
+            if when <= self.now:
+                self.sleepers.remove(entry)
+                if not fut.done():
+                    fut.set_result(None)
+        # 起きたタスクが次の await まで進むのを待つ
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+
+class Handler:
+    """bot.respond と同じ順番: 1ターン1回だけ数える → 取り込み → 返事を作る（時計で待つ）→ commit → 送信"""
+
+    def __init__(self, clock, think: float):
+        self.clock = clock
+        self.think = think
+        self.charged = 0
+        self.fresh = []
+        self.sent = []
+
+    async def __call__(self, key, turn):
+        if "charged" not in turn.state:
+            turn.state["charged"] = True
+            self.charged += 1
+        self.fresh.extend(turn.take_fresh())
+        await self.clock.sleep(self.think)
+        turn.commit()
+        await self.clock.sleep(self.think)
+        self.sent.append(list(turn.items))
+
+
+def _pipeline(think=1.0):
+    clock = FakeClock()
+    handler = Handler(clock, think)
+    return clock, handler, DebouncePipeline(handler, window=0.8, max_wait=4.0, clock=clock, sleep=clock.sleep)
+
+
+def test_burst_becomes_one_turn():
+    async def run():
+        clock, handler, pipe = _pipeline()
+        pipe.submit("ch", "a")
+        await clock.advance(0.5)
+        pipe.submit("ch", "b")
+        await clock.advance(0.5)
+        assert handler.sent == [] and handler.fresh == []   # まだ静かになっていない
+        await clock.advance(0.4)
+        await clock.advance(1.0)
+        await clock.advance(1.0)
+        return handler, pipe.stats()
+
+    handler, stats = asyncio.run(run())
+    assert handler.sent == [["a", "b"]]
+    assert stats["turns"] == 1 and stats["merged"] == 1
+
+
+def test_restart_before_commit_charges_once_and_takes_each_item_once():
+    async def run():
+        clock, handler, pipe = _pipeline()
+        pipe.submit("ch", "a")
+        await clock.advance(0.8)          # 1ターン目が始まる
+        pipe.submit("ch", "b")            # commit 前なので作り直し
+        await clock.advance(0.8)
+        pipe.submit("ch", "c")            # もう一度作り直し
+        await clock.advance(0.8)
+        for _ in range(3):
+            await clock.advance(1.0)
+        return handler, pipe.stats()
+
+    handler, stats = asyncio.run(run())
+    assert handler.sent == [["a", "b", "c"]]
+    assert handler.fresh == ["a", "b", "c"]
+    assert handler.charged == 1
+    assert stats["restarted"] == 2
+
+
+def test_message_after_commit_is_the_next_turn():
+    async def run():
+        clock, handler, pipe = _pipeline()
+        pipe.submit("ch", "a")
+        await clock.advance(0.8)
+        await clock.advance(1.0)          # commit 済み、送信中
+        pipe.submit("ch", "b")
+        for _ in range(4):
+            await clock.advance(1.0)
+        return handler, pipe.stats()
+
+    handler, stats = asyncio.run(run())
+    assert handler.sent == [["a"], ["b"]]
+    assert handler.charged == 2
+    assert stats["restarted"] == 0
+
+
+def test_drain_waits_for_buffered_and_running_turns():
+    async def run():
+        clock, handler, pipe = _pipeline()
+        pipe.submit("ch1", "a")
+        await clock.advance(0.8)          # ch1 は返事を作っている途中
+        pipe.submit("ch2", "b")           # ch2 はまだためているだけ
+        drain = asyncio.ensure_future(pipe.drain())
+        await clock.advance(0.1)
+        assert not drain.done()
+        for _ in range(4):
+            await clock.advance(1.0)
+        await asyncio.wait_for(drain, 1.0)
+        return handler, pipe.stats()
+
+    handler, stats = asyncio.run(run())
+    assert sorted(handler.sent) == [["a"], ["b"]]
+    assert stats["buffered"] == 0 and stats["in_flight"] == 0
@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("openai")
+
+from openai_scheduler import OpenAIScheduler
+
+
+class ServerError(Exception):
+    status_code = 500
+
+
+def test_deadline_covers_retries():
+    # 持ち時間は submit 前に1回だけ決める。再試行のたびに延びてはいけない
+    async def run():
+        loop = asyncio.get_running_loop()
+        sched = OpenAIScheduler(max_retries=5, backoff_base=0.15, backoff_max=0.15)
+        started = loop.time()
+        attempts = []
+
+        async def call(messages):
+            attempts.append(loop.time() - started)
+            await asyncio.sleep(0.2)
+            raise ServerError("boom")
+
+        with pytest.raises(asyncio.TimeoutError):
+            await sched.submit("u1", lambda: [], call, deadline=started + 0.5)
+        return loop.time() - started, attempts, sched.stats()
+
+    elapsed, attempts, stats = asyncio.run(run())
+    assert elapsed < 0.75
+    assert all(t < 0.5 for t in attempts)
+    assert 1 < len(attempts) < 6
+    assert stats["errors"] == 1
+
+
+def test_retries_within_deadline_succeed():
+    async def run():
+        loop = asyncio.get_running_loop()
+        sched = OpenAIScheduler(max_retries=2, backoff_base=0.01, backoff_max=0.01)
+        failures = [ServerError("a"), ServerError("b")]
+
+        async def call(messages):
+            if failures:
+                raise failures.pop(0)
+            return "ok"
+
+        result = await sched.submit("u1", lambda: [], call, deadline=loop.time() + 1.0)
+        return result, sched.stats()
+
+    result, stats = asyncio.run(run())
+    assert result == "ok"
+    assert stats["retries"] == 2
+
+
+def test_deadline_covers_waiting_for_a_slot():
+    # 同時実行の枠が空かなくても、持ち時間が来たら送らずに TimeoutError
+    async def run():
+        loop = asyncio.get_running_loop()
+        sched = OpenAIScheduler(max_concurrency=1)
+        release = asyncio.Event()
+        calls = []
+
+        async def slow(messages):
+            await release.wait()
+            return "first"
+
+        async def call(messages):
+            calls.append(messages)
+            return "second"
+
+        first = asyncio.create_task(sched.submit("u1", lambda: [], slow))
+        await asyncio.sleep(0)
+        started = loop.time()
+        with pytest.raises(asyncio.TimeoutError):
+            await sched.submit("u2", lambda: [], call, deadline=started + 0.2)
+        elapsed = loop.time() - started
+        release.set()
+        return elapsed, calls, await first, sched.stats()
+
+    elapsed, calls, first, stats = asyncio.run(run())
+    assert elapsed < 0.4
+    assert calls == []
+    assert first == "first"
+    assert stats["expired"] == 1 and stats["queued"] == 0
@@ -0,0 +1,32 @@
+import asyncio
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from rate_limiter import RateLimiter
+
+NOW = datetime(2026, 3, 10, 12, 0, tzinfo=ZoneInfo("Asia/Tokyo"))
+
+
+def test_cold_ahit_reads_counts_with_aload_not_load():
+    sync_calls, async_calls = [], []
+
+    def load(uid, days):
+        sync_calls.append(uid)
+        return [0, 0]
+
+    async def aload(uid, days):
+        async_calls.append((uid, days))
+        await asyncio.sleep(0)
+        return [5, 0]
+
+    limiter = RateLimiter(daily_limit=5, per_minute=60, burst=3,
+                          clock=lambda: NOW, load=load, aload=aload)
+
+    # 今日もう5回使っている相手（保存済みの回数は aload から）
+    assert asyncio.run(limiter.ahit("u1")) == "daily"
+    assert sync_calls == []
+    assert async_calls == [("u1", ["2026-03-10", "2026-03-09"])]
+
+    # 2回目からはメモリ上の状態を使う
+    assert asyncio.run(limiter.ahit("u1")) == "daily"
+    assert len(async_calls) == 1
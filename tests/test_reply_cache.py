@@ -0,0 +1,22 @@
+from reply_cache import ReplyCache
+
+CTX = ("normal", "あなた", "neutral", "sunny", False, True, False)
+
+
+def test_replies_are_not_shared_between_users():
+    cache = ReplyCache(fuzzy_threshold=0.6)
+    cache.store("user-a", "ただいま", CTX, "おかえり……今日の面接どうだった……？")
+
+    # 同じ文面・同じ状況でも、別の相手には完全一致でもあいまい一致でも返さない
+    assert cache.lookup("user-b", "ただいま", CTX) is None
+    assert cache.lookup("user-b", "ただいま〜", CTX) is None
+    assert cache.stats()["hits"] == 0 and cache.stats()["fuzzy_hits"] == 0
+
+    assert cache.lookup("user-a", "ただいま！", CTX) == "おかえり……今日の面接どうだった……？"
+
+
+def test_same_user_does_not_get_the_same_reply_twice_in_a_row():
+    cache = ReplyCache()
+    cache.store("user-a", "おやすみ", CTX, "おやすみ……✨")
+    assert cache.lookup("user-a", "おやすみ", CTX) == "おやすみ……✨"
+    assert cache.lookup("user-a", "おやすみ", CTX) is None
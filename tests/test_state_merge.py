@@ -0,0 +1,32 @@
+from state_merge import merge_user
+
+
+def _user(daily, monthly=None):
+    return {"uid": "u1", "daily_counts": dict(daily), "monthly_counts": dict(monthly or {}), "kv": {}, "kv_t": {}}
+
+
+BASE_DAYS = {f"2026-10-{d:02d}": 5 for d in range(1, 8)}
+
+
+def test_concurrent_rollup_of_the_same_day_counts_it_once():
+    base = _user(BASE_DAYS)
+    # 両方が新しい日を足して、一番古い 10-01 を月に畳んだ
+    ours_days = {k: v for k, v in BASE_DAYS.items() if k != "2026-10-01"}
+    ours = _user({**ours_days, "2026-10-08": 1}, {"2026-10": 5})
+    theirs = _user({**ours_days, "2026-10-09": 2}, {"2026-10": 5})
+
+    merged = merge_user(base, ours, theirs)
+    assert merged["monthly_counts"] == {"2026-10": 5}
+    assert "2026-10-01" not in merged["daily_counts"]
+    assert merged["daily_counts"]["2026-10-08"] == 1 and merged["daily_counts"]["2026-10-09"] == 2
+
+
+def test_rollup_on_one_side_keeps_the_other_sides_increments():
+    base = _user(BASE_DAYS)
+    ours = _user({k: v for k, v in BASE_DAYS.items() if k != "2026-10-01"} | {"2026-10-08": 1}, {"2026-10": 5})
+    # 相手は畳む前の 10-01 に 3 回足していた
+    theirs = _user({**BASE_DAYS, "2026-10-01": 8})
+
+    merged = merge_user(base, ours, theirs)
+    assert merged["monthly_counts"] == {"2026-10": 8}
+    assert "2026-10-01" not in merged["daily_counts"]
@@ -0,0 +1,84 @@
+"""
+用意したコーパスから Ruby のモデルをまとめて学習して保存する
+
+    python train_ruby.py --jsonl corpus.jsonl     # 1行1メッセージ（{"c": "..."} か文字列）のコーパスから
+    python train_ruby.py --jsonl corpus.jsonl --out ruby_model.bin --workers 4
+    python train_ruby.py --mem-dir ruby_mem       # 保存済みの会話から（中身を確認してから使う）
+
+モデルは全員のフォールバック返事で共有するので、特定の相手のDMを含むものは学習させない
+（--mem-dir は公開してよい会話だけのディレクトリを用意したときに使う）
+bot.py は起動時に RUBY_MODEL_PATH（既定 ruby_model.bin）を読み込むので、そのまま使える
+"""
+import argparse
+import glob
+import json
+import os
+import time
+
+from ruby_core import Ruby
+
+
+def iter_channel_messages(mem_dir: str):
+    """channels/{chid}.json のスナップショットと channels/{chid}.d/*.jsonl の追記分を順に流す"""
+    for path in sorted(glob.glob(os.path.join(mem_dir, "channels", "*.json"))):
+        with open(path, encoding="utf-8") as f:
+            msgs = json.load(f).get("messages", [])
+        segs = sorted(glob.glob(os.path.join(path[:-len(".json")] + ".d", "*.jsonl")))
+        for m in msgs:
+            yield m
+        for seg in segs:
+            yield from iter_jsonl(seg)
+
+
+def iter_jsonl(path: str):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            row = json.loads(line)
+            yield row if isinstance(row, dict) else {"c": str(row)}
+
+
+def main():
+    ap = argparse.ArgumentParser(description="会話ログから Ruby のモデルを学習する")
+    ap.add_argument("--mem-dir", default="", help="channels/ 以下の保存済み会話から学習する（共有してよいものだけ）")
+    ap.add_argument("--jsonl", action="append", default=[], help="1行1メッセージのダンプ（複数可）")
+    ap.add_argument("--who", choices=["all", "bot", "users"], default="all", help="学習する発言者")
+    ap.add_argument("--out", default=os.getenv("RUBY_MODEL_PATH", "ruby_model.bin"))
+    ap.add_argument("--base", default="", help="続きから学習するモデルファイル")
+    ap.add_argument("--workers", type=int, default=0, help="0でCPU数、1でプロセスを使わない")
+    ap.add_argument("--chunk-size", type=int, default=5000)
+    ap.add_argument("--max-keys", type=int, default=50000)
+    args = ap.parse_args()
+    if not args.jsonl and not args.mem_dir:
+        ap.error("--jsonl か --mem-dir で学習するコーパスを指定してください")
+
+    def messages():
+        for path in args.jsonl:
+            yield from iter_jsonl(path)
+        if args.mem_dir:
+            yield from iter_channel_messages(args.mem_dir)
+
+    def texts():
+        for m in messages():
+            is_bot = m.get("a") == "BOT"
+            if (args.who == "bot" and not is_bot) or (args.who == "users" and is_bot):
+                continue
+            yield m.get("c", "")
+
+    ruby = Ruby(max_keys=args.max_keys)
+    if args.base:
+        ruby.load_model(args.base)
+
+    t0 = time.perf_counter()
+    stats = ruby.train(texts(), workers=args.workers, chunk_size=args.chunk_size)
+    sec = time.perf_counter() - t0
+    ruby.save_model(args.out)
+    st = ruby.model_stats()
+    print(f"trained {stats['trained']}/{stats['messages']} messages in {sec:.2f}s "
+          f"-> {args.out} ({st['keys']} keys + base {st['base_keys']} keys)")
+
+
+if __name__ == "__main__":
+    main()